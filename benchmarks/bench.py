@@ -0,0 +1,209 @@
+"""Throughput and latency benchmarks for ``kombu-stomp``.
+
+Messages go through the whole transport (``Channel._put``,
+``MessageListener.on_message`` and ``QoS.ack``) against the in-process
+broker from :py:mod:`kombu_stomp.testing`, so results only depend on the
+client side. Every scenario publishes from a thread while the main thread
+consumes and acks, and reports::
+
+    publish_rate, consume_rate     messages per second
+    latency_p50, latency_p99       publish to consume latency, in ms
+    ack_cost                       mean time spent in message.ack(), in us
+    bytes_per_msg                  SEND frame bytes per message
+
+Payloads are JSON documents of about ``--sizes`` bytes. Bytes saved by
+compression show comparing ``bytes_per_msg`` with and without it::
+
+    python benchmarks/bench.py --transport-options '{"compression": "zlib"}'
+
+Results are printed as JSON, so they can be stored and compared later::
+
+    python benchmarks/bench.py --output baseline.json
+    python benchmarks/bench.py --compare baseline.json
+"""
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+
+import kombu
+
+import kombu_stomp
+from kombu_stomp import testing
+from kombu_stomp.utils import monotonic
+
+kombu_stomp.register_transport()
+
+TAGS = ['red', 'green', 'blue', 'new', 'sale', 'bulk', 'fragile', 'eu', 'us']
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def make_payload(size):
+    """Return a JSON-like document of about ``size`` bytes.
+
+    Records look like typical task arguments, so compression ratios are
+    realistic, unlike with a run of a single character.
+    """
+    rand = random.Random(size)
+    records = []
+    length = 2
+    while length < size:
+        record = {
+            'id': rand.randint(0, 1 << 30),
+            'name': 'item-{0}'.format(rand.randint(0, 9999)),
+            'price': round(rand.random() * 100, 2),
+            'tags': rand.sample(TAGS, 2),
+        }
+        records.append(record)
+        length += len(json.dumps(record)) + 2
+    return records
+
+
+def publish(url, queues, count, size, transport_options, result):
+    payload = make_payload(size)
+    with kombu.Connection(url, transport_options=transport_options) as conn:
+        producer = conn.Producer(serializer='json')
+        names = itertools.cycle(queues)
+        start = monotonic()
+        for _ in range(count):
+            producer.publish({'t': monotonic(), 'payload': payload},
+                             routing_key=next(names))
+        result['publish_time'] = monotonic() - start
+
+
+def run_scenario(broker, count, size, queues, prefetch, transport_options):
+    """Run one benchmark scenario and return its results as a dict."""
+    url = 'stomp://{0}:{1}'.format(*broker.host_and_port)
+    names = ['bench.{0}.{1}'.format(size, i) for i in range(queues)]
+    latencies = []
+    ack_times = []
+
+    def on_message(body, message):
+        latencies.append(monotonic() - body['t'])
+        start = monotonic()
+        message.ack()
+        ack_times.append(monotonic() - start)
+
+    with kombu.Connection(url, transport_options=transport_options) as conn:
+        consumer = conn.Consumer(
+            [kombu.Queue(name, routing_key=name) for name in names],
+            callbacks=[on_message],
+            accept=['json'],
+        )
+        if prefetch:
+            consumer.qos(prefetch_count=prefetch)
+
+        with consumer:
+            send_bytes = broker.stats['SEND_bytes']
+            published = {}
+            producer = threading.Thread(
+                target=publish,
+                args=(url, names, count, size, transport_options, published),
+            )
+            start = monotonic()
+            producer.start()
+            while len(latencies) < count:
+                conn.drain_events(timeout=10)
+            consume_time = monotonic() - start
+            producer.join()
+
+    publish_bytes = broker.stats['SEND_bytes'] - send_bytes
+    return {
+        'count': count,
+        'size': size,
+        'queues': queues,
+        'prefetch': prefetch,
+        'publish_rate': count / published['publish_time'],
+        'consume_rate': count / consume_time,
+        'latency_p50': percentile(latencies, 50) * 1000,
+        'latency_p99': percentile(latencies, 99) * 1000,
+        'ack_cost': sum(ack_times) / len(ack_times) * 1e6,
+        'bytes_per_msg': float(publish_bytes) / count,
+    }
+
+
+def scenario_key(result):
+    return result['size'], result['queues'], result['prefetch']
+
+
+def compare(results, baseline, tolerance):
+    """Return the scenarios with a rate worse than ``baseline``."""
+    previous = dict((scenario_key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get(scenario_key(result))
+        if old is None:
+            continue
+        for metric in ('publish_rate', 'consume_rate'):
+            if result[metric] < old[metric] * (1 - tolerance):
+                regressions.append({
+                    'scenario': scenario_key(result),
+                    'metric': metric,
+                    'baseline': old[metric],
+                    'current': result[metric],
+                })
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=2000,
+                        help='messages per scenario')
+    parser.add_argument('--sizes', type=int_list, default=[64, 1024, 16384],
+                        help='comma separated payload sizes, in bytes')
+    parser.add_argument('--queues', type=int_list, default=[1, 4],
+                        help='comma separated number of queues')
+    parser.add_argument('--prefetch', type=int_list, default=[0, 100],
+                        help='comma separated prefetch counts, 0 is no limit')
+    parser.add_argument('--transport-options', type=json.loads, default={},
+                        help='transport options, as JSON')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--compare', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed rate decrease when comparing')
+    args = parser.parse_args(argv)
+
+    results = []
+    with testing.Broker() as broker:
+        for size, queues, prefetch in itertools.product(args.sizes,
+                                                        args.queues,
+                                                        args.prefetch):
+            results.append(run_scenario(broker, args.count, size, queues,
+                                        prefetch, args.transport_options))
+
+    report = {
+        'python': platform.python_version(),
+        'kombu': kombu.__version__,
+        'transport_options': args.transport_options,
+        'results': results,
+    }
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(results, json.load(f),
+                                            args.tolerance)
+        status = 1 if report['regressions'] else 0
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
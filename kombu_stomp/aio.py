@@ -0,0 +1,629 @@
+"""asyncio support for ``kombu-stomp``, Python 3.5+ only.
+
+:py:class:`Channel` keeps the transport channel options, QoS and messages,
+but talks STOMP over an asyncio stream instead of a stomp.py receiver thread
+per connection. Publishing, subscribing and acknowledging only write to the
+stream buffer, so they don't block and Kombu producers and consumers can be
+used as usual, while waiting for messages and for the broker to take what
+was written is done by coroutines::
+
+    conn = kombu.Connection('stomp://localhost:61613',
+                            transport='kombu_stomp.aio:Transport')
+    channel = await aio.connect(conn)
+
+    await channel.publish({'hello': 'world'}, routing_key='queue')
+
+    consumer = kombu.Consumer(channel, [queue], callbacks=[on_message])
+    consumer.consume()
+    while True:
+        await channel.drain_events()
+"""
+from __future__ import absolute_import
+import asyncio
+import collections
+import contextlib
+import random
+import socket
+import uuid
+
+from kombu import serialization
+from six.moves import queue as _queue
+from stomp import exception as exc
+
+from . import metrics as _metrics
+from . import stomp
+from . import transport
+from .utils import monotonic
+
+#: Longest line, or body without content-length, the frame reader takes.
+STREAM_LIMIT = 1 << 24
+
+Frame = collections.namedtuple('Frame', 'command headers body')
+
+
+class FrameReader(object):
+    """STOMP frame parser reading from an :py:class:`asyncio.StreamReader`.
+
+    :py:attr:`last_read` is the :py:func:`monotonic` time anything was read
+    last, heart-beats included.
+    """
+    def __init__(self, reader, version='1.0'):
+        self.reader = reader
+        self.version = version
+        self.last_read = monotonic()
+
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\n'):
+            raise exc.ConnectionClosedException()
+        self.last_read = monotonic()
+        return line.rstrip(b'\r\n')
+
+    async def read(self):
+        """Return the next :py:class:`Frame`.
+
+        :raises: :py:exc:`stomp.exception.ConnectionClosedException` if the
+            stream ends.
+        """
+        command = b''
+        while not command:
+            # heart-beats and optional EOLs between frames
+            command = await self.readline()
+
+        headers = {}
+        while True:
+            line = (await self.readline()).decode('utf-8')
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            # first header wins, as per the spec
+            headers.setdefault(stomp.unescape(key, self.version),
+                               stomp.unescape(value, self.version))
+
+        try:
+            if 'content-length' in headers:
+                length = int(headers['content-length'])
+                body = (await self.reader.readexactly(length + 1))[:-1]
+            else:
+                body = (await self.reader.readuntil(b'\x00'))[:-1]
+        except asyncio.IncompleteReadError:
+            raise exc.ConnectionClosedException()
+        self.last_read = monotonic()
+        return Frame(command.decode('utf-8'), headers, body)
+
+
+class Connection(object):
+    """asyncio STOMP connection, with the stomp.py connection API the
+    transport uses.
+
+    Frames are written right away to the stream buffer, and
+    :py:meth:`drain` waits until the broker took them. Received messages
+    are kept by :py:attr:`message_listener` like in threaded connections,
+    and :py:meth:`get` waits for them. Reading from the broker stops while
+    the buffer is full.
+
+    :arg host_and_ports: brokers tried in order by :py:meth:`connect`.
+    """
+    def __init__(self, prefix='', version='1.2', heartbeats=(0, 0),
+                 host_and_ports=None, buffer_size=0, buffer_bytes=0,
+                 queue_weights=None, metrics=None):
+        self.version = version
+        self.heartbeats = heartbeats
+        self.host_and_ports = host_and_ports or [('127.0.0.1', 61613)]
+        self.metrics = metrics or _metrics.Metrics()
+        self.message_listener = stomp.MessageListener(
+            prefix=prefix,
+            q=stomp.ReceiveBuffer(buffer_size, buffer_bytes, queue_weights),
+            version=version,
+            metrics=self.metrics,
+        )
+        self.message_listener.conn = self
+        #: (host, port) connected to, and the ones that failed before it
+        self.broker = None
+        self.failed = []
+        #: seconds the broker took to answer CONNECT
+        self.latency = None
+        self.connected = False
+        self._reader = self._writer = None
+        self._tasks = []
+        self._last_write = monotonic()
+        # set when messages are buffered, and when there's room for more
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        # whether reading waits for room in the buffer
+        self._backpressured = False
+        self._batch = None
+        self._batch_timer = None
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self, username=None, passcode=None, **kwargs):
+        """Connect to the first broker accepting it.
+
+        :raises: :py:exc:`stomp.exception.ConnectFailedException` if none
+            does.
+        """
+        self.failed = []
+        for host, port in self.host_and_ports:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    host, port, limit=STREAM_LIMIT)
+            except OSError:
+                self.failed.append((host, port))
+                continue
+            break
+        else:
+            raise exc.ConnectFailedException()
+
+        self.broker = (host, port)
+        self.message_listener.on_connecting(self.broker)
+        self._reader = FrameReader(reader)
+        self._writer = writer
+        headers = {
+            'accept-version': ','.join(
+                v for v in stomp.VERSIONS if v <= self.version),
+            'host': host,
+        }
+        if username is not None:
+            headers['login'] = username
+            headers['passcode'] = passcode
+        if self.version != '1.0':
+            headers['heart-beat'] = '{0},{1}'.format(*self.heartbeats)
+        start = monotonic()
+        # CONNECT headers are never escaped
+        writer.write(stomp.encode_frame('CONNECT', headers))
+        try:
+            frame = await self._reader.read()
+        except exc.ConnectionClosedException:
+            frame = None
+        if frame is None or frame.command != 'CONNECTED':
+            writer.close()
+            raise exc.ConnectFailedException(
+                frame.headers.get('message') if frame else None)
+
+        self.latency = monotonic() - start
+        self.message_listener.on_connected(frame.headers, frame.body)
+        self.version = self._reader.version = self.message_listener.version
+        self.connected = True
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._receive())]
+        if self.version != '1.0' and 'heart-beat' in frame.headers:
+            send, expect = self._negotiate(frame.headers['heart-beat'])
+            if send or expect:
+                self._tasks.append(
+                    loop.create_task(self._heartbeat(send, expect)))
+
+    def _negotiate(self, server_heartbeats):
+        """Return the seconds between heart-beats sent and expected."""
+        sx, sy = (int(v) for v in server_heartbeats.split(','))
+        cx, cy = self.heartbeats
+        send = max(cx, sy) / 1000.0 if cx and sy else 0
+        expect = max(cy, sx) / 1000.0 if cy and sx else 0
+        return send, expect
+
+    async def _heartbeat(self, send, expect):
+        interval = min(v for v in (send, expect) if v) / 2.0
+        while self.connected:
+            await asyncio.sleep(interval)
+            now = monotonic()
+            if send and now - self._last_write >= send:
+                self._write(b'\n')
+            if self._backpressured:
+                # frames aren't read while waiting for room in the buffer
+                self._reader.last_read = now
+            # allow for some network delay, like stomp.py does
+            if expect and now - self._reader.last_read > expect * 2:
+                self.message_listener.on_heartbeat_timeout()
+                self._close()
+                return
+
+    async def _receive(self):
+        q = self.message_listener.q
+        listener = self.message_listener
+        try:
+            while True:
+                frame = await self._reader.read()
+                if frame.command == 'MESSAGE':
+                    while q.full():
+                        self._room.clear()
+                        self._backpressured = True
+                        await self._room.wait()
+                    self._backpressured = False
+                    listener.on_message(frame.headers, frame.body)
+                    self._ready.set()
+                elif frame.command == 'RECEIPT':
+                    listener.on_receipt(frame.headers, frame.body)
+                elif frame.command == 'ERROR':
+                    listener.on_error(frame.headers, frame.body)
+        except exc.ConnectionClosedException:
+            listener.on_disconnected()
+        finally:
+            self._close()
+
+    def _close(self):
+        self.connected = False
+        if self._writer is not None:
+            self._writer.close()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        # wake up getters, they find out we are disconnected
+        self._ready.set()
+
+    async def get(self, queues=None, timeout=None):
+        """Return the next received message from ``queues``.
+
+        :raises: :py:exc:`queue.Empty` after waiting ``timeout`` seconds,
+            :py:exc:`stomp.exception.NotConnectedException` if the
+            connection is lost.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            try:
+                item = self.message_listener.q.get_nowait(keys=queues)
+            except _queue.Empty:
+                if not self.connected:
+                    raise exc.NotConnectedException()
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    raise _queue.Empty()
+            else:
+                self._room.set()
+                return item
+
+    async def drain(self):
+        """Wait until the broker took everything written so far."""
+        self.flush()
+        if self.connected:
+            await self._writer.drain()
+
+    def _write(self, data):
+        if not self.connected:
+            raise exc.NotConnectedException()
+        self._writer.write(data)
+        self._last_write = monotonic()
+
+    def send_frame(self, cmd, headers, body=''):
+        data = stomp.encode_frame(cmd, headers, body, self.version)
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_sent_total',
+                                   command=cmd)
+        if self._batch is None:
+            return self._write(data)
+
+        if cmd != 'SEND':
+            # never reorder frames
+            self.flush()
+            return self._write(data)
+
+        self._batch.append(data)
+        self._batch_bytes += len(data)
+        max_frames, max_bytes, interval = self._batch_limits
+        if ((max_frames and len(self._batch) >= max_frames) or
+                (max_bytes and self._batch_bytes >= max_bytes)):
+            self.flush()
+        elif interval and self._batch_timer is None:
+            self._batch_timer = asyncio.get_event_loop().call_later(
+                interval, self.flush)
+
+    @property
+    def batching(self):
+        return self._batch is not None
+
+    def begin_batch(self, max_frames=None, max_bytes=None, interval=None):
+        """Buffer SEND frames, see
+        :py:meth:`kombu_stomp.stomp.ConnectionMixin.begin_batch`.
+        """
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_limits = (max_frames, max_bytes, interval)
+
+    def end_batch(self):
+        self.flush()
+        self._batch = None
+
+    def flush(self):
+        """Write the buffered SEND frames."""
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if self._batch:
+            data = b''.join(self._batch)
+            del self._batch[:]
+            self._batch_bytes = 0
+            self._write(data)
+
+    def send(self, destination, body, headers=None, **kwargs):
+        headers = dict(headers or {}, **kwargs)
+        headers['destination'] = destination
+        self.send_frame('SEND', headers, body)
+
+    def subscribe(self, destination, id, ack='auto', **headers):
+        # see stomp.MessageListener.drop
+        self.message_listener.ack_modes[id] = ack
+        headers.update(destination=destination, id=id, ack=ack)
+        self.send_frame('SUBSCRIBE', headers)
+
+    def unsubscribe(self, id, **headers):
+        headers['id'] = id
+        self.send_frame('UNSUBSCRIBE', headers)
+
+    def _ack_headers(self, id, transaction):
+        if self.version == '1.0':
+            headers = {'message-id': id}
+        elif self.version == '1.1':
+            headers = {'message-id': id[0], 'subscription': id[1]}
+        else:
+            headers = {'id': id}
+        if transaction is not None:
+            headers['transaction'] = transaction
+        return headers
+
+    def ack(self, id, transaction=None):
+        self.send_frame('ACK', self._ack_headers(id, transaction))
+
+    def nack(self, id, transaction=None):
+        self.send_frame('NACK', self._ack_headers(id, transaction))
+
+    def begin(self, transaction=None):
+        transaction = transaction or str(uuid.uuid4())
+        self.send_frame('BEGIN', {'transaction': transaction})
+        return transaction
+
+    def commit(self, transaction):
+        self.send_frame('COMMIT', {'transaction': transaction})
+
+    def abort(self, transaction):
+        self.send_frame('ABORT', {'transaction': transaction})
+
+    def disconnect(self):
+        if not self.connected:
+            raise exc.NotConnectedException()
+        self.flush()
+        self._write(stomp.encode_frame('DISCONNECT', {}))
+        self._close()
+
+
+class Channel(transport.Channel):
+    """``kombu-stomp`` channel over an asyncio :py:class:`Connection`.
+
+    It must be connected with :py:meth:`connect` before use. Lost
+    connections are replaced, and queues subscribed again, by the
+    coroutines, like threaded channels do, so synchronous methods raise
+    :py:exc:`stomp.exception.NotConnectedException` while disconnected.
+    """
+    # connections belong to a single channel, there are no threads to share
+    shared_connection = False
+
+    def __init__(self, *args, **kwargs):
+        super(Channel, self).__init__(*args, **kwargs)
+        # set when messages are acked, since prefetch limits may allow more
+        self._acked = asyncio.Event()
+
+    async def connect(self):
+        """Connect, or replace the lost connection, and return the channel.
+
+        Brokers are tried as configured by the ``failover`` and
+        ``reconnect_*`` transport options.
+        """
+        if self._stomp_conn is not None and self._stomp_conn.is_connected():
+            return self
+
+        start = monotonic()
+        failover = self._connected
+        self.qos.discard_stale()
+        if self._stomp_conn is not None:
+            self._stomp_conn.message_listener.close()
+
+        attempt = 0
+        while True:
+            conn = self._new_channel_conn()
+            params = self._get_conn_params()
+            try:
+                await conn.connect(params['username'], params['passcode'])
+            except exc.ConnectFailedException:
+                for broker in conn.host_and_ports:
+                    self.connection.broker_latency[broker] = transport.FAILED
+                attempt += 1
+                if 0 <= self.reconnect_attempts <= attempt:
+                    raise
+                delay = min(self.reconnect_delay_max,
+                            self.reconnect_delay *
+                            (1 + self.reconnect_backoff) ** (attempt - 1))
+                await asyncio.sleep(
+                    delay * (1 + random.random() * self.reconnect_jitter))
+            else:
+                break
+
+        for broker in conn.failed:
+            self.connection.broker_latency[broker] = transport.FAILED
+        self.connection.broker_latency[conn.broker] = conn.latency
+        self.stomp_version = conn.version
+        self._stomp_conn = conn
+        self._connected = True
+        self._resubscribe()
+        if failover:
+            self._recovered(start)
+        return self
+
+    def _new_channel_conn(self):
+        conn = Connection(self.prefix,
+                          version=self.stomp_version,
+                          heartbeats=tuple(self.heartbeats),
+                          host_and_ports=self.sort_brokers(self.brokers),
+                          buffer_size=self.receive_buffer_size,
+                          buffer_bytes=self.receive_buffer_bytes,
+                          queue_weights=self.queue_weights,
+                          metrics=self.metrics)
+        if self.publish_batch_size > 1:
+            conn.begin_batch(self.publish_batch_size,
+                             self.publish_batch_bytes,
+                             self.publish_batch_interval)
+        return conn
+
+    @contextlib.contextmanager
+    def conn_or_acquire(self, disconnect=False):
+        """Use the current connection, see :py:meth:`connect`."""
+        if not self.stomp_conn.is_connected():
+            raise exc.NotConnectedException()
+
+        yield self.stomp_conn
+
+        if disconnect:
+            self.stomp_conn.disconnect()
+
+    def _get_many(self, queue, timeout=None):
+        # never block the event loop, see drain_events
+        return super(Channel, self)._get_many(queue, timeout=0)
+
+    async def _next(self, queues, timeout):
+        if not self.stomp_conn.is_connected():
+            await self.connect()
+
+        conn = self.stomp_conn
+        self._update_prefetch(conn)
+        for queue in queues:
+            self.subscribe(conn, queue)
+        if not conn.message_listener.qsize():
+            # we are idle, so don't keep acknowledgements waiting
+            self.qos.flush_acks()
+        try:
+            item = await conn.get(queues, timeout)
+        except _queue.Empty:
+            raise socket.timeout()
+        if self.metrics.enabled:
+            conn.message_listener.report_buffer()
+        return item
+
+    async def drain_events(self, timeout=None):
+        """Deliver the next message to its consumer callback.
+
+        It waits while QoS limits don't allow more unacknowledged messages.
+
+        :raises: :py:exc:`socket.timeout` if no message can be delivered
+            within ``timeout`` seconds, like Kombu does.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not (self._consumers and self.qos.can_consume()):
+            self._acked.clear()
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(self._acked.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise socket.timeout()
+
+        remaining = None if deadline is None else deadline - loop.time()
+        item, queue = await self._next(self._active_queues, remaining)
+        self.connection._callbacks[queue](item)
+
+    async def get(self, queue, no_ack=False, timeout=None):
+        """Return the next message from ``queue``, like ``basic_get`` does,
+        but waiting up to ``timeout`` seconds for it.
+        """
+        item, _ = await self._next([queue], timeout)
+        message = self.Message(self, item)
+        if not no_ack:
+            self.qos.append(message, message.delivery_tag)
+        return message
+
+    async def publish(self, body, routing_key, exchange='',
+                      serializer='json', headers=None, **properties):
+        """Publish ``body`` and wait until the broker took it."""
+        if not self.stomp_conn.is_connected():
+            await self.connect()
+
+        content_type, content_encoding, body = serialization.dumps(
+            body, serializer=serializer)
+        message = self.prepare_message(body,
+                                       properties.pop('priority', None),
+                                       content_type,
+                                       content_encoding,
+                                       headers,
+                                       properties)
+        self.basic_publish(message, exchange, routing_key)
+        await self.stomp_conn.drain()
+
+    async def ack(self, message):
+        """Acknowledge ``message`` and wait until the broker took it."""
+        message.ack()
+        self.qos.flush_acks()
+        await self.stomp_conn.drain()
+
+    async def flush(self):
+        """Send buffered acknowledgements and published messages."""
+        self.qos.flush_acks()
+        await self.stomp_conn.drain()
+
+    def basic_ack(self, *args, **kwargs):
+        super(Channel, self).basic_ack(*args, **kwargs)
+        self._acked.set()
+
+    def basic_reject(self, *args, **kwargs):
+        super(Channel, self).basic_reject(*args, **kwargs)
+        self._acked.set()
+
+
+class Transport(transport.Transport):
+    """asyncio transport for ``kombu-stomp``, see :py:class:`Channel`."""
+    Channel = Channel
+
+    supports_ev = False
+
+    def __init__(self, client, *args, **kwargs):
+        super(Transport, self).__init__(client, *args, **kwargs)
+        # a single connection per channel, there are no threads to share
+        self.publisher_pool = None
+
+    def drain_events(self, connection, timeout=None):
+        """Deliver the next message from any channel, running the event loop
+        until then, for code that isn't a coroutine.
+
+        Coroutines must await :py:meth:`Channel.drain_events` instead, since
+        the loop can't be run while it's running already. Heart-beats are
+        only exchanged while the loop runs.
+
+        :raises: :py:exc:`socket.timeout` if no message is delivered within
+            ``timeout`` seconds, :py:exc:`RuntimeError` if called while the
+            event loop is running.
+        """
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            raise RuntimeError('The event loop is running, await the channel '
+                               'drain_events coroutine instead')
+        loop.run_until_complete(self._drain_events(timeout))
+
+    async def _drain_events(self, timeout):
+        if not self.channels:
+            if timeout is not None:
+                await asyncio.sleep(timeout)
+            raise socket.timeout()
+
+        tasks = [asyncio.ensure_future(channel.drain_events(timeout))
+                 for channel in self.channels]
+        done, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        # another channel may have timed out at the same time
+        for task in done:
+            if task.exception() is None:
+                return
+        done.pop().result()
+
+
+async def connect(connection):
+    """Return a connected :py:class:`Channel` for the Kombu ``connection``.
+    """
+    return await connection.channel().connect()
@@ -0,0 +1,99 @@
+"""In-process asyncio STOMP broker for tests, Python 3.5+ only.
+
+It's :py:class:`kombu_stomp.testing.Broker` served from the event loop, so
+asyncio clients can be tested without threads, e.g.::
+
+    async with aiotesting.Broker() as broker:
+        conn = kombu.Connection('stomp://127.0.0.1:{0}'.format(broker.port),
+                                transport='kombu_stomp.aio:Transport')
+"""
+from __future__ import absolute_import
+import asyncio
+
+from . import testing
+from .stomp import encode_frame
+
+
+class Session(testing.Session):
+    """Server side of a client connection, over asyncio streams."""
+    def __init__(self, broker, reader, writer):
+        super(Session, self).__init__(broker, None)
+        self.thread = None
+        self.reader = reader
+        self.writer = writer
+
+    def send_frame(self, command, headers, body=b''):
+        self.send_data(encode_frame(command, headers, body, self.version))
+
+    def send_data(self, data):
+        if self.writer.transport.is_closing():
+            self.running = False
+            return
+        self.writer.write(data)
+        self.broker.stats['bytes_out'] += len(data)
+
+    def start_heartbeats(self, interval):
+        async def run():
+            while self.running:
+                await asyncio.sleep(interval)
+                self.send_data(b'\n')
+
+        asyncio.get_event_loop().create_task(run())
+
+    async def run(self):
+        try:
+            while self.running:
+                try:
+                    data = await self.reader.read(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            self.close()
+
+    def close(self):
+        self.running = False
+        self.transactions.clear()
+        self.broker.remove_session(self)
+        self.writer.close()
+
+
+class Broker(testing.Broker):
+    """STOMP broker listening on a loopback TCP port, see
+    :py:class:`kombu_stomp.testing.Broker`.
+
+    It starts listening with :py:meth:`start`, or when entering it with
+    ``async with``.
+    """
+    def listen(self, host, port):
+        self.host, self.port = host, port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._accept,
+                                                 self.host,
+                                                 self.port)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        self.running = True
+        return self
+
+    async def stop(self):
+        """Stop accepting connections and close all sessions."""
+        self.running = False
+        self.server.close()
+        for session in list(self.sessions):
+            session.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _accept(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.append(session)
+        await session.run()
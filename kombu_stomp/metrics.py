@@ -0,0 +1,187 @@
+"""Metrics hooks for ``kombu-stomp``.
+
+Pass a :py:class:`Metrics` instance as the ``metrics`` transport option to
+get the transport instrumented, e.g. with :py:class:`InMemoryMetrics`::
+
+    metrics = InMemoryMetrics()
+    conn = kombu.Connection('stomp://', transport_options={'metrics': metrics})
+    ...
+    print(metrics.render())
+
+The following metrics are emitted, labelled with the ``channel`` ID:
+
+``kombu_stomp_frames_sent_total{command}``
+    Counter of frames sent, e.g. ``SEND`` or ``ACK``.
+``kombu_stomp_frames_received_total{command}``
+    Counter of frames received, e.g. ``MESSAGE``.
+``kombu_stomp_received_bytes_total{queue}``
+    Counter of message body bytes received, as sent over the wire.
+``kombu_stomp_published_bytes_total{queue}``
+    Counter of message body bytes published, as sent over the wire.
+``kombu_stomp_decode_seconds``
+    Histogram of the time taken turning a STOMP frame into a Kombu message.
+``kombu_stomp_receive_buffer_messages``, ``kombu_stomp_receive_buffer_bytes``
+    Gauges of messages received but not consumed yet.
+``kombu_stomp_unacked_messages``, ``kombu_stomp_unacked_bytes``
+    Gauges of messages delivered to Kombu and not acknowledged yet, and of
+    the memory used tracking them.
+``kombu_stomp_ack_latency_seconds``
+    Histogram of the time from delivering a message to Kombu until it's
+    acknowledged.
+``kombu_stomp_queue_wait_seconds{queue,broker}``
+    Histogram of the time from reaching the broker until received, see
+    :py:class:`kombu_stomp.transport.Message`.
+``kombu_stomp_buffer_wait_seconds{queue,broker}``
+    Histogram of the time from being received until delivered to Kombu.
+``kombu_stomp_latency_seconds{queue,broker}``
+    Histogram of the time from being published until delivered to Kombu.
+``kombu_stomp_reconnects_total``, ``kombu_stomp_failover_seconds``
+    Counter of lost connections replaced, and histogram of the time it took.
+"""
+from __future__ import absolute_import
+import threading
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0)
+
+
+class Metrics(object):
+    """Metrics hook doing nothing, the default one.
+
+    Subclasses receive metrics by overriding :py:meth:`increment`,
+    :py:meth:`gauge` and :py:meth:`observe`, and setting :py:attr:`enabled`,
+    otherwise nothing is measured, so the hot path doesn't pay for it.
+    """
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        """Add ``value`` to counter ``name``."""
+
+    def gauge(self, name, value, **labels):
+        """Set gauge ``name`` to ``value``."""
+
+    def observe(self, name, value, **labels):
+        """Add ``value`` to histogram ``name``."""
+
+    def labels(self, **labels):
+        """Return metrics adding ``labels`` to everything emitted."""
+        if not self.enabled:
+            return self
+        return LabelledMetrics(self, labels)
+
+
+class LabelledMetrics(Metrics):
+    """Metrics adding ``labels`` to everything emitted to ``metrics``."""
+    enabled = True
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self._labels = labels
+
+    def increment(self, name, value=1, **labels):
+        self.metrics.increment(name, value, **dict(self._labels, **labels))
+
+    def gauge(self, name, value, **labels):
+        self.metrics.gauge(name, value, **dict(self._labels, **labels))
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **dict(self._labels, **labels))
+
+    def labels(self, **labels):
+        return LabelledMetrics(self.metrics, dict(self._labels, **labels))
+
+
+class InMemoryMetrics(Metrics):
+    """Thread safe metrics kept in memory, see :py:meth:`render`.
+
+    :arg buckets: upper bounds of the histogram buckets, in increasing order.
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (name, sorted label items) -> value, or histogram
+        # [bucket counts, sum, count]
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    [0] * len(self.buckets), 0, 0,
+                ]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get(self, name, **labels):
+        """Return the value of a counter or gauge, ``None`` if unknown.
+
+        Histograms are returned as a ``(count, sum)`` tuple.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2], self._histograms[key][1]
+            return self._counters.get(key, self._gauges.get(key))
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters),
+                                  ('gauge', self._gauges)):
+                for name in sorted(set(name for name, _ in metrics)):
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                    for key in sorted(k for k in metrics if k[0] == name):
+                        lines.append('{0}{1} {2}'.format(
+                            name, format_labels(key[1]), metrics[key]))
+
+            histograms = self._histograms
+            for name in sorted(set(name for name, _ in histograms)):
+                lines.append('# TYPE {0} histogram'.format(name))
+                for key in sorted(k for k in histograms if k[0] == name):
+                    counts, total, count = histograms[key]
+                    cumulative = 0
+                    bounds = [repr(float(b)) for b in self.buckets]
+                    for bound, bucket in zip(bounds + ['+Inf'],
+                                             counts + [count - sum(counts)]):
+                        cumulative += bucket
+                        lines.append('{0}_bucket{1} {2}'.format(
+                            name,
+                            format_labels(key[1] + (('le', bound),)),
+                            cumulative))
+                    labels = format_labels(key[1])
+                    lines.append('{0}_sum{1} {2}'.format(name, labels, total))
+                    lines.append('{0}_count{1} {2}'.format(name, labels,
+                                                           count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Return Prometheus text for a sequence of label ``(name, value)``."""
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+        for name, value in labels))
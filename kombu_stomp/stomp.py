@@ -1,20 +1,701 @@
 from __future__ import absolute_import
 import ast
+import collections
+import errno
+import json
+import logging
+import os
+import threading
+import time
+import zlib
 
 from six.moves import queue
 
 import stomp
+from stomp import backward
+from stomp import constants
+from stomp import exception
 from stomp import listener
+from stomp import utils
+
+from . import metrics as _metrics
+from .utils import monotonic
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+#: Header telling how Kombu dictionaries were encoded as header values. If
+#: missing, they are Python literals (the ``str`` of the dictionary).
+FORMAT_HEADER = 'kombu-format'
+#: Kombu dictionaries are encoded as JSON.
+JSON_FORMAT = '1'
+#: Kombu message keys holding dictionaries.
+DICT_HEADERS = ('properties', 'headers')
+#: Header naming the codec the message body was compressed with.
+COMPRESSION_HEADER = 'kombu-compression'
+#: Header holding the time the message was published, in seconds since the
+#: epoch.
+PUBLISHED_HEADER = 'kombu-published'
+#: Header listing the Kombu message headers also sent as STOMP headers, see
+#: :py:func:`encode_headers`.
+FILTER_HEADER = 'kombu-filter'
+#: Highest message priority, as in JMS.
+MAX_PRIORITY = 9
+#: Supported STOMP versions, from older to newer.
+VERSIONS = ('1.0', '1.1', '1.2')
+#: STOMP headers which aren't part of the Kombu message.
+STOMP_HEADERS = ('destination', 'timestamp', 'message-id', 'expires',
+                 'priority', 'subscription', 'ack', 'content-length',
+                 FORMAT_HEADER, COMPRESSION_HEADER, PUBLISHED_HEADER,
+                 FILTER_HEADER)
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+#: Body compression codecs, name -> (compress, decompress)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'gzip': (_gzip_compress, lambda data: zlib.decompress(data, _GZIP_WBITS)),
+}
+if lz4 is not None:  # pragma: no cover
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+if zstandard is not None:  # pragma: no cover
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def encode_headers(message, filter_headers=(), json_headers=True):
+    """Return the STOMP headers for sending a Kombu message dictionary.
+
+    Dictionaries are encoded as compact JSON, falling back to Python literals
+    if they are not JSON serializable or ``json_headers`` is false. The Kombu
+    ``expiration`` and ``priority`` properties are sent as the ``expires``
+    and ``priority`` STOMP headers too, so brokers like ActiveMQ drop expired
+    messages and serve urgent ones first. Priorities are capped to
+    :py:data:`MAX_PRIORITY`.
+
+    :arg message: Kombu message dictionary, without body.
+    :arg filter_headers: names of Kombu message headers also sent as STOMP
+        headers, so brokers can filter on them, e.g. with JMS selectors.
+        Names clashing with other headers are skipped. They are listed in
+        :py:data:`FILTER_HEADER`, so consumers leave them out.
+    :arg json_headers: whether dictionaries are encoded as JSON, or as
+        Python literals only, which consumers older than JSON headers
+        understand too.
+    :return dict: STOMP headers.
+    """
+    headers = dict(message)
+    keys = [key for key in DICT_HEADERS if key in headers and json_headers]
+    try:
+        for key in keys:
+            headers[key] = json.dumps(headers[key], separators=(',', ':'))
+    except (TypeError, ValueError):
+        headers = dict(message)
+    else:
+        if keys:
+            headers[FORMAT_HEADER] = JSON_FORMAT
+
+    properties = message.get('properties') or {}
+    if properties.get('expiration') is not None:
+        # milliseconds since the epoch
+        headers['expires'] = (int(time.time() * 1000) +
+                              int(properties['expiration']))
+    # Kombu 4+ keeps it in the properties
+    priority = properties.get('priority')
+    if priority is None:
+        priority = (properties.get('delivery_info') or {}).get('priority')
+    if priority is not None:
+        headers['priority'] = min(int(priority), MAX_PRIORITY)
+
+    kombu_headers = message.get('headers') or {}
+    names = [name for name in filter_headers
+             if kombu_headers.get(name) is not None and
+             name not in headers and name not in STOMP_HEADERS]
+    if names:
+        for name in names:
+            headers[name] = kombu_headers[name]
+        headers[FILTER_HEADER] = ','.join(names)
+    return headers
+
+
+def decode_header(value, format=None):
+    """Decode a Kombu dictionary from a STOMP header value.
+
+    :arg value: header value.
+    :arg format: value of the :py:data:`FORMAT_HEADER` header.
+    :return dict: the decoded dictionary.
+    """
+    if format == JSON_FORMAT:
+        return json.loads(value)
+
+    # messages sent by older versions
+    return ast.literal_eval(value)
+
+
+def restore_delivery_properties(properties, headers):
+    """Update Kombu message ``properties`` from the STOMP ``headers``.
+
+    ``expiration`` is set to the milliseconds left until the ``expires``
+    header, so republishing the message keeps its deadline. The
+    ``priority`` header fills the delivery info priority if missing, e.g.
+    for messages published by other clients.
+    """
+    expires = int(headers.get('expires') or 0)
+    if expires:
+        properties['expiration'] = str(
+            max(expires - int(time.time() * 1000), 0))
+    priority = headers.get('priority')
+    if priority is not None:
+        properties.setdefault('delivery_info', {}).setdefault(
+            'priority', int(priority))
+
+
+def compress_body(body, headers, codec, threshold=0):
+    """Compress a message body, if it's at least ``threshold`` bytes long.
+
+    The codec name is added to ``headers`` as :py:data:`COMPRESSION_HEADER`
+    when compressing, so :py:func:`decompress_body` can reverse it.
+
+    :arg codec: one of :py:data:`CODECS`.
+    :return: the body to send.
+    """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    if len(body) < threshold:
+        return body
+
+    try:
+        compress = CODECS[codec][0]
+    except KeyError:
+        raise ValueError('Unsupported compression codec {0!r}'.format(codec))
+    headers[COMPRESSION_HEADER] = codec
+    return compress(body)
+
+
+def decompress_body(body, headers):
+    """Reverse :py:func:`compress_body`.
+
+    :return: the body, as bytes if it was compressed, otherwise untouched.
+    """
+    codec = headers.get(COMPRESSION_HEADER)
+    if codec is None:
+        return body
+
+    try:
+        decompress = CODECS[codec][1]
+    except KeyError:
+        raise ValueError('Unsupported compression codec {0!r}'.format(codec))
+    return decompress(body)
+
+
+#: STOMP 1.1 and 1.2 header escapes, 1.1 doesn't escape carriage returns.
+_ESCAPES = (('\\', '\\\\'), ('\r', '\\r'), ('\n', '\\n'), (':', '\\c'))
+
+
+def escape(value, version):
+    """Escape a header value as required by STOMP ``version``."""
+    if version == '1.0':
+        return value
+
+    for char, escaped in _ESCAPES:
+        if char == '\r' and version == '1.1':
+            continue
+        value = value.replace(char, escaped)
+    return value
+
+
+def unescape(value, version):
+    """Reverse :py:func:`escape`."""
+    if version == '1.0' or '\\' not in value:
+        return value
+
+    chars = []
+    it = iter(value)
+    for char in it:
+        if char == '\\':
+            char = {'\\': '\\', 'r': '\r', 'n': '\n', 'c': ':'}[next(it)]
+        chars.append(char)
+    return ''.join(chars)
+
+
+def encode_frame(command, headers, body=b'', version='1.0'):
+    """Return the bytes of a STOMP frame."""
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+
+    lines = [command]
+    for key, value in headers.items():
+        lines.append('{0}:{1}'.format(escape(str(key), version),
+                                      escape(str(value), version)))
+    if body:
+        lines.append('content-length:{0}'.format(len(body)))
+    preamble = '\n'.join(lines) + '\n\n'
+    return preamble.encode('utf-8') + body + b'\x00'
+
+
+class ReceiveBuffer(object):
+    """Thread safe buffer of received messages, with a FIFO queue per key.
+
+    :py:meth:`get` serves the non empty queues round robin, taking up to
+    ``weights[key]`` items (``1`` by default) from a queue before moving to
+    the next one, so a busy queue can't starve the rest. Picking the next
+    queue doesn't depend on how many there are, and asking for queues with
+    nothing buffered is told apart without going through the others.
+
+    :py:meth:`put` blocks while there are ``maxsize`` messages, or
+    ``maxbytes`` bytes, buffered. It's called from the stomp.py receiver
+    thread, so a full buffer stops reading from the socket and TCP flow
+    control holds the broker back. ``0`` means no limit. Heart-beats aren't
+    read meanwhile either, so it can be given a ``keepalive`` callable for
+    telling the connection it's still alive.
+    """
+    def __init__(self, maxsize=0, maxbytes=0, weights=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.weights = weights or {}
+        #: bytes of the buffered messages
+        self.bytes = 0
+        self.closed = False
+        self._size = 0
+        # key -> deque of (item, size)
+        self._queues = {}
+        # key -> times discarded, so items waiting for room are dropped too
+        self._discarded = {}
+        # keys with items, the first one is being served
+        self._ready = collections.deque()
+        # the same keys, for membership checks
+        self._ready_keys = set()
+        self._served = 0
+        self._cond = threading.Condition()
+
+    def full(self):
+        return bool((self.maxsize and self._size >= self.maxsize) or
+                    (self.maxbytes and self.bytes >= self.maxbytes))
+
+    def put(self, item, size=0, key=None, keepalive=None, interval=None,
+            block=True):
+        """Add ``item``, of ``size`` bytes, waiting for room if full.
+
+        :arg keepalive: callable called every ``interval`` seconds while
+            waiting.
+        :arg block: if false, it's added right away even if full.
+        """
+        with self._cond:
+            discarded = self._discarded.get(key)
+            while block and self.full() and not self.closed:
+                if keepalive is None:
+                    self._cond.wait()
+                else:
+                    keepalive()
+                    self._cond.wait(interval)
+            if self.closed or self._discarded.get(key) != discarded:
+                return
+            items = self._queues.get(key)
+            if not items:
+                items = self._queues[key] = collections.deque()
+                self._ready.append(key)
+                self._ready_keys.add(key)
+            items.append((item, size))
+            self._size += 1
+            self.bytes += size
+            self._cond.notify_all()
+
+    def get(self, block=True, timeout=None, keys=None):
+        """Remove and return the next item.
+
+        :arg keys: only take items from these keys, all by default.
+        :raises: :py:exc:`Queue.Empty` if there is none after ``timeout``
+            seconds, or right away if not ``block``.
+        """
+        if keys is not None and not isinstance(keys, (set, frozenset)):
+            keys = frozenset(keys)
+        with self._cond:
+            if block and timeout is not None:
+                deadline = monotonic() + timeout
+            while not self._select(keys):
+                if not block:
+                    raise queue.Empty()
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise queue.Empty()
+                self._cond.wait(remaining)
+
+            return self._pop()
+
+    def _select(self, keys):
+        """Rotate the first requested key with items to the front."""
+        if keys is None:
+            return bool(self._ready)
+        if keys.isdisjoint(self._ready_keys):
+            return False
+        while self._ready[0] not in keys:
+            self._ready.rotate(-1)
+            self._served = 0
+        return True
+
+    def _pop(self):
+        key = self._ready[0]
+        items = self._queues[key]
+        item, size = items.popleft()
+        self._size -= 1
+        self.bytes -= size
+        self._served += 1
+        if not items:
+            del self._queues[key]
+            self._ready.popleft()
+            self._ready_keys.discard(key)
+            self._served = 0
+        elif self._served >= self.weights.get(key, 1):
+            self._ready.rotate(-1)
+            self._served = 0
+        self._cond.notify_all()
+        return item
+
+    def get_nowait(self, keys=None):
+        return self.get(block=False, keys=keys)
+
+    def qsize(self, keys=None):
+        """Return the number of buffered items, only from ``keys`` if given.
+        """
+        if keys is None:
+            return self._size
+        with self._cond:
+            return sum(len(self._queues.get(key, ())) for key in keys)
+
+    def discard(self, key):
+        """Drop the buffered items of ``key``, and the ones waiting for room.
+        """
+        with self._cond:
+            self._discarded[key] = self._discarded.get(key, 0) + 1
+            items = self._queues.pop(key, None)
+            if items:
+                if self._ready[0] == key:
+                    self._served = 0
+                self._ready.remove(key)
+                self._ready_keys.discard(key)
+                self._size -= len(items)
+                self.bytes -= sum(size for _, size in items)
+            self._cond.notify_all()
+
+    def close(self):
+        """Drop the buffered items and stop waiting for room."""
+        with self._cond:
+            self.closed = True
+            self._queues.clear()
+            self._ready.clear()
+            self._ready_keys.clear()
+            self._size = self.bytes = 0
+            self._cond.notify_all()
+
+
+class DecodePool(object):
+    """Bounded pool of threads decoding received messages.
+
+    Frames submitted with the same key are handed to ``deliver`` in the
+    order they were submitted, whatever thread decoded them first, so
+    messages from a queue keep their order. :py:meth:`submit` blocks while
+    ``maxsize`` frames are waiting to be decoded, so a slow consumer holds
+    the receiver thread back, like a full :py:class:`ReceiveBuffer` does,
+    calling :py:attr:`keepalive` every :py:attr:`keepalive_interval` seconds
+    if set.
+
+    :arg deliver: callable receiving every decoded result, called by one
+        thread at a time.
+    :arg workers: number of decoding threads.
+    :arg maxsize: frames waiting to be decoded, ``workers * 4`` by default.
+    """
+    def __init__(self, deliver, workers, maxsize=0):
+        self.deliver = deliver
+        self.closed = False
+        #: callable called while :py:meth:`submit` waits, see
+        #: :py:meth:`MessageListener.set_keepalive`
+        self.keepalive = None
+        self.keepalive_interval = None
+        self._tasks = queue.Queue(maxsize or workers * 4)
+        self._lock = threading.Lock()
+        self._deliver_lock = threading.Lock()
+        # key -> deque of [result, done] in submission order
+        self._pending = {}
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Decode by calling ``func(*args, **kwargs)`` in a pool thread."""
+        if self.closed:
+            return
+
+        # result, whether it's done, whether it's discarded
+        slot = [None, False, False]
+        with self._lock:
+            self._pending.setdefault(key, collections.deque()).append(slot)
+        task = (key, slot, func, args, kwargs)
+        if self.keepalive is None:
+            self._tasks.put(task)
+            return
+        while not self.closed:
+            try:
+                self._tasks.put(task, timeout=self.keepalive_interval)
+                return
+            except queue.Full:
+                self.keepalive()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            if self.closed:
+                continue
+
+            key, slot, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception:  # noqa: B902, the pool must keep running
+                logger.exception('Failed decoding message')
+                result = None
+            with self._lock:
+                slot[:2] = [result, True]
+            self._release(key)
+
+    def _release(self, key):
+        """Deliver the leading decoded results of ``key``."""
+        with self._deliver_lock:
+            while True:
+                with self._lock:
+                    pending = self._pending.get(key)
+                    if not pending or not pending[0][1]:
+                        return
+                    result, _, discarded = pending.popleft()
+                    if not pending:
+                        del self._pending[key]
+                if result is not None and not discarded and not self.closed:
+                    self.deliver(result)
+
+    def discard(self, key):
+        """Drop the frames of ``key`` not delivered yet."""
+        with self._lock:
+            for slot in self._pending.get(key, ()):
+                slot[2] = True
+
+    def close(self):
+        """Drop the frames not decoded yet and stop the threads."""
+        self.closed = True
+        for _ in self._threads:
+            self._tasks.put(None)
+        with self._lock:
+            self._pending.clear()
+
+
+class Waker(object):
+    """Self-pipe used for waking up an event loop from other threads.
+
+    The read end of the pipe can be registered with an event loop (e.g. the
+    Kombu hub), so it becomes readable whenever :py:meth:`wake` is called.
+    Without one, :py:meth:`wait` blocks until then.
+    """
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        if fcntl is not None:
+            for fd in (self._read_fd, self._write_fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._signaled = False
+        self._closed = False
+        # receiver threads may wake us up while draining or closing
+        self._lock = threading.Lock()
+        # set along with the pipe, see wait()
+        self._event = threading.Event()
+
+    def fileno(self):
+        """Return the file descriptor becoming readable on wake up."""
+        return self._read_fd
+
+    def wake(self):
+        """Make the file descriptor readable.
+
+        Only the first call after :py:meth:`drain` writes to the pipe, so
+        bursts of messages don't cost a system call each. It does nothing
+        once closed.
+        """
+        if self._signaled:
+            return
+
+        with self._lock:
+            if self._signaled or self._closed:
+                return
+
+            self._signaled = True
+            self._event.set()
+            try:
+                os.write(self._write_fd, b'x')
+            except OSError as e:
+                # pipe is full, so it's already readable
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def drain(self):
+        """Consume pending wake ups, so the file descriptor is not readable.
+
+        It must be called before consuming the events we were woken up for,
+        otherwise we could miss wake ups.
+        """
+        with self._lock:
+            if self._closed:
+                return
+
+            self._event.clear()
+            try:
+                while os.read(self._read_fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            self._signaled = False
+
+    def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds for a wake up since
+        :py:meth:`drain`.
+
+        :return: whether it was woken up.
+        """
+        return self._event.wait(timeout)
+
+    def close(self):
+        # receiver threads may still be running, so wake is a no-op from
+        # now on, and the file descriptors can't be reused under it
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = self._signaled = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
 
 
 class MessageListener(listener.ConnectionListener):
-    """stomp.py listener used by ``kombu-stomp``"""
-    def __init__(self, prefix='', q=None):
+    """stomp.py listener used by ``kombu-stomp``
+
+    :arg version: STOMP version of the connection, updated to the version
+        accepted by the broker when connecting.
+    :arg metrics: :py:class:`kombu_stomp.metrics.Metrics` receiving the
+        received frames, decoding time and buffer size.
+    :arg decode_workers: if given, messages are decoded by a
+        :py:class:`DecodePool` of that many threads, so the receiver thread
+        only hands frames over, otherwise they are decoded as received.
+    """
+    def __init__(self, prefix='', q=None, waker=None, version='1.0',
+                 metrics=None, decode_workers=0):
         if not q:
-            q = queue.Queue()
+            q = ReceiveBuffer()
 
         self.q = q
         self.prefix = prefix
+        self.waker = waker
+        self.version = version
+        self.metrics = metrics or _metrics.Metrics()
+        # (host, port) of the broker we are connected to
+        self.broker = None
+        self.decoder = None
+        if decode_workers:
+            self.decoder = DecodePool(self.deliver, decode_workers)
+        #: callable telling the connection it's alive while waiting for room
+        #: in the buffer, see :py:meth:`set_keepalive`
+        self.keepalive = None
+        self.keepalive_interval = None
+        #: whether :py:meth:`deliver` waits for room in the buffer, rather
+        #: than buffering beyond its limits, see :py:meth:`route`
+        self.block = True
+        #: subscription ID -> listener its messages are handed over to, when
+        #: channels share the connection (see :py:meth:`route`), ``None``
+        #: otherwise
+        self.routes = None
+        # subscription ID -> receipt ending the discarding of its messages,
+        # see discard()
+        self._discarding = {}
+        #: connection settling the messages that can't be decoded, and the
+        #: ack mode of its subscriptions by ID, see :py:meth:`drop`
+        self.conn = None
+        self.ack_modes = {}
+
+    def on_connecting(self, host_and_port):
+        self.broker = host_and_port
+
+    def on_connected(self, headers, body):
+        # brokers only speaking STOMP 1.0 don't send the version header
+        self.version = headers.get('version', '1.0')
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_received_total',
+                                   command='CONNECTED')
+
+    def on_receipt(self, headers, body):
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_received_total',
+                                   command='RECEIPT')
+        receipt = headers.get('receipt-id')
+        self.receipt(receipt)
+        if self.routes is not None:
+            for owner in list(self.routes.values()):
+                owner.receipt(receipt)
+
+    def receipt(self, receipt):
+        """Handle the RECEIPT frame ``receipt``, see :py:meth:`discard`."""
+        for subscription, pending in list(self._discarding.items()):
+            if pending == receipt:
+                self._discarding.pop(subscription, None)
+
+    def discard(self, subscription, queue, receipt):
+        """Drop the messages of ``subscription``, until the RECEIPT frame
+        ``receipt`` arrives.
+
+        It's called before unsubscribing with that receipt, since the broker
+        redelivers the unacked messages it pushed through the subscription:
+        the ones buffered for ``queue``, being decoded, and on their way.
+        """
+        self._discarding[subscription] = receipt
+        if self.decoder is not None:
+            self.decoder.discard(subscription)
+        self.q.discard(queue)
+
+    def on_error(self, headers, body):
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_received_total',
+                                   command='ERROR')
+
+    def on_disconnected(self):
+        # wake up the event loop, so the connection is restored
+        if self.waker is not None:
+            self.waker.wake()
+
+    on_heartbeat_timeout = on_disconnected
 
     def on_message(self, headers, body):
         """Received message hook.
@@ -22,55 +703,458 @@ class MessageListener(listener.ConnectionListener):
         :arg headers: message headers.
         :arg body: message body.
         """
-        self.q.put(self.to_kombu_message(headers, body))
+        if self.routes is not None:
+            owner = self.routes.get(headers.get('subscription'))
+            # otherwise unsubscribed, the broker redelivers it if unacked
+            if owner is not None:
+                owner.on_message(headers, body)
+            return
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_received_total',
+                                   command='MESSAGE')
+        subscription = headers.get('subscription')
+        if subscription in self._discarding:
+            # pushed before unsubscribing, the broker redelivers it
+            return
+        if self.decoder is None:
+            self.deliver(self.decode(headers, body))
+        else:
+            # kept in order by subscription, so by queue
+            self.decoder.submit(subscription or headers['destination'],
+                                self.decode,
+                                headers,
+                                body,
+                                received_at=time.time())
+
+    def decode(self, headers, body, **kwargs):
+        """Return a received message as buffered, along with its size, or
+        ``None`` if it can't be decoded, after logging it and settling it
+        with :py:meth:`drop`.
+
+        Keyword arguments are given to :py:meth:`to_kombu_message`.
+        """
+        metrics = self.metrics
+        if metrics.enabled:
+            start = monotonic()
+        try:
+            item = self.to_kombu_message(headers, body, **kwargs)
+        except Exception:  # noqa: B902, receiving must go on
+            logger.exception('Failed decoding message')
+            self.drop(headers)
+            return None
+        size = len(body or '')
+        if metrics.enabled:
+            metrics.observe('kombu_stomp_decode_seconds', monotonic() - start)
+            metrics.increment('kombu_stomp_received_bytes_total', size,
+                              queue=item[1])
+        return item, size
+
+    def deliver(self, decoded):
+        """Buffer a message returned by :py:meth:`decode`."""
+        if decoded is None:
+            return
+        item, size = decoded
+        # buffered by queue name
+        self.q.put(item, size, item[1],
+                   keepalive=self.keepalive,
+                   interval=self.keepalive_interval,
+                   block=self.block)
+        if self.metrics.enabled:
+            self.report_buffer()
+        if self.waker is not None:
+            self.waker.wake()
+
+    def drop(self, headers):
+        """Acknowledge the received message with ``headers`` without
+        delivering it, so it doesn't hold a prefetch slot until reconnecting.
+
+        It isn't NACKed, the broker would redeliver it. Messages of
+        ``client`` subscriptions are acknowledged by the next cumulative ACK
+        instead, and ``auto`` ones need nothing.
+        """
+        subscription = headers.get('subscription')
+        if (self.conn is not None and
+                self.ack_modes.get(subscription) == 'client-individual'):
+            self.conn.ack(self.ack_id(headers))
+
+    def route(self, subscription, listener):
+        """Hand the messages received for ``subscription`` over to
+        ``listener``, e.g. the one of a channel sharing the connection.
+
+        Messages of subscriptions not routed are dropped from then on.
+
+        ``listener`` buffers them beyond its limits rather than waiting for
+        room, since that would hold back the messages of every listener. The
+        broker must limit them instead, e.g. with a prefetch size.
+        """
+        if self.routes is None:
+            self.routes = {}
+        listener.block = False
+        listener.version = self.version
+        listener.broker = self.broker
+        listener.set_keepalive(self.keepalive, self.keepalive_interval)
+        listener.conn = self.conn
+        listener.ack_modes = self.ack_modes
+        self.routes[subscription] = listener
+
+    def set_keepalive(self, keepalive, interval):
+        """Call ``keepalive`` every ``interval`` seconds while the receiver
+        thread waits for room in the buffer, or for the decoding threads.
+
+        The receiver thread doesn't read heart-beats meanwhile, so it's used
+        for refreshing the time the last one was received. Otherwise a slow
+        consumer makes the connection time out, and its unacked messages are
+        redelivered into the same full buffer after reconnecting.
+        """
+        self.keepalive = keepalive
+        self.keepalive_interval = interval
+        if self.decoder is not None:
+            self.decoder.keepalive = keepalive
+            self.decoder.keepalive_interval = interval
+
+    def report_buffer(self):
+        """Emit the receive buffer size gauges."""
+        self.metrics.gauge('kombu_stomp_receive_buffer_messages', self.qsize())
+        self.metrics.gauge('kombu_stomp_receive_buffer_bytes',
+                           self.buffered_bytes())
+
+    def qsize(self, queues=None):
+        """Return the number of received messages waiting to be consumed.
+
+        :arg queues: only count messages from these queues.
+        """
+        return self.q.qsize(queues)
 
-    def to_kombu_message(self, headers, body):
+    def buffered_bytes(self):
+        """Return the body bytes of the messages waiting to be consumed."""
+        return self.q.bytes
+
+    def close(self):
+        """Drop the messages waiting to be consumed.
+
+        It also releases the receiver thread if it's waiting for room, and
+        stops the decoding threads.
+        """
+        self.q.close()
+        if self.decoder is not None:
+            self.decoder.close()
+
+    def to_kombu_message(self, headers, body, received_at=None):
         """Get STOMP headers and body message and return a Kombu message dict.
 
         :arg headers: message headers.
         :arg body: message body.
+        :arg received_at: time the message was received, now by default.
         :return dict: A dictionary that Kombu can use for creating a new
-            message object.
+            message object, along with its trace (see :py:meth:`trace`).
         """
-        msg_id = headers['message-id']
+        trace = self.trace(headers, received_at)
+        msg_id = self.ack_id(headers)
+        # already in the Kombu headers, see encode_headers
+        copies = headers.get(FILTER_HEADER, '').split(',')
         message = dict(
             [(header, value) for header, value in headers.items()
              # Remove STOMP specific headers
-             if header not in ('destination',
-                               'timestamp',
-                               'message-id',
-                               'expires',
-                               'priority')]
-        )
-        # properties is a dictionary and we need evaluate it
-        message['properties'] = ast.literal_eval(message['properties'])
-        message['body'] = body
-        return (
-            (message, msg_id),
-            self.queue_from_destination(headers['destination']),
+             if header not in STOMP_HEADERS and header not in copies]
         )
+        # properties and headers are dictionaries and we need decode them
+        format = headers.get(FORMAT_HEADER)
+        for key in DICT_HEADERS:
+            if key in message:
+                message[key] = decode_header(message[key], format)
+        if 'properties' in message:
+            restore_delivery_properties(message['properties'], headers)
+        # handed over as received, Kombu decodes them as needed
+        message['body'] = decompress_body(body, headers)
+        # subscription IDs are queue destinations, unlike the destination of
+        # messages from topics
+        queue = self.queue_from_destination(
+            headers.get('subscription', headers['destination']))
+        return (message, msg_id, queue, trace), queue
+
+    def trace(self, headers, received_at=None):
+        """Return the timings of a message received at ``received_at``, or
+        just received.
+
+        :return dict: the time it was published, timestamped by the broker
+            and received, in seconds since the epoch, and the ``broker``
+            ``(host, port)``. Times missing from the headers are ``None``.
+        """
+        published_at = headers.get(PUBLISHED_HEADER)
+        broker_timestamp = headers.get('timestamp')
+        return {
+            'published_at': (float(published_at)
+                             if published_at is not None else None),
+            # milliseconds, e.g. ActiveMQ or Artemis
+            'broker_timestamp': (int(broker_timestamp) / 1000.0
+                                 if broker_timestamp else None),
+            'received_at': received_at or time.time(),
+            'broker': self.broker,
+        }
 
-    def iterator(self):
+    def ack_id(self, headers):
+        """Return the ID for acknowledging a message.
+
+        It's the ``message-id`` header on STOMP 1.0, a tuple of ``message-id``
+        and ``subscription`` headers on STOMP 1.1, and the ``ack`` header on
+        STOMP 1.2.
+        """
+        if self.version == '1.1':
+            return headers['message-id'], headers['subscription']
+        if self.version == '1.2' and 'ack' in headers:
+            return headers['ack']
+        return headers['message-id']
+
+    def iterator(self, timeout=None, queues=None):
         """Return a Python generator consuming received messages.
 
         If we try to consume a message and there is no messages remaining, then
-        an exception will be raised.
+        we wait up to ``timeout`` seconds for the receiver thread to deliver
+        one, and an exception will be raised if none arrives in time. Waiting
+        is done on the queue condition, so we wake up as soon as a message is
+        put, instead of polling.
 
+        :arg timeout: seconds to wait for a message, ``None`` or ``0`` means
+            do not wait at all.
+        :arg queues: only consume messages from these queues, taking turns
+            between them (see :py:class:`ReceiveBuffer`).
         :yields dict: A dictionary representing the message in a Kombu
             compatible format.
         :raises: :py:exc:`Queue.Empty` When there is no message to be consumed.
         """
         while True:
-            yield self.q.get_nowait()
+            if timeout:
+                yield self.q.get(timeout=timeout, keys=queues)
+            else:
+                yield self.q.get_nowait(keys=queues)
 
     def queue_from_destination(self, destination):
         """Get the queue name from a destination header value."""
         return destination.split('/queue/{0}'.format(self.prefix))[1]
 
 
-class Connection(stomp.Connection10):
-    """Connection object used by ``kombu-stomp``"""
-    def __init__(self, prefix='', *args, **kwargs):
-        super(Connection, self).__init__(*args, **kwargs)
-        self.message_listener = MessageListener(prefix=prefix)
+class VersionMismatch(exception.ConnectFailedException):
+    """The broker accepted an older STOMP version than the connection's.
+
+    :arg version: version accepted by the broker.
+    """
+    def __init__(self, version):
+        super(VersionMismatch, self).__init__(version)
+        self.version = version
+
+
+class ConnectionMixin(object):
+    """Behaviour shared by the ``kombu-stomp`` connections of every version.
+
+    Message bodies are received as bytes, since they can be binary, and
+    given to Kombu as they are.
+
+    It can buffer SEND frames and write them at once (see
+    :py:meth:`begin_batch`), so publishing many messages doesn't cost a
+    system call each.
+
+    Received messages are buffered until consumed, up to ``buffer_size``
+    messages and ``buffer_bytes`` bytes, and consumed from every queue in
+    turn, taking ``queue_weights[queue]`` messages at a time (see
+    :py:class:`ReceiveBuffer`).
+
+    Frames sent and received are reported to ``metrics``, a
+    :py:class:`kombu_stomp.metrics.Metrics` instance.
+
+    Received messages are decoded by the receiver thread, or by
+    ``decode_workers`` threads if given (see :py:class:`DecodePool`).
+
+    When connecting, the broker is offered every version up to the
+    connection's one. If it picks an older one, :py:exc:`VersionMismatch` is
+    raised after disconnecting, so a connection for that version can be used
+    instead.
+    """
+    def __init__(self, prefix='', waker=None, buffer_size=0, buffer_bytes=0,
+                 queue_weights=None, metrics=None, decode_workers=0,
+                 *args, **kwargs):
+        kwargs.setdefault('auto_decode', False)
+        super(ConnectionMixin, self).__init__(*args, **kwargs)
+        self.metrics = metrics or _metrics.Metrics()
+        self.message_listener = MessageListener(
+            prefix=prefix,
+            q=ReceiveBuffer(buffer_size, buffer_bytes, queue_weights),
+            waker=waker,
+            version=self.version,
+            metrics=self.metrics,
+            decode_workers=decode_workers,
+        )
+        self.message_listener.conn = self
         self.set_listener('message_listener', self.message_listener)
+        heartbeats = kwargs.get('heartbeats')
+        if heartbeats and heartbeats[1]:
+            # on_heartbeat() refreshes the time of the last heart-beat read
+            self.message_listener.set_keepalive(self.on_heartbeat,
+                                                heartbeats[1] / 2000.0)
+        self._batch = None
+        self._batch_lock = threading.RLock()
+        self._batch_timer = None
+        # failure of the timer writing the buffered frames, see send_frame()
+        self._batch_error = None
+
+    @property
+    def batching(self):
+        return self._batch is not None
+
+    def begin_batch(self, max_frames=None, max_bytes=None, interval=None):
+        """Start buffering SEND frames.
+
+        Buffered frames are written with a single socket write when
+        ``max_frames`` or ``max_bytes`` are reached, ``interval`` seconds
+        after the first frame was buffered, before sending any other kind of
+        frame (so frames are never reordered), or when :py:meth:`flush` or
+        :py:meth:`end_batch` are called.
+        """
+        with self._batch_lock:
+            self._batch = []
+            self._batch_frames = 0
+            self._batch_bytes = 0
+            self._batch_limits = (max_frames, max_bytes, interval)
+
+    def end_batch(self):
+        """Write the buffered frames and stop buffering."""
+        with self._batch_lock:
+            try:
+                self.flush()
+            finally:
+                self._batch = None
+
+    def flush(self):
+        """Write the buffered frames.
+
+        They stay buffered if writing fails, and so does the failure of
+        writing them after ``interval`` seconds, which is raised by the next
+        call to :py:meth:`send_frame`, :py:meth:`flush` or
+        :py:meth:`end_batch` instead.
+        """
+        with self._batch_lock:
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            error, self._batch_error = self._batch_error, None
+            if error is not None:
+                raise error
+            if not self._batch:
+                return
+
+            self.transport.send(backward.pack(self._batch))
+            del self._batch[:]
+            self._batch_frames = self._batch_bytes = 0
+
+    def _flush_later(self):
+        with self._batch_lock:
+            try:
+                self.flush()
+            except Exception as e:  # noqa: B902, raised by the next send
+                # nobody would notice it in the timer thread
+                self._batch_error = e
+
+    def connect(self, *args, **kwargs):
+        super(ConnectionMixin, self).connect(*args, **kwargs)
+        version = self.message_listener.version
+        if kwargs.get('wait') and version != self.version:
+            self.disconnect()
+            raise VersionMismatch(version)
+
+    def subscribe(self, destination, id=None, ack='auto', headers=None,
+                  **keyword_headers):
+        # see MessageListener.drop
+        self.message_listener.ack_modes[id] = ack
+        return super(ConnectionMixin, self).subscribe(destination,
+                                                      id,
+                                                      ack,
+                                                      headers,
+                                                      **keyword_headers)
+
+    def send_frame(self, cmd, headers=None, body=''):
+        if cmd in (constants.CMD_CONNECT, constants.CMD_STOMP):
+            headers[constants.HDR_ACCEPT_VERSION] = ','.join(
+                v for v in VERSIONS if v <= self.version)
+            # STOMP 1.0 brokers don't know the STOMP frame
+            cmd = constants.CMD_CONNECT
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_frames_sent_total',
+                                   command=cmd)
+
+        with self._batch_lock:
+            if self._batch_error is not None:
+                self.flush()
+            if self._batch is None:
+                return super(ConnectionMixin, self).send_frame(cmd,
+                                                               headers,
+                                                               body)
+
+            if cmd != constants.CMD_SEND:
+                self.flush()
+                return super(ConnectionMixin, self).send_frame(cmd,
+                                                               headers,
+                                                               body)
+
+            if self.version != '1.0':
+                self._escape_headers(headers)
+            lines = utils.convert_frame(utils.Frame(cmd, headers, body))
+            self._batch.extend(lines)
+            self._batch_frames += 1
+            self._batch_bytes += sum(len(line) for line in lines)
+
+            max_frames, max_bytes, interval = self._batch_limits
+            if ((max_frames and self._batch_frames >= max_frames) or
+                    (max_bytes and self._batch_bytes >= max_bytes)):
+                self.flush()
+            elif interval and self._batch_timer is None:
+                self._batch_timer = threading.Timer(interval,
+                                                    self._flush_later)
+                self._batch_timer.daemon = True
+                self._batch_timer.start()
+
+
+class Connection10(ConnectionMixin, stomp.Connection10):
+    """STOMP 1.0 connection."""
+
+
+class Connection11(ConnectionMixin, stomp.Connection11):
+    """STOMP 1.1 connection.
+
+    Messages are acknowledged by a tuple of message ID and subscription, see
+    :py:meth:`MessageListener.ack_id`.
+    """
+    def ack(self, id, subscription=None, transaction=None, receipt=None):
+        if subscription is None:
+            id, subscription = id
+        super(Connection11, self).ack(id, subscription, transaction, receipt)
+
+    def nack(self, id, subscription=None, transaction=None, receipt=None):
+        if subscription is None:
+            id, subscription = id
+        super(Connection11, self).nack(id, subscription, transaction, receipt)
+
+
+class Connection12(ConnectionMixin, stomp.Connection12):
+    """STOMP 1.2 connection."""
+
+
+CONNECTIONS = {
+    '1.0': Connection10,
+    '1.1': Connection11,
+    '1.2': Connection12,
+}
+
+
+class Connection(object):
+    """Connection object used by ``kombu-stomp``.
+
+    Creating it returns the connection class for STOMP ``version`` instead,
+    see :py:data:`CONNECTIONS`.
+
+    :arg heartbeats: tuple of milliseconds between heart-beats sent and
+        expected from the broker, ``0`` for none. Ignored on STOMP 1.0.
+    """
+    def __new__(cls, prefix='', waker=None, version='1.0',
+                heartbeats=(0, 0), **kwargs):
+        if version != '1.0':
+            kwargs['heartbeats'] = heartbeats
+        return CONNECTIONS[version](prefix, waker, **kwargs)
@@ -0,0 +1,664 @@
+"""In-process STOMP broker for tests and benchmarks.
+
+:py:class:`Broker` speaks enough STOMP 1.0, 1.1 and 1.2 over loopback for
+exercising ``kombu-stomp`` without a real ActiveMQ, e.g.::
+
+    with testing.Broker() as broker:
+        conn = kombu.Connection('stomp://127.0.0.1:{0}'.format(broker.port))
+
+It is not meant to be fast or complete, just predictable.
+"""
+from __future__ import absolute_import
+import collections
+import itertools
+import re
+import socket
+import threading
+import time
+
+from .stomp import encode_frame
+from .stomp import escape  # noqa, part of the API
+from .stomp import unescape
+
+VERSIONS = ('1.0', '1.1', '1.2')
+
+Frame = collections.namedtuple('Frame', 'command headers body size')
+
+_PREAMBLE_END = re.compile(b'\r?\n\r?\n')
+
+
+class FrameParser(object):
+    """Incremental STOMP frame parser.
+
+    Feed it bytes with :py:meth:`feed` and it returns the complete
+    :py:class:`Frame` objects received so far.
+    """
+    def __init__(self, version='1.0'):
+        self.version = version
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _next_frame(self):
+        # heart-beats and optional EOLs between frames
+        buf = self.buffer.lstrip(b'\r\n')
+        self.buffer = buf
+        match = _PREAMBLE_END.search(buf)
+        if match is None:
+            return None
+
+        end = match.start()
+        lines = buf[:end].decode('utf-8').replace('\r', '').split('\n')
+        command, headers = lines[0], {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            key = unescape(key, self.version)
+            # first header wins, as per the spec
+            headers.setdefault(key, unescape(value, self.version))
+
+        start = match.end()
+        if 'content-length' in headers:
+            stop = start + int(headers['content-length'])
+            if len(buf) < stop + 1:
+                return None
+        else:
+            stop = buf.find(b'\x00', start)
+            if stop < 0:
+                return None
+
+        body = buf[start:stop]
+        self.buffer = buf[stop + 1:]
+        return Frame(command, headers, body, stop + 1)
+
+
+_SELECTOR_TOKEN = re.compile(
+    r"\s*(?:(<>|<=|>=|[=<>(),])|'((?:[^']|'')*)'|(-?\d+(?:\.\d*)?)|"
+    r"([A-Za-z_$][\w$.]*))"
+)
+_COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class Selector(object):
+    """JMS message selector, as given in the ``selector`` SUBSCRIBE header.
+
+    It knows comparisons of headers to string and number literals, ``IN``,
+    ``IS NULL``, ``AND``, ``OR``, ``NOT`` and parentheses. Headers are
+    compared as numbers to number literals. Comparing missing headers is
+    false, instead of unknown.
+    """
+    def __init__(self, text):
+        self.text = text
+        self._tokens = self._tokenize(text)
+        self._match = self._or()
+        if self._tokens:
+            raise ValueError('Invalid selector {0!r}'.format(text))
+
+    def __call__(self, headers):
+        return self._match(headers)
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = []
+        text = text.rstrip()
+        pos = 0
+        while pos < len(text):
+            match = _SELECTOR_TOKEN.match(text, pos)
+            if match is None:
+                raise ValueError('Invalid selector {0!r}'.format(text))
+            op, string, number, name = match.groups()
+            if string is not None:
+                tokens.append(('literal', string.replace("''", "'")))
+            elif number is not None:
+                tokens.append(('literal', float(number)))
+            elif name is not None and name.upper() in (
+                    'AND', 'OR', 'NOT', 'IS', 'NULL', 'IN'):
+                tokens.append((name.upper(), None))
+            elif name is not None:
+                tokens.append(('name', name))
+            else:
+                tokens.append((op, None))
+            pos = match.end()
+        return tokens
+
+    def _accept(self, kind):
+        if self._tokens and self._tokens[0][0] == kind:
+            return self._tokens.pop(0)[1] or True
+        return None
+
+    def _expect(self, kind):
+        value = self._accept(kind)
+        if value is None:
+            raise ValueError('Invalid selector {0!r}'.format(self.text))
+        return value
+
+    def _or(self):
+        terms = [self._and()]
+        while self._accept('OR'):
+            terms.append(self._and())
+        return lambda headers: any(term(headers) for term in terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._accept('AND'):
+            terms.append(self._not())
+        return lambda headers: all(term(headers) for term in terms)
+
+    def _not(self):
+        if self._accept('NOT'):
+            term = self._not()
+            return lambda headers: not term(headers)
+        if self._accept('('):
+            term = self._or()
+            self._expect(')')
+            return term
+        return self._comparison()
+
+    def _comparison(self):
+        name = self._expect('name')
+        if self._accept('IS'):
+            negate = bool(self._accept('NOT'))
+            self._expect('NULL')
+            return lambda headers: (headers.get(name) is None) != negate
+
+        negate = bool(self._accept('NOT'))
+        if self._accept('IN'):
+            self._expect('(')
+            values = [self._expect('literal')]
+            while self._accept(','):
+                values.append(self._expect('literal'))
+            self._expect(')')
+            return lambda headers: (
+                any(self._compare(headers.get(name), '=', value)
+                    for value in values) != negate)
+
+        op = next((op for op in _COMPARISONS if self._accept(op)), None)
+        if op is None or negate:
+            raise ValueError('Invalid selector {0!r}'.format(self.text))
+        value = self._expect('literal')
+        return lambda headers: self._compare(headers.get(name), op, value)
+
+    @staticmethod
+    def _compare(header, op, value):
+        if header is None:
+            return False
+        if isinstance(value, float):
+            try:
+                header = float(header)
+            except ValueError:
+                return False
+        return _COMPARISONS[op](header, value)
+
+
+def topic_matches(pattern, topic):
+    """Whether a ``topic`` name matches ``pattern``, with the ActiveMQ
+    wildcards: ``*`` for any word and ``>`` for any trailing words.
+    """
+    words = topic.split('.')
+    pattern = pattern.split('.')
+    for i, word in enumerate(pattern):
+        if word == '>':
+            return True
+        if i >= len(words) or word not in ('*', words[i]):
+            return False
+    return len(pattern) == len(words)
+
+
+class Subscription(object):
+    """A client subscription to a broker destination."""
+    def __init__(self, session, id, destination, ack, headers):
+        self.session = session
+        self.id = id
+        self.destination = destination
+        self.ack = ack
+        self.headers = headers
+        self.selector = None
+        if headers.get('selector'):
+            self.selector = Selector(headers['selector'])
+        # message-id -> (headers, body), in delivery order
+        self.unacked = collections.OrderedDict()
+
+    @property
+    def prefetch(self):
+        return int(self.headers.get('activemq.prefetchSize', 0))
+
+    def can_receive(self):
+        if self.prefetch and len(self.unacked) >= self.prefetch:
+            return False
+        return self.session.running
+
+    def matches(self, headers):
+        return self.selector is None or self.selector(headers)
+
+
+class Session(object):
+    """Server side of a client connection."""
+    TRANSACTIONAL = ('SEND', 'ACK', 'NACK')
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.version = '1.0'
+        self.parser = FrameParser()
+        self.running = True
+        self.subscriptions = {}
+        # transaction ID -> frames deferred until COMMIT
+        self.transactions = {}
+        self._send_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def send_frame(self, command, headers, body=b''):
+        data = encode_frame(command, headers, body, self.version)
+        self.send_data(data)
+
+    def send_data(self, data):
+        with self._send_lock:
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                self.running = False
+                return
+        self.broker.stats['bytes_out'] += len(data)
+
+    def start_heartbeats(self, interval):
+        """Send a heart-beat every ``interval`` seconds while running."""
+        def run():
+            while self.running:
+                time.sleep(interval)
+                self.send_data(b'\n')
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        try:
+            while self.running:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.error:
+                    data = b''
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            self.close()
+
+    def feed(self, data):
+        """Handle the frames in ``data``, as received from the client."""
+        self.broker.stats['bytes_in'] += len(data)
+        for command, headers, body, size in self.parser.feed(data):
+            self.broker.stats[command] += 1
+            self.broker.stats[command + '_bytes'] += size
+            handler = getattr(self, 'on_' + command.lower(), None)
+            if handler is None:
+                self.error('Unknown command {0}'.format(command))
+                continue
+            if command in self.TRANSACTIONAL and 'transaction' in headers:
+                self.defer(handler, headers, body)
+            else:
+                handler(headers, body)
+            if 'receipt' in headers:
+                self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+
+    def close(self):
+        self.running = False
+        self.transactions.clear()
+        self.broker.remove_session(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def error(self, message):
+        self.send_frame('ERROR', {'message': message})
+
+    def on_connect(self, headers, body):
+        accepted = headers.get('accept-version', '1.0').split(',')
+        versions = [v for v in self.broker.versions if v in accepted]
+        if not versions:
+            self.error('Supported protocol versions are {0}'.format(
+                ' '.join(self.broker.versions)))
+            self.running = False
+            return
+
+        self.version = self.parser.version = versions[-1]
+        reply = {'session': id(self), 'server': 'kombu-stomp-testing'}
+        if self.version != '1.0':
+            reply['version'] = self.version
+            reply['heart-beat'] = '{0},{1}'.format(*self.broker.heartbeats)
+        self.send_frame('CONNECTED', reply)
+        if (self.version != '1.0' and self.broker.send_heartbeats and
+                self.broker.heartbeats[0]):
+            self.start_heartbeats(self.broker.heartbeats[0] / 1000.0)
+
+    on_stomp = on_connect
+
+    def on_disconnect(self, headers, body):
+        if 'receipt' in headers:
+            self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+            headers.pop('receipt')
+        self.running = False
+
+    def on_send(self, headers, body):
+        self.broker.publish(headers, body)
+
+    def on_subscribe(self, headers, body):
+        destination = headers['destination']
+        sub_id = headers.get('id', destination)
+        try:
+            sub = Subscription(self, sub_id, destination,
+                               headers.get('ack', 'auto'), headers)
+        except ValueError as e:
+            self.error(str(e))
+            return
+        self.subscriptions[sub_id] = sub
+        self.broker.subscribe(sub)
+
+    def on_unsubscribe(self, headers, body):
+        sub_id = headers.get('id', headers.get('destination'))
+        sub = self.subscriptions.pop(sub_id, None)
+        if sub is not None:
+            self.broker.unsubscribe(sub)
+
+    def on_ack(self, headers, body):
+        msg_id = headers.get('id' if self.version == '1.2' else 'message-id')
+        self.broker.ack(self, msg_id)
+
+    def on_nack(self, headers, body):
+        msg_id = headers.get('id' if self.version == '1.2' else 'message-id')
+        self.broker.nack(self, msg_id)
+
+    def defer(self, handler, headers, body):
+        frames = self.transactions.get(headers.pop('transaction'))
+        if frames is None:
+            self.error('Unknown transaction')
+            return
+        frames.append((handler, headers, body))
+
+    def on_begin(self, headers, body):
+        if headers['transaction'] in self.transactions:
+            self.error('Transaction already started')
+            return
+        self.transactions[headers['transaction']] = []
+
+    def on_commit(self, headers, body):
+        frames = self.transactions.pop(headers['transaction'], None)
+        if frames is None:
+            self.error('Unknown transaction')
+            return
+        with self.broker.lock:
+            for handler, frame_headers, frame_body in frames:
+                handler(frame_headers, frame_body)
+
+    def on_abort(self, headers, body):
+        if self.transactions.pop(headers['transaction'], None) is None:
+            self.error('Unknown transaction')
+
+
+class Broker(object):
+    """STOMP broker listening on a loopback TCP port.
+
+    Messages sent to ``/queue/`` destinations are dispatched round robin to
+    subscribers, honouring the ``activemq.prefetchSize`` subscription
+    header and ``selector`` ones (see :py:class:`Selector`). Messages with
+    higher ``priority`` go first, and the ones past their ``expires`` time
+    are dropped, counted in the ``expired`` stat. Unacknowledged messages
+    are redelivered, flagged with a ``redelivered`` header, when
+    the session owning them ends. Frames sent within a transaction are held
+    until it's committed.
+
+    Messages sent to ``/topic/`` destinations are copied to their current
+    subscribers, which may use the ``*`` and ``>`` wildcards (see
+    :py:func:`topic_matches`), and never redelivered. Like ActiveMQ virtual
+    topics, the ones sent to ``/topic/VirtualTopic.<name>`` are copied to the
+    ``/queue/Consumer.<consumer>.VirtualTopic.<name>`` queues too.
+
+    :arg port: port to listen to, a free one by default.
+    :arg versions: STOMP versions accepted by the broker.
+    :arg heartbeats: heart-beats offered to STOMP 1.1 and 1.2 clients. They
+        are never sent unless ``send_heartbeats`` is set, so clients
+        expecting them see the broker as dead, which is handy for testing
+        heart-beat timeouts.
+    """
+    def __init__(self, host='127.0.0.1', port=0, versions=VERSIONS,
+                 heartbeats=(0, 0), send_heartbeats=False):
+        self.versions = tuple(versions)
+        self.heartbeats = heartbeats
+        self.send_heartbeats = send_heartbeats
+        self.lock = threading.RLock()
+        self.queues = collections.defaultdict(collections.deque)
+        self.subscriptions = collections.defaultdict(list)
+        self.sessions = []
+        self.stats = collections.Counter()
+        self._ids = itertools.count(1)
+        self._cycles = {}
+        self.running = False
+        self.thread = None
+        self.listen(host, port)
+
+    def listen(self, host, port):
+        """Bind the listening socket, setting :py:attr:`port`."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+
+    @property
+    def host_and_port(self):
+        return self.host, self.port
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop accepting connections and close all sessions."""
+        self.running = False
+        try:
+            # unblock accept()
+            socket.create_connection(self.host_and_port).close()
+        except socket.error:
+            pass
+        self.thread.join()
+        self.sock.close()
+        for session in list(self.sessions):
+            session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while self.running:
+            sock, _ = self.sock.accept()
+            if not self.running:
+                sock.close()
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+            session.start()
+
+    def remove_session(self, session):
+        with self.lock:
+            if session not in self.sessions:
+                return
+            self.sessions.remove(session)
+            for sub in list(session.subscriptions.values()):
+                self.unsubscribe(sub)
+
+    def qsize(self, destination):
+        """Number of messages waiting to be dispatched from ``destination``.
+        """
+        with self.lock:
+            return len(self.queues[destination])
+
+    def publish(self, headers, body):
+        headers = dict(headers)
+        headers.pop('content-length', None)
+        headers.pop('receipt', None)
+        headers.setdefault('message-id', 'ID:{0}'.format(next(self._ids)))
+        headers.setdefault('timestamp', int(time.time() * 1000))
+        headers.setdefault('expires', 0)
+        headers.setdefault('priority', 4)
+        with self.lock:
+            if headers['destination'].startswith('/topic/'):
+                self._publish_topic(headers, body)
+            else:
+                self._enqueue(headers['destination'], headers, body)
+
+    def _publish_topic(self, headers, body):
+        topic = headers['destination'][len('/topic/'):]
+        for destination in list(self.subscriptions):
+            if not (destination.startswith('/topic/') and
+                    topic_matches(destination[len('/topic/'):], topic)):
+                continue
+            for sub in self.subscriptions[destination]:
+                if sub.session.running and sub.matches(headers):
+                    self._deliver(sub, self._copy(headers), body)
+        if not topic.startswith('VirtualTopic.'):
+            return
+        for destination in set(self.queues) | set(self.subscriptions):
+            if not destination.startswith('/queue/Consumer.'):
+                continue
+            consumer = destination[len('/queue/Consumer.'):].split('.', 1)
+            if len(consumer) == 2 and topic_matches(consumer[1], topic):
+                self._enqueue(destination, self._copy(headers), body)
+
+    def _copy(self, headers):
+        # every copy is a message on its own, acknowledged separately
+        return dict(headers, **{'message-id': 'ID:{0}'.format(
+            next(self._ids))})
+
+    def _enqueue(self, destination, headers, body):
+        with self.lock:
+            queue = self.queues[destination]
+            # after the messages of the same or higher priority
+            index = len(queue)
+            while (index and int(queue[index - 1][0]['priority']) <
+                   int(headers['priority'])):
+                index -= 1
+            queue.rotate(-index)
+            queue.appendleft((headers, body))
+            queue.rotate(index)
+            self._dispatch(destination)
+
+    def subscribe(self, sub):
+        with self.lock:
+            self.subscriptions[sub.destination].append(sub)
+            self._cycles.pop(sub.destination, None)
+            self._dispatch(sub.destination)
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            subs = self.subscriptions[sub.destination]
+            if sub in subs:
+                subs.remove(sub)
+                self._cycles.pop(sub.destination, None)
+            if sub.destination.startswith('/topic/'):
+                # gone with the subscription
+                sub.unacked.clear()
+                return
+            # give unacked messages back
+            queue = self.queues[sub.destination]
+            for headers, body in reversed(list(sub.unacked.values())):
+                headers['redelivered'] = 'true'
+                queue.appendleft((headers, body))
+            sub.unacked.clear()
+            self._dispatch(sub.destination)
+
+    def ack(self, session, msg_id):
+        with self.lock:
+            for sub in session.subscriptions.values():
+                if msg_id not in sub.unacked:
+                    continue
+                if sub.ack == 'client':
+                    # cumulative, acks every message delivered before it
+                    while sub.unacked:
+                        acked, _ = sub.unacked.popitem(last=False)
+                        if acked == msg_id:
+                            break
+                else:
+                    del sub.unacked[msg_id]
+                self._dispatch(sub.destination)
+                return
+
+    def nack(self, session, msg_id):
+        with self.lock:
+            for sub in session.subscriptions.values():
+                message = sub.unacked.pop(msg_id, None)
+                if message is None:
+                    continue
+                if not sub.destination.startswith('/topic/'):
+                    message[0]['redelivered'] = 'true'
+                    self.queues[sub.destination].appendleft(message)
+                    self._dispatch(sub.destination)
+                return
+
+    def _next_subscription(self, destination, headers):
+        subs = [sub for sub in self.subscriptions[destination]
+                if sub.can_receive() and sub.matches(headers)]
+        if not subs:
+            return None
+
+        cycle = self._cycles.get(destination)
+        if cycle is None:
+            cycle = self._cycles[destination] = itertools.cycle(
+                self.subscriptions[destination])
+        for _ in range(len(self.subscriptions[destination])):
+            sub = next(cycle)
+            if sub in subs:
+                return sub
+
+    def _dispatch(self, destination):
+        queue = self.queues[destination]
+        # messages no subscription selects wait for one that does
+        skipped = []
+        while queue and any(sub.can_receive()
+                            for sub in self.subscriptions[destination]):
+            headers, body = queue.popleft()
+            expires = int(headers['expires'])
+            if expires and expires <= time.time() * 1000:
+                self.stats['expired'] += 1
+                continue
+            sub = self._next_subscription(destination, headers)
+            if sub is None:
+                skipped.append((headers, body))
+            else:
+                self._deliver(sub, headers, body)
+        queue.extendleft(reversed(skipped))
+
+    def _deliver(self, sub, headers, body):
+        frame_headers = dict(headers)
+        frame_headers['subscription'] = sub.id
+        if sub.ack != 'auto':
+            sub.unacked[headers['message-id']] = (headers, body)
+            if sub.session.version == '1.2':
+                frame_headers['ack'] = headers['message-id']
+        sub.session.send_frame('MESSAGE', frame_headers, body)
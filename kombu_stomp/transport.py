@@ -1,93 +1,836 @@
 from __future__ import absolute_import
+import array
+import collections
 import contextlib
+import functools
+import socket
+import sys
+import threading
+import time
+import uuid
 
+import six
 from kombu.transport import virtual
+from kombu.transport.virtual import exchange as _exchange
 from kombu import utils
+from kombu.utils import url
+from six.moves import queue as _queue
 from stomp import exception as exc
 
+from . import metrics as _metrics
 from . import stomp
+from .utils import monotonic
+from .utils import MutableMapping
+
+# latency recorded for brokers we couldn't connect to
+FAILED = float('inf')
 
 
 class Message(virtual.Message):
     """Kombu virtual transport message class for kombu-stomp.
 
     This class extends :py:class:`kombu.transport.virtual.Message`, so it
-    keeps STOMP message ID for later use.
+    keeps STOMP message ID and the queue it was received from for later use.
+
+    Incoming messages keep their timings too, in seconds since the epoch:
+    ``published_at`` by the producer, ``broker_timestamp`` when the broker
+    got it, ``received_at`` by the consumer connection and ``delivered_at``
+    to Kombu, along with the ``broker`` ``(host, port)`` it came from. They
+    are ``None`` when unknown. Timings taken in different hosts are only as
+    accurate as their clocks are in sync.
     """
+    published_at = broker_timestamp = received_at = delivered_at = None
+    broker = None
 
-    def __init__(self, channel, raw_message):
-        # we'll get a message ID only for incoming messages
+    def __init__(self, *args, **kwargs):
+        # Kombu 3 passes (channel, payload) and Kombu 4+ (payload, channel)
+        if 'channel' in kwargs:
+            channel = kwargs.pop('channel')
+            raw_message = args[0] if args else kwargs.pop('payload')
+        else:
+            channel = args[0]
+            raw_message = args[1] if len(args) > 1 else kwargs.pop('payload')
+        # we'll get a message ID, queue and trace only for incoming messages
         if isinstance(raw_message, tuple):
-            raw_message, msg_id = raw_message
-            self.msg_id = msg_id
+            raw_message, self.msg_id, self.queue, trace = (
+                raw_message + (None, None)
+            )[:4]
         else:
             self.msg_id = None
+            self.queue = None
+            trace = None
+
+        super(Message, self).__init__(channel=channel, payload=raw_message)
+        if trace:
+            self.published_at = trace['published_at']
+            self.broker_timestamp = trace['broker_timestamp']
+            self.received_at = trace['received_at']
+            self.broker = trace['broker']
+            self.delivered_at = time.time()
+            channel.trace(self)
+
+    @property
+    def queue_wait(self):
+        """Seconds from reaching the broker until received by the consumer."""
+        if self.broker_timestamp is None or self.received_at is None:
+            return None
+        return self.received_at - self.broker_timestamp
+
+    @property
+    def buffer_wait(self):
+        """Seconds from being received until delivered to Kombu."""
+        if self.received_at is None or self.delivered_at is None:
+            return None
+        return self.delivered_at - self.received_at
+
+    @property
+    def latency(self):
+        """Seconds from being published until delivered to Kombu."""
+        if self.published_at is None or self.delivered_at is None:
+            return None
+        return self.delivered_at - self.published_at
+
+
+class Unacked(MutableMapping):
+    """Mapping of the delivery tags of unacknowledged messages to their STOMP
+    message ID, keeping the time they were delivered too.
+
+    Records live in slots of flat arrays, reused once messages are settled,
+    so memory is bounded by the most messages unacknowledged at once. Slots
+    are compacted when most of them are free, and released when no message
+    is left.
+    """
+    #: fewest slots worth compacting
+    COMPACT_MIN = 64
 
-        super(Message, self).__init__(channel, raw_message)
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # delivery tag -> slot
+        self._slots = {}
+        self._msg_ids = []
+        self._delivered_at = array.array('d')
+        self._free = []
+
+    def add(self, delivery_tag, msg_id, delivered_at=0.0):
+        """Track a message delivered at ``delivered_at`` (monotonic time,
+        ``0.0`` if unknown).
+        """
+        slot = self._slots.get(delivery_tag)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._msg_ids)
+                self._msg_ids.append(None)
+                self._delivered_at.append(0.0)
+            self._slots[delivery_tag] = slot
+        self._msg_ids[slot] = msg_id
+        self._delivered_at[slot] = delivered_at
+
+    def settle(self, delivery_tag):
+        """Stop tracking a message.
+
+        :return: its message ID and delivery time, ``(None, None)`` if it
+            wasn't tracked.
+        """
+        slot = self._slots.pop(delivery_tag, None)
+        if slot is None:
+            return None, None
+        msg_id = self._msg_ids[slot]
+        delivered_at = self._delivered_at[slot] or None
+        if not self._slots:
+            self._reset()
+            return msg_id, delivered_at
+        self._msg_ids[slot] = None
+        self._free.append(slot)
+        if (len(self._free) > len(self._slots) and
+                len(self._msg_ids) >= self.COMPACT_MIN):
+            self._compact()
+        return msg_id, delivered_at
+
+    def _compact(self):
+        records = [(tag, self._msg_ids[slot], self._delivered_at[slot])
+                   for tag, slot in self._slots.items()]
+        self._reset()
+        for record in records:
+            self.add(*record)
+
+    def stats(self):
+        """Return the number of ``messages`` tracked, the ``slots`` they
+        take, and the ``bytes`` used by the tracking structures, not counting
+        the tags and IDs, which are shared with the messages.
+        """
+        return {
+            'messages': len(self._slots),
+            'slots': len(self._msg_ids),
+            'bytes': (sys.getsizeof(self._slots) +
+                      sys.getsizeof(self._msg_ids) +
+                      sys.getsizeof(self._delivered_at) +
+                      sys.getsizeof(self._free)),
+        }
+
+    def __getitem__(self, delivery_tag):
+        return self._msg_ids[self._slots[delivery_tag]]
+
+    def __setitem__(self, delivery_tag, msg_id):
+        self.add(delivery_tag, msg_id)
+
+    def __delitem__(self, delivery_tag):
+        if delivery_tag not in self._slots:
+            raise KeyError(delivery_tag)
+        self.settle(delivery_tag)
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def clear(self):
+        self._reset()
 
 
 class QoS(virtual.QoS):
-    """Kombu quality of service class for ``kombu-stomp``."""
+    """Kombu quality of service class for ``kombu-stomp``.
+
+    STOMP acknowledgements are buffered and sent in batches of
+    ``ack_batch_size``, or when ``ack_flush_interval`` seconds elapse, or when
+    the channel runs out of messages to consume. When subscribing with
+    ``ack_mode='client'``, acknowledgements are cumulative, so a single ACK
+    frame per queue acknowledges the longest run of acked messages in
+    delivery order.
+
+    Acknowledgements made while :py:attr:`transaction` is set are sent as
+    part of that STOMP transaction, see :py:meth:`Channel.transaction`.
+
+    Requeued and restored messages are NACKed, so the broker redelivers them
+    instead of Kombu publishing them again, see :py:attr:`can_nack`.
+
+    The message IDs of unacknowledged messages are kept in :py:attr:`ids`,
+    an :py:class:`Unacked` mapping, until they are acked, rejected, restored
+    or discarded after losing the connection, see :py:meth:`stats`.
+    """
     def __init__(self, *args, **kwargs):
-        self.ids = {}
+        #: :py:class:`Unacked` delivery tag -> message ID mapping
+        self.ids = Unacked()
+        # delivery tag -> message ID, acked by Kombu but not by the broker yet
+        self._pending_acks = collections.OrderedDict()
+        # current STOMP transaction ID, and delivery tags acked within it
+        self.transaction = None
+        self._transaction_acks = set()
+        # queue -> delivery tags in delivery order, only for cumulative acks
+        self._delivery_order = collections.defaultdict(
+            collections.OrderedDict,
+        )
+        self._last_ack_flush = monotonic()
         super(QoS, self).__init__(*args, **kwargs)
 
+    @property
+    def cumulative_acks(self):
+        return self.channel.ack_mode == 'client'
+
+    @property
+    def can_nack(self):
+        """Whether messages can be NACKed: STOMP 1.0 has no NACK, and with
+        cumulative acks it would reject the messages delivered before too.
+
+        Otherwise requeued and restored messages are acknowledged, and
+        published again by Kombu.
+        """
+        return self.channel.stomp_version != '1.0' and not self.cumulative_acks
+
     def append(self, message, delivery_tag):
-        self.ids[delivery_tag] = message.msg_id
+        metrics = self.channel.metrics
+        # delivery times are only taken for the ack latency metric
+        self.ids.add(delivery_tag,
+                     message.msg_id,
+                     monotonic() if metrics.enabled else 0.0)
+        if self.cumulative_acks:
+            self._delivery_order[message.queue][delivery_tag] = None
         super(QoS, self).append(message, delivery_tag)
+        if metrics.enabled:
+            self._report_unacked()
+
+    def stats(self):
+        """Return the sizes of the unacknowledged message tracking.
+
+        :return dict: ``unacked`` messages, the ``slots`` and ``bytes`` used
+            tracking them (see :py:meth:`Unacked.stats`), messages
+            ``delivered`` to Kombu and not settled yet, and acknowledgements
+            buffered (``pending_acks``).
+        """
+        unacked = self.ids.stats()
+        return {
+            'unacked': unacked['messages'],
+            'slots': unacked['slots'],
+            'bytes': unacked['bytes'],
+            'delivered': self.unsettled(),
+            'pending_acks': len(self._pending_acks),
+        }
+
+    def unsettled(self):
+        """Return the number of messages delivered to Kombu and not acked or
+        rejected yet.
+        """
+        return len(self._delivered) - len(self._dirty)
+
+    def _report_unacked(self):
+        stats = self.ids.stats()
+        metrics = self.channel.metrics
+        metrics.gauge('kombu_stomp_unacked_messages', stats['messages'])
+        metrics.gauge('kombu_stomp_unacked_bytes', stats['bytes'])
 
     def ack(self, delivery_tag):
         self._stomp_ack(delivery_tag)
         return super(QoS, self).ack(delivery_tag)
 
+    def reject(self, delivery_tag, requeue=False):
+        if requeue and delivery_tag not in self._delivered:
+            # delivered through a lost connection, the broker redelivers it
+            requeue = False
+        if requeue and self.can_nack:
+            with self.channel.conn_or_acquire() as conn:
+                self._nack(conn, delivery_tag)
+            return super(QoS, self).reject(delivery_tag)
+        # Acknowledged, so the broker discards it rather than keeping its
+        # prefetch slot, as a NACK would have it redelivered. With
+        # cumulative acks a message never acked blocks all the messages
+        # after it, and requeued messages are restored as a new message, so
+        # the broker mustn't redeliver them too.
+        self._stomp_ack(delivery_tag)
+        return super(QoS, self).reject(delivery_tag, requeue=requeue)
+
+    def restore_unacked(self):
+        """Give the unacknowledged messages back to the broker.
+
+        They are NACKed if possible, otherwise acknowledged and published
+        again. Messages delivered through a lost connection are left to the
+        broker, which redelivers them anyway.
+        """
+        self._flush()
+        conn = self.channel.stomp_conn
+        if not self._delivered or not conn.is_connected():
+            self.discard_stale()
+            return []
+        if not self.can_nack:
+            for delivery_tag in self._delivered:
+                self._stomp_ack(delivery_tag)
+            self.flush_acks()
+            return super(QoS, self).restore_unacked()
+
+        for delivery_tag in self._delivered:
+            self._nack(conn, delivery_tag)
+        self._delivered.clear()
+        return []
+
+    def _nack(self, conn, delivery_tag):
+        msg_id, _ = self.ids.settle(delivery_tag)
+        if self.channel.metrics.enabled:
+            self._report_unacked()
+        if msg_id is None:
+            return
+        kwargs = {}
+        if self.transaction is not None:
+            kwargs['transaction'] = self.transaction
+        conn.nack(msg_id, **kwargs)
+
     def _stomp_ack(self, delivery_tag):
-        msg_id = self.ids.pop(delivery_tag, None)
+        msg_id, delivered_at = self.ids.settle(delivery_tag)
+        metrics = self.channel.metrics
+        if metrics.enabled:
+            if delivered_at is not None:
+                metrics.observe('kombu_stomp_ack_latency_seconds',
+                                monotonic() - delivered_at)
+            self._report_unacked()
         if msg_id:
-            with self.channel.conn_or_acquire() as conn:
-                conn.ack(msg_id)
+            self._pending_acks[delivery_tag] = msg_id
+            if self.transaction is not None:
+                self._transaction_acks.add(delivery_tag)
+            if (len(self._pending_acks) >= self.channel.ack_batch_size or
+                    monotonic() - self._last_ack_flush >=
+                    self.channel.ack_flush_interval):
+                self.flush_acks()
+
+    def flush_acks(self):
+        """Send all the buffered acknowledgements to the broker."""
+        self._last_ack_flush = monotonic()
+        if not self._pending_acks:
+            return
+
+        with self.channel.conn_or_acquire() as conn:
+            # a reconnection discards the pending acks, see discard_stale
+            if self.cumulative_acks:
+                msg_ids = self._pop_cumulative_acks()
+            else:
+                msg_ids = list(self._pending_acks.values())
+                self._pending_acks.clear()
+
+            kwargs = {}
+            if self.transaction is not None:
+                kwargs['transaction'] = self.transaction
+            for msg_id in msg_ids:
+                conn.ack(msg_id, **kwargs)
+
+    def begin_transaction(self, transaction):
+        """Send the following acknowledgements within ``transaction``.
+
+        Acknowledgements buffered so far are flushed first, so they aren't
+        part of it.
+        """
+        self.flush_acks()
+        self.transaction = transaction
+
+    def end_transaction(self, commit=True):
+        """Stop sending acknowledgements within the current transaction.
+
+        :arg commit: if true, the acknowledgements still buffered are
+            flushed, so they get committed along with the transaction,
+            otherwise they are forgotten, since the broker discards them
+            when the transaction is aborted. Messages acknowledged within
+            an aborted transaction are redelivered by the broker after
+            reconnecting, or acknowledged by the next cumulative ACK.
+        """
+        if commit:
+            self.flush_acks()
+        else:
+            for delivery_tag in self._transaction_acks:
+                self._pending_acks.pop(delivery_tag, None)
+                for delivered in self._delivery_order.values():
+                    delivered.pop(delivery_tag, None)
+        self._transaction_acks.clear()
+        self.transaction = None
+
+    def _pop_cumulative_acks(self):
+        """Return the message IDs acknowledging every acked run of messages.
+
+        Only the leading acked messages of every queue can be acknowledged,
+        the rest must wait for the messages delivered before them.
+        """
+        msg_ids = []
+        for delivered in self._delivery_order.values():
+            msg_id = None
+            for delivery_tag in list(delivered):
+                if delivery_tag not in self._pending_acks:
+                    break
+
+                del delivered[delivery_tag]
+                msg_id = self._pending_acks.pop(delivery_tag)
+
+            if msg_id:
+                msg_ids.append(msg_id)
+
+        return msg_ids
+
+    def discard_stale(self):
+        """Forget about messages delivered through a previous connection.
+
+        The broker will redeliver them, and their message IDs can't be
+        acknowledged through a new connection. They no longer count against
+        the prefetch limit, and aren't restored when the channel is closed,
+        while acking or rejecting them is still fine.
+        """
+        self._flush()
+        self._delivered.clear()
+        self.ids.clear()
+        self._pending_acks.clear()
+        self._delivery_order.clear()
+        self._transaction_acks.clear()
+
+
+class ConnectionPool(object):
+    """Thread safe pool of STOMP connections used for publishing.
+
+    Connections are created on demand, up to ``limit``, and every one of them
+    is used by a single thread at a time. Pooled connections never
+    subscribe, so they don't own any subscription or unacknowledged message:
+    consuming and acknowledging always happen through the channel
+    connection.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._free = _queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    @contextlib.contextmanager
+    def acquire(self, create):
+        """Context manager yielding a connected connection from the pool.
+
+        It blocks until a connection is free if the pool is full.
+
+        :arg create: callable returning a new connected STOMP connection.
+        """
+        conn = self._get(create)
+        try:
+            yield conn
+        finally:
+            self._free.put(conn)
+
+    def _get(self, create):
+        try:
+            conn = self._free.get_nowait()
+        except _queue.Empty:
+            with self._lock:
+                full = self._size >= self.limit
+                if not full:
+                    self._size += 1
+            if not full:
+                return self._create(create)
+            conn = self._free.get()
+
+        # health check, replace broken connections
+        if not conn.is_connected():
+            return self._create(create)
+        return conn
+
+    def _create(self, create):
+        conn = None
+        try:
+            conn = create()
+        finally:
+            if conn is None:
+                # failed, so it doesn't count against the limit
+                with self._lock:
+                    self._size -= 1
+        return conn
+
+    def close(self):
+        """Disconnect all the connections in the pool."""
+        while True:
+            try:
+                conn = self._free.get_nowait()
+            except _queue.Empty:
+                break
+            try:
+                conn.disconnect()
+            except exc.NotConnectedException:
+                pass
+            with self._lock:
+                self._size -= 1
+
+
+class SharedConnection(object):
+    """A channel's view of the STOMP connection shared by every channel of
+    the transport, with the ``shared_connection`` transport option.
+
+    It works like the shared connection (see :py:meth:`Transport.shared_conn`),
+    except that the messages received for the channel subscriptions are
+    routed to its own :py:attr:`message_listener`, and disconnecting only
+    unsubscribes the channel.
+
+    :arg message_listener: :py:class:`kombu_stomp.stomp.MessageListener`
+        buffering the messages received for the channel.
+    """
+    def __init__(self, message_listener):
+        self.message_listener = message_listener
+        #: shared connection it's attached to, see :py:meth:`attach`
+        self.conn = None
+        self._subscriptions = set()
+
+    def __getattr__(self, name):
+        if self.conn is None:
+            raise exc.NotConnectedException()
+        return getattr(self.conn, name)
+
+    def attach(self, transport, channel):
+        """Attach to the shared connection of ``transport``, connecting it
+        with the ``channel`` settings if needed.
+        """
+        self.conn = transport.shared_conn(channel)
+
+    def is_connected(self):
+        # a lost shared connection is replaced, rather than reconnected
+        return self.conn is not None and self.conn.is_connected()
+
+    def subscribe(self, destination, id, **kwargs):
+        self.conn.message_listener.route(id, self.message_listener)
+        self._subscriptions.add(id)
+        return self.conn.subscribe(destination, id=id, **kwargs)
+
+    def unsubscribe(self, id, **headers):
+        self._subscriptions.discard(id)
+        self.conn.message_listener.routes.pop(id, None)
+        return self.conn.unsubscribe(id=id, **headers)
+
+    def disconnect(self):
+        """Unsubscribe the channel, leaving the connection to the rest."""
+        if not self.is_connected():
+            raise exc.NotConnectedException()
+        for id in list(self._subscriptions):
+            self.unsubscribe(id)
+
+
+class TopicExchange(_exchange.TopicExchange):
+    """Topic exchange published to STOMP topics, with the ``topic_exchanges``
+    transport option, or to every bound queue otherwise.
+    """
+    def deliver(self, message, exchange, routing_key, **kwargs):
+        if not self.channel.topic_exchanges:
+            return super(TopicExchange, self).deliver(message,
+                                                      exchange,
+                                                      routing_key,
+                                                      **kwargs)
+        self.channel._put_fanout(exchange, message, routing_key, **kwargs)
 
 
 class Channel(virtual.Channel):
-    """``kombu-stomp`` channel class."""
+    """``kombu-stomp`` channel class.
+
+    Fanout exchanges, and topic ones with the ``topic_exchanges`` transport
+    option, are STOMP topics (see :py:meth:`topic_destination`), so the
+    broker copies messages to their subscribers.
+
+    Every channel has its own STOMP connection, unless the
+    ``shared_connection`` transport option is set. Then channels subscribe
+    through a :py:class:`SharedConnection`, with subscription IDs telling
+    the channel apart, see :py:meth:`subscription_id`.
+    """
     QoS = QoS
     Message = Message
+    supports_fanout = True
+    exchange_types = dict(virtual.Channel.exchange_types,
+                          topic=TopicExchange)
 
     def __init__(self, *args, **kwargs):
         super(Channel, self).__init__(*args, **kwargs)
         self._stomp_conn = None
         self._subscriptions = set()
+        # queue -> JMS selector given as queue argument
+        self._selectors = {}
+        self._local = threading.local()
+        # whether the channel connection ever connected, so next connections
+        # are failovers
+        self._connected = False
+        #: seconds the last failover took, from noticing the lost connection
+        #: to being subscribed again through the new one
+        self.failover_time = None
+        # whether subscriptions were made with an older prefetch count
+        self._prefetch_changed = False
+
+    def drain_events(self, timeout=None, callback=None):
+        """Get the next message received, see :py:meth:`_get_many`.
+
+        It's given to ``callback(message, queue)`` if set, like Kombu 4+
+        does, and returned as ``(message, queue)`` otherwise, like Kombu 3
+        expects.
+
+        :raises: :py:exc:`Empty` right away without consumers, or with the
+            prefetch limit reached, see :py:meth:`Transport.drain_events`.
+        """
+        if not (self._consumers and self.qos.can_consume()):
+            raise _queue.Empty()
+        item = self._get_many(self._active_queues, timeout=timeout)
+        if callback is None:
+            return item
+        callback(*item)
 
     def _get_many(self, queue, timeout=None):
         """Get next messesage from current active queues.
 
-        Note that we are ignoring any timeout due to performance
-        issues.
+        Queues take turns, as configured by ``queue_weights``, so a busy
+        queue doesn't starve the rest. It blocks until a message is received
+        or ``timeout`` seconds elapse.
+        If no timeout is given we wait up to ``consume_timeout`` seconds.
         """
+        if timeout is None:
+            timeout = self.consume_timeout
+
         with self.conn_or_acquire() as conn:
+            self._update_prefetch(conn)
             for q in queue:
                 self.subscribe(conn, q)
 
             # FIXME(rafaduran): inappropriate intimacy code smell
-            return next(conn.message_listener.iterator())
+            if not conn.message_listener.qsize():
+                # we are idle, so don't keep acknowledgements waiting
+                self.qos.flush_acks()
+            item = next(conn.message_listener.iterator(timeout, queue))
+            if self.metrics.enabled:
+                conn.message_listener.report_buffer()
+            return item
+
+    def prepare_message(self, body, priority=None, *args, **kwargs):
+        message = super(Channel, self).prepare_message(body,
+                                                       priority,
+                                                       *args,
+                                                       **kwargs)
+        if not priority:
+            # Kombu publishes 0, the lowest one, when not given any, so the
+            # broker default applies instead, see stomp.encode_headers.
+            # Kombu 3 keeps it in the delivery info and Kombu 4+ in the
+            # properties.
+            properties = message['properties']
+            properties['delivery_info'].pop('priority', None)
+            properties.pop('priority', None)
+        return message
 
     def _put(self, queue, message, **kwargs):
-        with self.conn_or_acquire() as conn:
+        self._send(self.queue_destination(queue), message, queue)
+
+    def _put_fanout(self, exchange, message, routing_key, **kwargs):
+        if self.typeof(exchange).type == 'fanout':
+            routing_key = None
+        self._send(self.topic_destination(exchange, routing_key),
+                   message,
+                   exchange)
+
+    def _queue_bind(self, *args):
+        # bindings are looked up in the broker state when subscribing, see
+        # topic()
+        pass
+
+    def _send(self, destination, message, name):
+        """Publish a Kombu message to ``destination``, ``name`` being the
+        queue or exchange it's reported as.
+        """
+        with self.publisher_conn() as conn:
             body = message.pop('body')
-            conn.send(self.queue_destination(queue), body, **message)
+            headers = stomp.encode_headers(message,
+                                           self.filter_headers,
+                                           self.json_headers)
+            if self.compression:
+                body = stomp.compress_body(body,
+                                           headers,
+                                           self.compression,
+                                           self.compression_threshold)
+            if self.qos.transaction is not None:
+                headers['transaction'] = self.qos.transaction
+            if self.publish_timestamps:
+                headers[stomp.PUBLISHED_HEADER] = repr(time.time())
+            if self.metrics.enabled:
+                self.metrics.increment('kombu_stomp_published_bytes_total',
+                                       len(body),
+                                       queue=name)
+            # passed as a dict, since Kombu 'headers' clashes with stomp.py
+            # send arguments
+            conn.send(destination, body, headers=headers)
+
+    def trace(self, message):
+        """Report the timings of a message delivered to Kombu.
+
+        They are given to the ``trace_callback`` transport option, and to
+        the queue wait and latency metrics.
+        """
+        if self.trace_callback is not None:
+            self.trace_callback(message)
+        if self.metrics.enabled:
+            broker = message.broker and '{0}:{1}'.format(*message.broker)
+            for name, value in (
+                    ('kombu_stomp_queue_wait_seconds', message.queue_wait),
+                    ('kombu_stomp_buffer_wait_seconds', message.buffer_wait),
+                    ('kombu_stomp_latency_seconds', message.latency)):
+                if value is not None:
+                    self.metrics.observe(name, value,
+                                         queue=message.queue,
+                                         broker=broker)
 
     def basic_consume(self, queue, *args, **kwargs):
         with self.conn_or_acquire() as conn:
             self.subscribe(conn, queue)
 
-        return super(Channel, self).basic_consume(queue, *args, **kwargs)
+        consumer_tag = super(Channel, self).basic_consume(queue,
+                                                          *args,
+                                                          **kwargs)
+        self.connection.notify()
+        return consumer_tag
+
+    def basic_ack(self, *args, **kwargs):
+        super(Channel, self).basic_ack(*args, **kwargs)
+        # room for one more message within the prefetch limit
+        self.connection.notify()
+
+    def basic_reject(self, *args, **kwargs):
+        super(Channel, self).basic_reject(*args, **kwargs)
+        self.connection.notify()
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                  apply_global=False):
+        """Set the prefetch count.
+
+        The broker only takes it when subscribing (see
+        ``prefetch_header``), so queues already consumed are subscribed
+        again, as soon as no message waits for acknowledgement, see
+        :py:meth:`_update_prefetch`.
+        """
+        if (prefetch_count != self.qos.prefetch_count and
+                self.prefetch_header and self._subscriptions):
+            self._prefetch_changed = True
+        super(Channel, self).basic_qos(prefetch_size,
+                                       prefetch_count,
+                                       apply_global)
+        self.connection.notify()
+        # otherwise subscribed again with it when reconnecting
+        if (self._prefetch_changed and self._stomp_conn is not None and
+                self._stomp_conn.is_connected()):
+            with self.conn_or_acquire() as conn:
+                self._update_prefetch(conn)
+
+    def _update_prefetch(self, conn):
+        """Subscribe ``conn`` again to the queues being consumed, if the
+        prefetch count changed since subscribing.
+
+        It waits until no message is delivered and unacked, since acking
+        messages of the old subscriptions may fail, and the broker redelivers
+        them anyway. Messages received through the old subscriptions are
+        dropped for the same reason, see
+        :py:meth:`kombu_stomp.stomp.MessageListener.discard`.
+        """
+        if not self._prefetch_changed or self.qos.unsettled():
+            return
+
+        self._prefetch_changed = False
+        self.qos.flush_acks()
+        for queue in list(self._subscriptions):
+            subscription = self.subscription_id(queue)
+            receipt = str(uuid.uuid4())
+            conn.message_listener.discard(subscription, queue, receipt)
+            conn.unsubscribe(id=subscription, receipt=receipt)
+            self._subscriptions.discard(queue)
+            self.subscribe(conn, queue)
 
     def subscribe(self, conn, queue):
         if queue in self._subscriptions:
             return
 
         self._subscriptions.add(queue)
-        return conn.subscribe(self.queue_destination(queue),
-                              ack='client-individual')
+        headers = {}
+        prefetch = self.qos.prefetch_count
+        if self.shared_connection and self.receive_buffer_size:
+            # our buffer doesn't hold back the shared connection when full,
+            # see stomp.MessageListener.route
+            prefetch = min(prefetch or self.receive_buffer_size,
+                           self.receive_buffer_size)
+        if prefetch and self.prefetch_header:
+            # the broker won't push more unacked messages than we can consume
+            headers[self.prefetch_header] = prefetch
+        selector = self.selector(queue)
+        if selector:
+            # the broker only pushes the messages matching it
+            headers['selector'] = selector
+        # the ID tells the queue of received messages, which can't be taken
+        # from topic destinations
+        return conn.subscribe(self.subscription_destination(queue),
+                              id=self.subscription_id(queue),
+                              ack=self.ack_mode,
+                              **headers)
+
+    def _new_queue(self, queue, arguments=None, **kwargs):
+        if arguments and arguments.get('selector'):
+            self._selectors[queue] = arguments['selector']
+
+    def selector(self, queue):
+        """Return the JMS selector filtering the messages of ``queue``.
+
+        It's the ``selector`` queue argument, e.g.
+        ``kombu.Queue('tasks', queue_arguments={'selector': "kind = 'a'"})``,
+        or the ``selectors`` transport option entry for the queue.
+        """
+        return self._selectors.get(queue) or self.selectors.get(queue)
 
     def queue_unbind(self,
                      queue,
@@ -101,19 +844,101 @@ class Channel(virtual.Channel):
                                           arguments,
                                           **kwargs)
         with self.conn_or_acquire() as conn:
-            conn.unsubscribe(self.queue_destination(queue))
+            conn.unsubscribe(id=self.subscription_id(queue))
             self._subscriptions.discard(queue)
 
     def queue_destination(self, queue):
         return '/queue/{prefix}{name}'.format(prefix=self.prefix,
                                               name=queue)
 
+    def subscription_id(self, queue):
+        """Return the ID of the subscription to ``queue``.
+
+        It's the queue destination, prefixed by the channel ID when channels
+        share the connection.
+        """
+        destination = self.queue_destination(queue)
+        if self.shared_connection:
+            return '{0}:{1}'.format(self.channel_id, destination)
+        return destination
+
+    def topic(self, queue):
+        """Return the exchange and routing key of the topic ``queue`` is
+        bound to, ``None`` if it isn't bound to one.
+
+        The routing key is ``None`` for fanout exchanges.
+        """
+        for exchange, routing_key in self.bindings(queue):
+            type = self.typeof(exchange).type
+            if type == 'fanout':
+                return exchange, None
+            if type == 'topic' and self.topic_exchanges:
+                return exchange, routing_key
+        return None
+
+    def bindings(self, queue):
+        """Return the ``(exchange, routing_key)`` pairs ``queue`` is bound
+        with.
+        """
+        if hasattr(self.state, 'queue_bindings'):
+            # Kombu 4+ keeps every binding of the queue
+            return [(exchange, routing_key) for exchange, routing_key, _
+                    in self.state.queue_bindings(queue)]
+        try:
+            exchange, routing_key, _ = self.state.bindings[queue]
+        except KeyError:
+            return []
+        return [(exchange, routing_key)]
+
+    def topic_destination(self, exchange, routing_key=None):
+        """Return the STOMP topic of an exchange.
+
+        It's ``/topic/<prefix><exchange>``, or
+        ``/topic/VirtualTopic.<prefix><exchange>`` with the
+        ``virtual_topics`` transport option, followed by ``.<routing_key>``
+        for topic exchanges.
+        """
+        name = self.prefix + exchange
+        if routing_key:
+            name = '{0}.{1}'.format(name, routing_key)
+        if self.virtual_topics:
+            name = 'VirtualTopic.' + name
+        return '/topic/' + name
+
+    def subscription_destination(self, queue):
+        """Return the destination consumed for ``queue``.
+
+        It's the queue destination, unless the queue is bound to a topic (see
+        :py:meth:`topic`). Then every queue gets a copy of the messages
+        published to the topic: subscribing to it, or to the queue ActiveMQ
+        makes for the queue with ``virtual_topics``, which keeps messages
+        while there are no consumers and shares them among consumers.
+        """
+        topic = self.topic(queue)
+        if topic is None:
+            return self.queue_destination(queue)
+        exchange, routing_key = topic
+        if routing_key:
+            # ActiveMQ wildcard for zero or more words
+            routing_key = '.'.join('>' if word == '#' else word
+                                   for word in routing_key.split('.'))
+        destination = self.topic_destination(exchange, routing_key)
+        if not self.virtual_topics:
+            return destination
+        # dots would split the consumer name in ActiveMQ consumer queues
+        return '/queue/Consumer.{0}.{1}'.format(
+            queue.replace('.', '_'), destination[len('/topic/'):])
+
     @contextlib.contextmanager
     def conn_or_acquire(self, disconnect=False):
         """Use current connection or create a new one."""
         if not self.stomp_conn.is_connected():
-            self.stomp_conn.start()
-            self.stomp_conn.connect(**self._get_conn_params())
+            self.qos.discard_stale()
+            if self._connected:
+                self._failover()
+            else:
+                self._stomp_conn = self._open(self.stomp_conn)
+                self._connected = True
 
         yield self.stomp_conn
 
@@ -121,6 +946,221 @@ class Channel(virtual.Channel):
             self.stomp_conn.disconnect()
             self.iterator = None
 
+    def _failover(self):
+        """Replace the lost channel connection and resubscribe.
+
+        A new connection is made, so brokers are tried in the current
+        :py:meth:`sort_brokers` order, and messages buffered by the lost one
+        are dropped, since the broker redelivers them.
+        """
+        start = monotonic()
+        lost = self._stomp_conn
+        lost.transport.disconnect_socket()
+        lost.message_listener.close()
+
+        self._stomp_conn = self._open(self._new_channel_conn())
+        self._resubscribe()
+        self._recovered(start)
+
+    def _resubscribe(self):
+        """Subscribe the channel connection to the queues being consumed.
+
+        Subscriptions are made again from scratch, so they get the current
+        ack mode and prefetch count.
+        """
+        self._prefetch_changed = False
+        subscriptions, self._subscriptions = self._subscriptions, set()
+        for queue in subscriptions:
+            self.subscribe(self._stomp_conn, queue)
+
+    def _recovered(self, start):
+        """Report a failover, the lost connection was noticed at ``start``.
+
+        It sets :py:attr:`failover_time`, emits the failover metrics and
+        calls the ``reconnect_callback`` transport option with the channel.
+        """
+        self.failover_time = monotonic() - start
+        if self.metrics.enabled:
+            self.metrics.increment('kombu_stomp_reconnects_total')
+            self.metrics.observe('kombu_stomp_failover_seconds',
+                                 self.failover_time)
+        if self.reconnect_callback is not None:
+            self.reconnect_callback(self)
+
+    @contextlib.contextmanager
+    def publisher_conn(self):
+        """Connection for publishing.
+
+        A connection from the transport publisher pool if there is one,
+        otherwise the channel connection. Within a transaction it's always
+        the channel connection, since STOMP transactions belong to a
+        connection.
+        """
+        batch_conn = getattr(self._local, 'batch_conn', None)
+        pool = self.connection.publisher_pool
+        if self.qos.transaction is not None:
+            with self.conn_or_acquire() as conn:
+                yield conn
+        elif batch_conn is not None:
+            yield batch_conn
+        elif pool is None:
+            with self.conn_or_acquire() as conn:
+                yield conn
+        else:
+            with pool.acquire(self._new_publisher_conn) as conn:
+                yield conn
+
+    @contextlib.contextmanager
+    def publish_batch(self):
+        """Context manager grouping a burst of published messages.
+
+        Messages published by this thread within the block are buffered and
+        written at once when leaving it, or earlier if the
+        ``publish_batch_size`` or ``publish_batch_bytes`` limits are hit.
+        Nested blocks join the outermost one.
+        """
+        outer_conn = getattr(self._local, 'batch_conn', None)
+        with self.publisher_conn() as conn:
+            batching = conn.batching
+            if not batching:
+                conn.begin_batch(self.publish_batch_size or None,
+                                 self.publish_batch_bytes)
+            self._local.batch_conn = conn
+            try:
+                yield
+            finally:
+                self._local.batch_conn = outer_conn
+                if conn is outer_conn:
+                    # written when leaving the outermost block
+                    pass
+                elif batching:
+                    conn.flush()
+                else:
+                    conn.end_batch()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager running a STOMP transaction.
+
+        Messages published and acknowledged through this channel within the
+        block are committed at once when leaving it, or aborted if an
+        exception is raised, e.g. for consuming and publishing atomically::
+
+            with channel.transaction():
+                producer.publish(result)
+                message.ack()
+
+        It yields the transaction ID.
+        """
+        with self.conn_or_acquire() as conn:
+            transaction = conn.begin()
+            self.qos.begin_transaction(transaction)
+            succeeded = False
+            try:
+                yield transaction
+                succeeded = True
+            finally:
+                # aborted on any exception, including KeyboardInterrupt
+                self.qos.end_transaction(commit=succeeded)
+                if succeeded:
+                    conn.commit(transaction)
+                else:
+                    conn.abort(transaction)
+
+    def _new_stomp_conn(self, **kwargs):
+        params = dict(self._get_params(), metrics=self.metrics)
+        params.update(kwargs)
+        conn = stomp.Connection(self.prefix,
+                                version=self.stomp_version,
+                                heartbeats=tuple(self.heartbeats),
+                                **params)
+        if self.publish_batch_size > 1:
+            conn.begin_batch(self.publish_batch_size,
+                             self.publish_batch_bytes,
+                             self.publish_batch_interval)
+        return conn
+
+    def _new_channel_conn(self):
+        if self.shared_connection:
+            return SharedConnection(stomp.MessageListener(
+                prefix=self.prefix,
+                q=stomp.ReceiveBuffer(self.receive_buffer_size,
+                                      self.receive_buffer_bytes,
+                                      self.queue_weights),
+                waker=self.connection.waker,
+                metrics=self.metrics,
+                decode_workers=self.decode_workers,
+            ))
+        return self._new_stomp_conn(waker=self.connection.waker,
+                                    buffer_size=self.receive_buffer_size,
+                                    buffer_bytes=self.receive_buffer_bytes,
+                                    queue_weights=self.queue_weights,
+                                    decode_workers=self.decode_workers)
+
+    def _new_publisher_conn(self):
+        return self._connect(self._new_stomp_conn(), self._new_stomp_conn)
+
+    def _open(self, conn):
+        """Connect the channel connection ``conn`` and return it."""
+        if isinstance(conn, SharedConnection):
+            conn.attach(self.connection, self)
+            # the one negotiated by the channel connecting it
+            self.stomp_version = conn.version
+            return conn
+        return self._connect(conn, self._new_channel_conn)
+
+    def _connect(self, conn, create):
+        """Connect ``conn`` to the broker and return it.
+
+        If the broker accepts an older STOMP version than ``stomp_version``,
+        a connection for that version is returned instead, made with
+        ``create``, and it's the version used from then on.
+
+        The time the broker took to answer CONNECT is recorded, see
+        :py:meth:`sort_brokers`.
+        """
+        brokers = self.sort_brokers(self.brokers)
+        try:
+            conn.start()
+            start = monotonic()
+            try:
+                conn.connect(**self._get_conn_params())
+            except stomp.VersionMismatch as e:
+                self.stomp_version = e.version
+                conn = create()
+                conn.start()
+                start = monotonic()
+                conn.connect(**self._get_conn_params())
+        except exc.ConnectFailedException:
+            for broker in brokers:
+                self.connection.broker_latency[broker] = FAILED
+            raise
+
+        broker = conn.transport.current_host_and_port
+        if broker in brokers:
+            # the ones tried before failed
+            for failed in brokers[:brokers.index(broker)]:
+                self.connection.broker_latency[failed] = FAILED
+        self.connection.broker_latency[broker] = monotonic() - start
+        return conn
+
+    def sort_brokers(self, brokers):
+        """Return ``brokers`` in the order they should be tried.
+
+        Brokers that answered fastest last time we connected to them go
+        first, then the ones never tried, in the configured order, and
+        finally the ones we failed to connect to.
+        """
+        latencies = self.connection.broker_latency
+
+        def rank(broker):
+            latency = latencies.get(broker)
+            if latency is None:
+                return 1, 0
+            return (2 if latency == FAILED else 0), latency
+
+        return sorted(brokers, key=rank)
+
     @property
     def stomp_conn(self):
         """Property over the stomp.py connection object.
@@ -128,8 +1168,7 @@ class Channel(virtual.Channel):
         It will create the connection object at first use.
         """
         if not self._stomp_conn:
-            self._stomp_conn = stomp.Connection(self.prefix,
-                                                **self._get_params())
+            self._stomp_conn = self._new_channel_conn()
 
         return self._stomp_conn
 
@@ -137,17 +1176,180 @@ class Channel(virtual.Channel):
     def transport_options(self):
         return self.connection.client.transport_options
 
+    @utils.cached_property
+    def brokers(self):
+        """Brokers to connect to, as a list of ``(host, port)`` tuples.
+
+        Those are the connection URL broker, the alternate URLs given to
+        Kombu, e.g. ``stomp://a:61613;stomp://b:61613``, and the ``failover``
+        transport option ones, either ``'host:port'`` strings or tuples.
+        """
+        client = self.connection.client
+        brokers = [(client.hostname, client.port)]
+        for alt in client.alt:
+            parts = url.parse_url(alt)
+            brokers.append((parts['hostname'], parts['port']))
+        for broker in self.transport_options.get('failover', ()):
+            if isinstance(broker, six.string_types):
+                host, _, port = broker.rpartition(':')
+                broker = (host, int(port)) if host else (port, None)
+            brokers.append(tuple(broker))
+
+        result = []
+        for host, port in brokers:
+            broker = (host or '127.0.0.1', int(port or 61613))
+            if broker not in result:
+                result.append(broker)
+        return result
+
+    @utils.cached_property
+    def metrics(self):
+        """Transport metrics, labelled with the channel ID."""
+        return self.connection.metrics.labels(channel=self.channel_id)
+
+    @utils.cached_property
+    def publish_timestamps(self):
+        return self.transport_options.get('publish_timestamps', True)
+
+    @utils.cached_property
+    def trace_callback(self):
+        return self.transport_options.get('trace_callback')
+
+    @utils.cached_property
+    def reconnect_callback(self):
+        return self.transport_options.get('reconnect_callback')
+
     @utils.cached_property
     def prefix(self):
         return self.transport_options.get('queue_name_prefix', '')
 
+    @utils.cached_property
+    def stomp_version(self):
+        return self.transport_options.get('stomp_version', '1.2')
+
+    @utils.cached_property
+    def heartbeats(self):
+        return self.transport_options.get('heartbeats', (10000, 10000))
+
+    @utils.cached_property
+    def prefetch_header(self):
+        return self.transport_options.get('prefetch_header',
+                                          'activemq.prefetchSize')
+
+    @utils.cached_property
+    def receive_buffer_size(self):
+        return self.transport_options.get('receive_buffer_size', 1000)
+
+    @utils.cached_property
+    def receive_buffer_bytes(self):
+        return self.transport_options.get('receive_buffer_bytes', 1 << 25)
+
+    @utils.cached_property
+    def queue_weights(self):
+        return self.transport_options.get('queue_weights', {})
+
+    @utils.cached_property
+    def decode_workers(self):
+        return self.transport_options.get('decode_workers', 0)
+
+    @utils.cached_property
+    def selectors(self):
+        return self.transport_options.get('selectors', {})
+
+    @utils.cached_property
+    def filter_headers(self):
+        return self.transport_options.get('filter_headers', ())
+
+    @utils.cached_property
+    def json_headers(self):
+        return self.transport_options.get('json_headers', True)
+
+    @utils.cached_property
+    def topic_exchanges(self):
+        return self.transport_options.get('topic_exchanges', False)
+
+    @utils.cached_property
+    def virtual_topics(self):
+        return self.transport_options.get('virtual_topics', False)
+
+    @utils.cached_property
+    def shared_connection(self):
+        return self.transport_options.get('shared_connection', False)
+
+    @utils.cached_property
+    def body_encoding(self):
+        # None sends bodies as raw bytes, delimited by content-length
+        return self.transport_options.get('body_encoding', 'base64')
+
+    @utils.cached_property
+    def compression(self):
+        return self.transport_options.get('compression')
+
+    @utils.cached_property
+    def compression_threshold(self):
+        return self.transport_options.get('compression_threshold', 1024)
+
+    @utils.cached_property
+    def consume_timeout(self):
+        return self.transport_options.get('consume_timeout', 1.0)
+
+    @utils.cached_property
+    def ack_mode(self):
+        return self.transport_options.get('ack_mode', 'client-individual')
+
+    @utils.cached_property
+    def ack_batch_size(self):
+        return self.transport_options.get('ack_batch_size', 1)
+
+    @utils.cached_property
+    def ack_flush_interval(self):
+        return self.transport_options.get('ack_flush_interval', 1.0)
+
+    @utils.cached_property
+    def publish_batch_size(self):
+        return self.transport_options.get('publish_batch_size', 0)
+
+    @utils.cached_property
+    def publish_batch_bytes(self):
+        return self.transport_options.get('publish_batch_bytes', 1 << 16)
+
+    @utils.cached_property
+    def publish_batch_interval(self):
+        return self.transport_options.get('publish_batch_interval', 0.01)
+
+    @utils.cached_property
+    def reconnect_attempts(self):
+        return self.transport_options.get('reconnect_attempts', 1)
+
+    @utils.cached_property
+    def reconnect_delay(self):
+        return self.transport_options.get('reconnect_delay', 0.1)
+
+    @utils.cached_property
+    def reconnect_delay_max(self):
+        return self.transport_options.get('reconnect_delay_max', 60.0)
+
+    @utils.cached_property
+    def reconnect_backoff(self):
+        return self.transport_options.get('reconnect_backoff', 0.5)
+
+    @utils.cached_property
+    def reconnect_jitter(self):
+        return self.transport_options.get('reconnect_jitter', 0.1)
+
     def _get_params(self):
+        brokers = self.sort_brokers(self.brokers)
+        attempts = self.reconnect_attempts
         return {
-            'host_and_ports': [
-                (self.connection.client.hostname or '127.0.0.1',
-                 self.connection.client.port or 61613)
-            ],
-            'reconnect_attempts_max': 1,
+            'host_and_ports': brokers,
+            # stomp.py counts every broker failing, we count rounds over all
+            'reconnect_attempts_max': (
+                attempts * len(brokers) if attempts >= 0 else -1
+            ),
+            'reconnect_sleep_initial': self.reconnect_delay,
+            'reconnect_sleep_increase': self.reconnect_backoff,
+            'reconnect_sleep_jitter': self.reconnect_jitter,
+            'reconnect_sleep_max': self.reconnect_delay_max,
         }
 
     def _get_conn_params(self):
@@ -157,15 +1359,203 @@ class Channel(virtual.Channel):
             'wait': True,
         }
 
+    def has_pending(self):
+        """Whether received messages are ready for being delivered now."""
+        return bool(self._stomp_conn and
+                    self._consumers and
+                    self.qos.can_consume() and
+                    self._stomp_conn.message_listener.qsize(
+                        self._active_queues))
+
+    def buffer_stats(self):
+        """Return the messages received but not consumed yet.
+
+        :return dict: number of ``messages`` and their body ``bytes``.
+        """
+        if not self._stomp_conn:
+            return {'messages': 0, 'bytes': 0}
+
+        listener = self._stomp_conn.message_listener
+        return {'messages': listener.qsize(),
+                'bytes': listener.buffered_bytes()}
+
     def close(self):
+        if self._stomp_conn and self._stomp_conn.is_connected():
+            self.qos.flush_acks()
         super(Channel, self).close()
         try:
             # TODO (rafaduran): do we need unsubscribe all queues first?
             self.stomp_conn.disconnect()
         except exc.NotConnectedException:
             pass
+        # the broker redelivers them, and the receiver thread may be waiting
+        # for room
+        self.stomp_conn.message_listener.close()
 
 
 class Transport(virtual.Transport):
     """Transport class for ``kombu-stomp``."""
     Channel = Channel
+
+    # drain_events() waits for messages, so no sleep between empty polls
+    polling_interval = None
+    supports_ev = True
+
+    def __init__(self, client, *args, **kwargs):
+        super(Transport, self).__init__(client, *args, **kwargs)
+        self._waker = None
+        # (host, port) -> seconds the broker took to answer CONNECT last time,
+        # or FAILED, shared by all channels
+        self.broker_latency = {}
+        #: :py:class:`kombu_stomp.metrics.Metrics` given as the ``metrics``
+        #: transport option, they do nothing by default
+        self.metrics = (client.transport_options.get('metrics') or
+                        _metrics.Metrics())
+        pool_size = client.transport_options.get('publisher_pool_size', 0)
+        self.publisher_pool = ConnectionPool(pool_size) if pool_size else None
+        self._shared_conn = None
+        self._shared_lock = threading.Lock()
+        #: seconds :py:meth:`drain_events` waits at most before draining
+        #: the channels again
+        self.consume_timeout = client.transport_options.get(
+            'consume_timeout', 1.0)
+        # index of the channel drained first next time, see _deliver_next()
+        self._turn = 0
+        # whether drain_events() waits for a wake up, see notify()
+        self._waiting = False
+
+    def shared_conn(self, channel):
+        """Return the STOMP connection shared by the channels, see
+        :py:class:`SharedConnection`.
+
+        If it isn't connected, it's replaced by a new one, connected with
+        the ``channel`` settings. Channels attached to the lost one notice it
+        and attach to the new one, like after a failover.
+        """
+        with self._shared_lock:
+            conn = self._shared_conn
+            if conn is None or not conn.is_connected():
+                if conn is not None:
+                    conn.transport.disconnect_socket()
+                create = functools.partial(channel._new_stomp_conn,
+                                           waker=self.waker,
+                                           metrics=self.metrics)
+                conn = self._shared_conn = channel._connect(create(), create)
+                # only routed messages are received
+                conn.message_listener.routes = {}
+            return conn
+
+    @property
+    def waker(self):
+        """:py:class:`kombu_stomp.stomp.Waker` shared by all channels.
+
+        Receiver threads use it for waking up the event loop on new messages.
+        """
+        if self._waker is None:
+            self._waker = stomp.Waker()
+
+        return self._waker
+
+    def register_with_event_loop(self, connection, loop):
+        fd = self.waker.fileno()
+        loop.add_reader(fd, self.on_readable, fd)
+        loop.on_tick.add(self.on_tick)
+
+    def drain_events(self, connection, timeout=None):
+        """Deliver the next message received by any channel.
+
+        Channels take turns and are drained without blocking, so an idle
+        channel doesn't hold back the rest. When none has a message it can
+        deliver, it waits for the receiver threads to wake it up (see
+        :py:attr:`waker`), or for :py:meth:`notify`, up to ``timeout``
+        seconds in all, and ``consume_timeout`` seconds before draining the
+        channels again.
+
+        :raises: :py:exc:`socket.timeout` if no message was delivered in
+            time.
+        """
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        waker = self.waker
+        while True:
+            # before draining the channels, so no wake up is missed
+            waker.drain()
+            if self._deliver_next():
+                return
+            wait = self.consume_timeout
+            if timeout is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                wait = min(wait, remaining)
+            self._waiting = True
+            try:
+                # unless acknowledgements made room meanwhile
+                if not any(channel.has_pending() for channel in self.channels):
+                    waker.wait(wait)
+            finally:
+                self._waiting = False
+
+    def notify(self):
+        """Wake up :py:meth:`drain_events` waiting in another thread, since
+        a channel may deliver messages now, e.g. after an acknowledgement
+        made room within the prefetch limit.
+        """
+        if self._waiting:
+            self.waker.wake()
+
+    def _deliver_next(self):
+        """Deliver a message of the next channel having one, without
+        blocking.
+
+        :return: whether a message was delivered.
+        """
+        channels = list(self.channels)
+        for i in range(len(channels)):
+            channel = channels[(self._turn + i) % len(channels)]
+            try:
+                message, queue = channel.drain_events(timeout=0)
+            except _queue.Empty:
+                continue
+            self._turn = (self._turn + i + 1) % len(channels)
+            if not queue or queue not in self._callbacks:
+                raise KeyError(
+                    'Message for queue {0!r} without consumers: {1}'.format(
+                        queue, message))
+            self._callbacks[queue](message)
+            return True
+        return False
+
+    def on_readable(self, fileno):
+        """Deliver all the messages received since last wake up."""
+        self.waker.drain()
+        while self._deliver_next():
+            pass
+
+    def on_tick(self):
+        """Wake up the event loop for messages held back by prefetch limits.
+
+        Those messages were left in the buffer by :py:meth:`on_readable`, so
+        there will be no more wake ups for them unless we do it here. Buffered
+        acknowledgements are flushed too.
+        """
+        if any(channel.has_pending() for channel in self.channels):
+            self.waker.wake()
+
+        # acks done during this loop iteration are sent together
+        for channel in self.channels:
+            channel.qos.flush_acks()
+
+    def close_connection(self, connection):
+        super(Transport, self).close_connection(connection)
+        if self.publisher_pool is not None:
+            self.publisher_pool.close()
+        if self._shared_conn is not None:
+            try:
+                self._shared_conn.disconnect()
+            except exc.NotConnectedException:
+                pass
+            self._shared_conn = None
+        if self._waker is not None:
+            self._waker.close()
+            self._waker = None
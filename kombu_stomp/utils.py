@@ -7,3 +7,13 @@ try:
     from unittest import mock
 except ImportError:
     import mock  # noqa
+
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic  # noqa
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping  # noqa
@@ -0,0 +1,389 @@
+import asyncio
+import socket
+
+import kombu
+from stomp import exception as exc
+
+from kombu_stomp import aio
+from kombu_stomp import aiotesting
+from kombu_stomp import metrics
+from kombu_stomp import stomp
+from kombu_stomp.utils import unittest
+
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coro, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+
+class FrameReaderTests(AsyncTestCase):
+    def read(self, data, version='1.0'):
+        stream = asyncio.StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        return self.run_async(aio.FrameReader(stream, version).read())
+
+    def test_read(self):
+        frame = self.read(b'MESSAGE\ndestination:/queue/a\n\nbody\x00')
+        self.assertEqual(frame,
+                         ('MESSAGE', {'destination': '/queue/a'}, b'body'))
+
+    def test_read__content_length(self):
+        frame = self.read(b'MESSAGE\ncontent-length:3\n\na\x00b\x00')
+        self.assertEqual(frame.body, b'a\x00b')
+
+    def test_read__heartbeats_and_crlf(self):
+        frame = self.read(b'\n\r\nRECEIPT\r\nreceipt-id:1\r\n\r\n\x00')
+        self.assertEqual(frame, ('RECEIPT', {'receipt-id': '1'}, b''))
+
+    def test_read__unescape(self):
+        frame = self.read(stomp.encode_frame('MESSAGE', {'key': 'a:b\n'},
+                                             version='1.2'),
+                          version='1.2')
+        self.assertEqual(frame.headers, {'key': 'a:b\n'})
+
+    def test_read__repeated_header(self):
+        frame = self.read(b'MESSAGE\nkey:a\nkey:b\n\n\x00')
+        self.assertEqual(frame.headers, {'key': 'a'})
+
+    def test_read__closed(self):
+        with self.assertRaises(exc.ConnectionClosedException):
+            self.read(b'MESSAGE\nkey:a\n\nbo')
+
+    def test_read__eof(self):
+        with self.assertRaises(exc.ConnectionClosedException):
+            self.read(b'\n')
+
+
+class ConnectionTests(AsyncTestCase):
+    def setUp(self):
+        super(ConnectionTests, self).setUp()
+        self.broker = self.run_async(aiotesting.Broker().start())
+        self.addCleanup(self.run_async, self.broker.stop())
+
+    def connect(self, **kwargs):
+        conn = aio.Connection(host_and_ports=[self.broker.host_and_port],
+                              **kwargs)
+        self.run_async(conn.connect())
+        self.addCleanup(self.disconnect, conn)
+        return conn
+
+    def disconnect(self, conn):
+        if conn.is_connected():
+            conn.disconnect()
+            # let the tasks be cancelled
+            self.run_async(asyncio.sleep(0))
+
+    def test_connect(self):
+        conn = self.connect()
+
+        self.assertTrue(conn.is_connected())
+        self.assertEqual(conn.version, '1.2')
+        self.assertEqual(conn.broker, self.broker.host_and_port)
+        self.assertEqual(conn.message_listener.broker, conn.broker)
+        self.assertIsNotNone(conn.latency)
+
+    def test_connect__older_broker(self):
+        self.broker.versions = ('1.0', '1.1')
+
+        self.assertEqual(self.connect().version, '1.1')
+
+    def test_connect__failover(self):
+        down = socket.socket()
+        down.bind(('127.0.0.1', 0))
+        down_address = down.getsockname()
+        down.close()
+
+        conn = aio.Connection(host_and_ports=[down_address,
+                                              self.broker.host_and_port])
+        self.run_async(conn.connect())
+        self.addCleanup(conn.disconnect)
+
+        self.assertEqual(conn.failed, [down_address])
+        self.assertEqual(conn.broker, self.broker.host_and_port)
+
+    def test_connect__failed(self):
+        self.broker.versions = ('1.0',)
+        conn = aio.Connection(host_and_ports=[self.broker.host_and_port],
+                              version='1.2')
+        # refused by brokers speaking no version we accept
+        self.broker.versions = ()
+
+        with self.assertRaises(exc.ConnectFailedException):
+            self.run_async(conn.connect())
+        self.assertFalse(conn.is_connected())
+
+    def test_send_and_get(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', id='/queue/a', ack='client-individual')
+        conn.send('/queue/a', b'body', headers={'kombu-format': '1'})
+        self.run_async(conn.drain())
+
+        (message, msg_id, queue, trace), key = self.run_async(conn.get())
+
+        self.assertEqual((queue, key), ('a', 'a'))
+        self.assertEqual(message['body'], b'body')
+        self.assertEqual(trace['broker'], self.broker.host_and_port)
+        conn.ack(msg_id)
+        self.run_async(conn.drain())
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['ACK'], 1)
+
+    def test_get__timeout(self):
+        conn = self.connect()
+
+        with self.assertRaises(stomp.queue.Empty):
+            self.run_async(conn.get(timeout=0.01))
+
+    def test_get__disconnected(self):
+        conn = self.connect()
+        self.run_async(self.broker.stop())
+        self.addCleanup(self.run_async, self.broker.start())
+
+        with self.assertRaises(exc.NotConnectedException):
+            self.run_async(conn.get())
+        self.assertFalse(conn.is_connected())
+
+    def test_backpressure(self):
+        conn = self.connect(buffer_size=1)
+        conn.subscribe('/queue/a', id='/queue/a', ack='auto')
+        for i in range(3):
+            conn.send('/queue/a', str(i))
+        self.run_async(conn.drain())
+        self.run_async(asyncio.sleep(0.05))
+
+        # the reader waits for room, leaving the rest in the socket
+        self.assertEqual(conn.message_listener.qsize(), 1)
+        bodies = [self.run_async(conn.get())[0][0]['body']
+                  for _ in range(3)]
+        self.assertEqual(bodies, [b'0', b'1', b'2'])
+
+    def test_backpressure__heartbeats(self):
+        self.broker.heartbeats = (50, 0)
+        self.broker.send_heartbeats = True
+        conn = self.connect(buffer_size=1, heartbeats=(0, 50))
+        conn.subscribe('/queue/a', id='/queue/a', ack='auto')
+        for i in range(3):
+            conn.send('/queue/a', str(i))
+        self.run_async(conn.drain())
+
+        # heart-beats aren't read while waiting for room
+        self.run_async(asyncio.sleep(0.3))
+        self.assertTrue(conn.is_connected())
+        bodies = [self.run_async(conn.get())[0][0]['body']
+                  for _ in range(3)]
+        self.assertEqual(bodies, [b'0', b'1', b'2'])
+
+    def test_batch(self):
+        conn = self.connect()
+        conn.begin_batch(max_frames=2)
+        conn.send('/queue/a', 'a')
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['SEND'], 0)
+
+        conn.send('/queue/a', 'b')
+        self.run_async(conn.drain())
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['SEND'], 2)
+
+    def test_transaction(self):
+        conn = self.connect()
+        transaction = conn.begin()
+        conn.send('/queue/a', 'a', transaction=transaction)
+        self.run_async(conn.drain())
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.qsize('/queue/a'), 0)
+
+        conn.commit(transaction)
+        self.run_async(conn.drain())
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.qsize('/queue/a'), 1)
+
+    def test_heartbeat_timeout(self):
+        # the broker offers heart-beats it never sends
+        self.broker.heartbeats = (10, 0)
+        conn = self.connect(heartbeats=(0, 10))
+
+        self.run_async(asyncio.sleep(0.1))
+        self.assertFalse(conn.is_connected())
+
+
+class TransportTests(AsyncTestCase):
+    """End to end tests, going through Kombu and the asyncio transport."""
+    def setUp(self):
+        super(TransportTests, self).setUp()
+        self.broker = self.run_async(aiotesting.Broker().start())
+        self.addCleanup(self.run_async, self.broker.stop())
+        self.conn = kombu.Connection(
+            'stomp://{0}:{1}'.format(*self.broker.host_and_port),
+            transport=aio.Transport,
+        )
+        self.addCleanup(self.conn.release)
+        self.queue = kombu.Queue('queue', routing_key='queue')
+
+    def connect(self):
+        channel = self.run_async(aio.connect(self.conn))
+        self.addCleanup(channel.close)
+        return channel
+
+    def test_publish_and_consume(self):
+        channel = self.connect()
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.headers))
+            message.ack()
+
+        self.run_async(channel.publish({'hello': 'world'},
+                                       routing_key='queue',
+                                       headers={'task': 'add'}))
+        with kombu.Consumer(channel, [self.queue], callbacks=[callback]):
+            self.run_async(channel.drain_events(timeout=5))
+            self.run_async(channel.flush())
+
+        self.assertEqual(received, [({'hello': 'world'}, {'task': 'add'})])
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['ACK'], 1)
+
+    def test_producer(self):
+        channel = self.connect()
+
+        kombu.Producer(channel).publish('hello', routing_key='queue')
+        self.run_async(channel.flush())
+
+        message = self.run_async(channel.get('queue', timeout=5))
+        self.assertEqual(message.payload, 'hello')
+        self.run_async(channel.ack(message))
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['ACK'], 1)
+
+    def test_drain_events__timeout(self):
+        channel = self.connect()
+
+        with kombu.Consumer(channel, [self.queue]):
+            with self.assertRaises(socket.timeout):
+                self.run_async(channel.drain_events(timeout=0.01))
+
+    def test_prefetch_count(self):
+        channel = self.connect()
+        messages = []
+        consumer = kombu.Consumer(
+            channel,
+            [self.queue],
+            callbacks=[lambda body, message: messages.append(message)],
+        )
+        consumer.qos(prefetch_count=1)
+        for i in range(2):
+            self.run_async(channel.publish(i, routing_key='queue'))
+
+        async def consume():
+            await channel.drain_events(timeout=5)
+            # waits for the first message to be acked
+            drained = self.loop.create_task(channel.drain_events(timeout=5))
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(messages), 1)
+            messages[0].ack()
+            await drained
+
+        with consumer:
+            self.run_async(consume())
+
+        self.assertEqual([m.payload for m in messages], [0, 1])
+
+    def test_stomp_1_1(self):
+        self.conn.transport_options['stomp_version'] = '1.1'
+        channel = self.connect()
+
+        self.run_async(channel.publish('hello', routing_key='queue'))
+        message = self.run_async(channel.get('queue', timeout=5))
+        self.run_async(channel.ack(message))
+
+        self.assertEqual(channel.stomp_conn.version, '1.1')
+        self.run_async(asyncio.sleep(0.01))
+        self.assertEqual(self.broker.stats['ACK'], 1)
+
+    def test_metrics(self):
+        self.conn.transport_options['metrics'] = metrics.InMemoryMetrics()
+        channel = self.connect()
+
+        self.run_async(channel.publish('hello', routing_key='queue'))
+        self.run_async(channel.get('queue', no_ack=True, timeout=5))
+
+        m = self.conn.transport_options['metrics']
+        labels = {'channel': channel.channel_id}
+        self.assertEqual(
+            m.get('kombu_stomp_frames_sent_total', command='SEND', **labels),
+            1,
+        )
+        self.assertEqual(m.get('kombu_stomp_frames_received_total',
+                               command='MESSAGE', **labels), 1)
+
+    def test_failover(self):
+        standby = self.run_async(aiotesting.Broker().start())
+        self.addCleanup(self.run_async, standby.stop())
+        self.conn.transport_options['failover'] = [standby.host_and_port]
+        channel = self.connect()
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        with kombu.Consumer(channel, [self.queue], callbacks=[callback]):
+            self.run_async(self.broker.stop())
+            self.addCleanup(self.run_async, self.broker.start())
+            # noticed while waiting, then resubscribed to the standby
+            with self.assertRaises(socket.timeout):
+                self.run_async(channel.drain_events(timeout=0.1))
+            self.assertEqual(channel.stomp_conn.broker, standby.host_and_port)
+            self.assertIsNotNone(channel.failover_time)
+
+            self.run_async(channel.publish('hello', routing_key='queue'))
+            self.run_async(channel.drain_events(timeout=5))
+
+        self.assertEqual(received, ['hello'])
+        self.assertEqual(
+            self.conn.transport.broker_latency[self.broker.host_and_port],
+            aio.transport.FAILED,
+        )
+
+    def test_connect__failed(self):
+        self.run_async(self.broker.stop())
+        self.addCleanup(self.run_async, self.broker.start())
+        self.conn.transport_options.update(reconnect_attempts=2,
+                                           reconnect_delay=0.01)
+
+        with self.assertRaises(exc.ConnectFailedException):
+            self.run_async(aio.connect(self.conn))
+
+    def test_sync_drain_events(self):
+        channel = self.conn.default_channel
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        self.run_async(channel.publish('hello', routing_key='queue'))
+        with kombu.Consumer(channel, [self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+            with self.assertRaises(socket.timeout):
+                self.conn.drain_events(timeout=0.01)
+
+        self.assertEqual(received, ['hello'])
+
+    def test_sync_drain_events__no_channels(self):
+        with self.assertRaises(socket.timeout):
+            self.conn.drain_events(timeout=0.01)
+
+    def test_sync_drain_events__loop_running(self):
+        async def drain():
+            self.conn.drain_events(timeout=0.01)
+
+        with self.assertRaises(RuntimeError):
+            self.run_async(drain())
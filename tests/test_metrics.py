@@ -0,0 +1,67 @@
+from kombu_stomp import metrics
+from kombu_stomp.utils import unittest
+
+
+class MetricsTests(unittest.TestCase):
+    def test_disabled(self):
+        m = metrics.Metrics()
+        self.assertFalse(m.enabled)
+        self.assertIs(m.labels(channel=1), m)
+        m.increment('counter')
+        m.gauge('gauge', 1)
+        m.observe('histogram', 1)
+
+
+class InMemoryMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.InMemoryMetrics(buckets=(0.1, 1.0))
+
+    def test_increment(self):
+        self.metrics.increment('frames', command='SEND')
+        self.metrics.increment('frames', 2, command='SEND')
+        self.metrics.increment('frames', command='ACK')
+
+        self.assertEqual(self.metrics.get('frames', command='SEND'), 3)
+        self.assertEqual(self.metrics.get('frames', command='ACK'), 1)
+        self.assertIsNone(self.metrics.get('frames'))
+
+    def test_gauge(self):
+        self.metrics.gauge('size', 3)
+        self.metrics.gauge('size', 1)
+
+        self.assertEqual(self.metrics.get('size'), 1)
+
+    def test_observe(self):
+        self.metrics.observe('latency', 0.5)
+        self.metrics.observe('latency', 2)
+
+        self.assertEqual(self.metrics.get('latency'), (2, 2.5))
+
+    def test_labels(self):
+        labelled = self.metrics.labels(channel=1).labels(queue='a')
+        labelled.increment('frames', command='SEND')
+
+        self.assertEqual(
+            self.metrics.get('frames', channel=1, queue='a', command='SEND'),
+            1,
+        )
+
+    def test_render(self):
+        self.metrics.increment('frames', command='SEND')
+        self.metrics.gauge('size', 3, queue='a"b')
+        self.metrics.observe('latency', 0.05)
+        self.metrics.observe('latency', 0.5)
+        self.metrics.observe('latency', 5)
+
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# TYPE frames counter',
+            'frames{command="SEND"} 1',
+            '# TYPE size gauge',
+            'size{queue="a\\"b"} 3',
+            '# TYPE latency histogram',
+            'latency_bucket{le="0.1"} 1',
+            'latency_bucket{le="1.0"} 2',
+            'latency_bucket{le="+Inf"} 3',
+            'latency_sum 5.55',
+            'latency_count 3',
+        ]) + '\n')
@@ -1,5 +1,12 @@
+import ast
+import json
+import select
+import threading
+import time
+
 from six.moves import queue
 
+from kombu_stomp import metrics
 from kombu_stomp import stomp
 from kombu_stomp.utils import mock
 from kombu_stomp.utils import unittest
@@ -38,10 +45,10 @@ class MessageListenerTests(ListenerTestCase):
         self.body = 'eyJoZWxsbyI6ICJ3b3JsZCJ9'
         self.maxDiff = None
 
-    @mock.patch('six.moves.queue.Queue')
-    def test_default_queue(self, Queue):
-        stomp.MessageListener()
-        Queue.assert_called_once_with()
+    def test_default_queue(self):
+        listener = stomp.MessageListener()
+        self.assertIsInstance(listener.q, stomp.ReceiveBuffer)
+        self.assertFalse(listener.q.maxsize)
 
     def test_on_message__transforms_the_message_to_kombu_format(self):
         with mock.patch.object(self.listener, 'to_kombu_message') as tokm:
@@ -51,7 +58,199 @@ class MessageListenerTests(ListenerTestCase):
     def test_on_message__puts_to_the_queue(self):
         with mock.patch.object(self.listener, 'to_kombu_message') as tokm:
             self.listener.on_message(self.headers, self.body)
-        self.queue.put.assert_called_once_with(tokm.return_value)
+        self.queue.put.assert_called_once_with(tokm.return_value,
+                                               len(self.body),
+                                               tokm.return_value[1],
+                                               keepalive=None,
+                                               interval=None,
+                                               block=True)
+
+    def test_on_message__keepalive(self):
+        keepalive = mock.Mock()
+        self.listener.set_keepalive(keepalive, 0.5)
+
+        with mock.patch.object(self.listener, 'to_kombu_message') as tokm:
+            self.listener.on_message(self.headers, self.body)
+
+        self.queue.put.assert_called_once_with(tokm.return_value,
+                                               len(self.body),
+                                               tokm.return_value[1],
+                                               keepalive=keepalive,
+                                               interval=0.5,
+                                               block=True)
+
+    def test_set_keepalive__decode_workers(self):
+        listener = stomp.MessageListener(decode_workers=1)
+        self.addCleanup(listener.close)
+        keepalive = mock.Mock()
+
+        listener.set_keepalive(keepalive, 0.5)
+
+        self.assertIs(listener.decoder.keepalive, keepalive)
+        self.assertEqual(listener.decoder.keepalive_interval, 0.5)
+
+    def test_buffered_bytes(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        self.listener.on_message(self.headers, self.body)
+        self.assertEqual(self.listener.buffered_bytes(), len(self.body))
+
+    def test_on_message__metrics(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        self.listener.metrics = metrics.InMemoryMetrics()
+        self.listener.on_message(self.headers, self.body)
+
+        m = self.listener.metrics
+        self.assertEqual(m.get('kombu_stomp_frames_received_total',
+                               command='MESSAGE'), 1)
+        self.assertEqual(m.get('kombu_stomp_received_bytes_total',
+                               queue='simple_queue'), len(self.body))
+        self.assertEqual(m.get('kombu_stomp_decode_seconds')[0], 1)
+        self.assertEqual(m.get('kombu_stomp_receive_buffer_messages'), 1)
+        self.assertEqual(m.get('kombu_stomp_receive_buffer_bytes'),
+                         len(self.body))
+
+    def test_on_message__wakes_up(self):
+        self.listener.waker = mock.Mock()
+        with mock.patch.object(self.listener, 'to_kombu_message'):
+            self.listener.on_message(self.headers, self.body)
+        self.listener.waker.wake.assert_called_once_with()
+
+    def test_on_message__decode_workers(self):
+        listener = stomp.MessageListener(decode_workers=2)
+        self.addCleanup(listener.close)
+        listener.on_message(self.headers, self.body)
+
+        item, queue = listener.q.get(timeout=5)
+        self.assertEqual(queue, 'simple_queue')
+        self.assertEqual(item[0]['body'], self.body)
+        self.assertLessEqual(item[3]['received_at'], time.time())
+
+    def test_close__decode_workers(self):
+        listener = stomp.MessageListener(decode_workers=1)
+        listener.close()
+
+        self.assertTrue(listener.decoder.closed)
+
+    def test_on_message__routed(self):
+        owner = stomp.MessageListener()
+        self.listener.version = '1.2'
+        self.listener.route('sub-1', owner)
+
+        with mock.patch.object(owner, 'on_message') as on_message:
+            self.listener.on_message({'subscription': 'sub-1'}, self.body)
+
+        on_message.assert_called_once_with({'subscription': 'sub-1'},
+                                           self.body)
+        self.assertEqual(owner.version, '1.2')
+        self.assertIsNone(owner.keepalive)
+        self.assertFalse(self.queue.put.called)
+
+    def test_on_message__routed_to_full_buffer(self):
+        owner = stomp.MessageListener(q=stomp.ReceiveBuffer(maxsize=1))
+        headers = dict(self.headers, subscription='/queue/simple_queue')
+        self.listener.route('/queue/simple_queue', owner)
+
+        # waiting for room would hold back every routed listener
+        self.listener.on_message(headers, self.body)
+        self.listener.on_message(headers, self.body)
+
+        self.assertFalse(owner.block)
+        self.assertEqual(owner.qsize(), 2)
+
+    def test_route__keepalive(self):
+        owner = stomp.MessageListener()
+        keepalive = mock.Mock()
+        self.listener.set_keepalive(keepalive, 0.5)
+
+        self.listener.route('sub-1', owner)
+
+        self.assertIs(owner.keepalive, keepalive)
+        self.assertEqual(owner.keepalive_interval, 0.5)
+
+    def test_discard(self):
+        headers = dict(self.headers, subscription='/queue/simple_queue')
+        self.listener.discard('/queue/simple_queue',
+                              'simple_queue',
+                              'receipt-1')
+        self.queue.discard.assert_called_once_with('simple_queue')
+
+        self.listener.on_message(headers, self.body)
+        self.listener.on_receipt({'receipt-id': 'other'}, '')
+        self.listener.on_message(headers, self.body)
+        self.assertFalse(self.queue.put.called)
+
+        self.listener.on_receipt({'receipt-id': 'receipt-1'}, '')
+        self.listener.on_message(headers, self.body)
+        self.assertEqual(self.queue.put.call_count, 1)
+
+    def test_discard__routed(self):
+        headers = dict(self.headers, subscription='/queue/simple_queue')
+        owner = stomp.MessageListener(q=mock.Mock())
+        self.listener.route('/queue/simple_queue', owner)
+        owner.discard('/queue/simple_queue', 'simple_queue', 'receipt-1')
+
+        self.listener.on_message(headers, self.body)
+        self.listener.on_receipt({'receipt-id': 'receipt-1'}, '')
+        self.listener.on_message(headers, self.body)
+
+        self.assertEqual(owner.q.put.call_count, 1)
+
+    def test_on_message__decode_failure(self):
+        self.listener.conn = mock.Mock()
+        self.listener.ack_modes['/queue/simple_queue'] = 'client-individual'
+        headers = dict(self.headers,
+                       subscription='/queue/simple_queue',
+                       properties='{')
+
+        with mock.patch.object(stomp.logger, 'exception') as log:
+            self.listener.on_message(headers, self.body)
+
+        log.assert_called_once_with('Failed decoding message')
+        self.listener.conn.ack.assert_called_once_with(
+            self.headers['message-id'])
+        self.assertFalse(self.queue.put.called)
+
+    def test_on_message__decode_failure_without_individual_acks(self):
+        self.listener.conn = mock.Mock()
+        self.listener.ack_modes['/queue/a'] = 'client'
+        self.listener.ack_modes['/queue/b'] = 'auto'
+
+        with mock.patch.object(stomp.logger, 'exception'):
+            for subscription in ('/queue/a', '/queue/b'):
+                self.listener.on_message(dict(self.headers,
+                                              subscription=subscription,
+                                              properties='{'),
+                                         self.body)
+
+        self.assertFalse(self.listener.conn.ack.called)
+        self.assertFalse(self.queue.put.called)
+
+    def test_on_message__not_routed(self):
+        self.listener.route('sub-1', stomp.MessageListener())
+
+        self.listener.on_message(dict(self.headers, subscription='sub-2'),
+                                 self.body)
+
+        self.assertFalse(self.queue.put.called)
+
+    def test_qsize(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        self.listener.q.put(1)
+        self.assertEqual(self.listener.qsize(), 1)
+
+    def test_qsize__queues(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        self.listener.on_message(self.headers, self.body)
+        self.assertEqual(self.listener.qsize(['simple_queue']), 1)
+        self.assertEqual(self.listener.qsize(['other']), 0)
+
+    def test_iterator__queues(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        self.listener.q.put(1, key='a')
+        self.listener.q.put(2, key='b')
+        it = self.listener.iterator(queues=['b'])
+        self.assertEqual(next(it), 2)
+        self.assertRaises(queue.Empty, lambda: next(it))
 
     def test_to_kombu_message__return_message_as_dict(self):
         self.assertDictEqual(
@@ -73,6 +272,65 @@ class MessageListenerTests(ListenerTestCase):
             }
         )
 
+    def test_to_kombu_message__trace(self):
+        self.listener.on_connecting(('broker', 61613))
+        self.headers[stomp.PUBLISHED_HEADER] = '1412068081.5'
+        item = self.listener.to_kombu_message(self.headers, self.body)[0]
+        message, trace = item[0], item[3]
+
+        self.assertNotIn(stomp.PUBLISHED_HEADER, message)
+        self.assertEqual(trace['published_at'], 1412068081.5)
+        self.assertEqual(trace['broker_timestamp'], 1412068081.608)
+        self.assertGreater(trace['received_at'], 1412068081.608)
+        self.assertEqual(trace['broker'], ('broker', 61613))
+
+    def test_trace__no_timestamps(self):
+        del self.headers['timestamp']
+        trace = self.listener.trace(self.headers)
+
+        self.assertIsNone(trace['published_at'])
+        self.assertIsNone(trace['broker_timestamp'])
+
+    def test_to_kombu_message__json_format(self):
+        headers = stomp.encode_headers({
+            'properties': {'delivery_tag': 'tag'},
+            'headers': {'task': 'add'},
+        })
+        headers.update({'message-id': 'msg-id',
+                        'destination': '/queue/simple_queue'})
+
+        self.assertDictEqual(
+            self.listener.to_kombu_message(headers, self.body)[0][0],
+            {
+                'properties': {'delivery_tag': 'tag'},
+                'headers': {'task': 'add'},
+                'body': self.body,
+            }
+        )
+
+    def test_to_kombu_message__filter_headers(self):
+        headers = stomp.encode_headers({'headers': {'kind': 'a'}}, ['kind'])
+        headers.update({'message-id': 'msg-id',
+                        'destination': '/queue/simple_queue'})
+
+        self.assertDictEqual(
+            self.listener.to_kombu_message(headers, self.body)[0][0],
+            {'headers': {'kind': 'a'}, 'body': self.body},
+        )
+
+    def test_to_kombu_message__binary_body(self):
+        body = b'\x00\xff' * 10
+        message = self.listener.to_kombu_message(self.headers, body)[0][0]
+        self.assertIs(message['body'], body)
+
+    def test_to_kombu_message__legacy_headers(self):
+        self.headers['headers'] = "{'task': 'add'}"
+        self.assertEqual(
+            self.listener.to_kombu_message(self.headers,
+                                           self.body)[0][0]['headers'],
+            {'task': 'add'},
+        )
+
     def test_to_kombu_message__return_message_id(self):
         self.assertEqual(
             self.listener.to_kombu_message(self.headers, self.body)[0][1],
@@ -85,6 +343,12 @@ class MessageListenerTests(ListenerTestCase):
             'simple_queue',
         )
 
+    def test_to_kombu_message__return_message_queue_name(self):
+        self.assertEqual(
+            self.listener.to_kombu_message(self.headers, self.body)[0][2],
+            'simple_queue',
+        )
+
     def test_iterator(self):
         self.queue.get_nowait.side_effect = (1, 3)
         it = self.listener.iterator()
@@ -92,10 +356,56 @@ class MessageListenerTests(ListenerTestCase):
         self.assertEqual(3, next(it))
 
     def test_iterator__empty(self):
-        self.listener.q = queue.Queue()
+        self.listener.q = stomp.ReceiveBuffer()
         it = self.listener.iterator()
         self.assertRaises(queue.Empty, lambda: next(it))
 
+    def test_iterator__timeout(self):
+        self.queue.get.side_effect = (1, 3)
+        it = self.listener.iterator(self.timeout)
+        self.assertEqual(1, next(it))
+        self.assertEqual(3, next(it))
+        self.queue.get.assert_called_with(timeout=self.timeout, keys=None)
+        self.assertFalse(self.queue.get_nowait.called)
+
+    def test_iterator__timeout_empty(self):
+        self.listener.q = stomp.ReceiveBuffer()
+        it = self.listener.iterator(0.01)
+        self.assertRaises(queue.Empty, lambda: next(it))
+
+    def test_to_kombu_message__removes_subscription_headers(self):
+        self.headers.update({'subscription': '/queue/simple_queue',
+                             'ack': 'ack-id'})
+        message = self.listener.to_kombu_message(self.headers,
+                                                 self.body)[0][0]
+        self.assertNotIn('subscription', message)
+        self.assertNotIn('ack', message)
+
+    def test_ack_id__1_1(self):
+        self.listener.version = '1.1'
+        self.headers['subscription'] = '/queue/simple_queue'
+        self.assertEqual(self.listener.ack_id(self.headers),
+                         (self.headers['message-id'], '/queue/simple_queue'))
+
+    def test_ack_id__1_2(self):
+        self.listener.version = '1.2'
+        self.headers['ack'] = 'ack-id'
+        self.assertEqual(self.listener.ack_id(self.headers), 'ack-id')
+
+    def test_on_connected__version(self):
+        self.listener.on_connected({'version': '1.2'}, '')
+        self.assertEqual(self.listener.version, '1.2')
+
+    def test_on_connected__no_version(self):
+        self.listener.version = '1.2'
+        self.listener.on_connected({}, '')
+        self.assertEqual(self.listener.version, '1.0')
+
+    def test_on_heartbeat_timeout__wakes_up(self):
+        self.listener.waker = mock.Mock()
+        self.listener.on_heartbeat_timeout()
+        self.listener.waker.wake.assert_called_once_with()
+
     def test_queue_from_destination(self):
         self.assertEqual(
             self.listener.queue_from_destination(self.headers['destination']),
@@ -110,6 +420,496 @@ class MessageListenerTests(ListenerTestCase):
         )
 
 
+class HeaderCodecTests(unittest.TestCase):
+    def setUp(self):
+        self.message = {
+            'content-type': 'application/json',
+            'properties': {
+                'body_encoding': 'base64',
+                'delivery_info': {'priority': 0, 'exchange': 'simple_queue'},
+                'delivery_tag': '423e3830-e67a-458d-9aa0-f58df4d01639',
+            },
+            'headers': {},
+        }
+
+    def test_encode_headers__json(self):
+        headers = stomp.encode_headers(self.message)
+
+        self.assertEqual(headers[stomp.FORMAT_HEADER], stomp.JSON_FORMAT)
+        self.assertEqual(json.loads(headers['properties']),
+                         self.message['properties'])
+        self.assertEqual(headers['headers'], '{}')
+        self.assertEqual(headers['content-type'], 'application/json')
+
+    def test_encode_headers__compact(self):
+        headers = stomp.encode_headers(self.message)
+        self.assertNotIn(' ', headers['properties'])
+
+    def test_encode_headers__does_not_modify_message(self):
+        stomp.encode_headers(self.message)
+        self.assertIsInstance(self.message['properties'], dict)
+
+    def test_encode_headers__no_dictionaries(self):
+        self.assertEqual(stomp.encode_headers({'content-type': 'text/plain'}),
+                         {'content-type': 'text/plain'})
+
+    def test_encode_headers__not_json_serializable(self):
+        self.message['headers'] = {'eta': object()}
+        headers = stomp.encode_headers(self.message)
+
+        self.assertNotIn(stomp.FORMAT_HEADER, headers)
+        self.assertEqual(headers, dict(self.message, priority=0))
+
+    def test_encode_headers__legacy(self):
+        self.message['headers'] = {'retries': None, 'chord': True}
+        headers = stomp.encode_headers(self.message, json_headers=False)
+
+        self.assertNotIn(stomp.FORMAT_HEADER, headers)
+        self.assertEqual(headers, dict(self.message, priority=0))
+        # what consumers older than JSON headers do
+        self.assertEqual(ast.literal_eval(str(headers['headers'])),
+                         self.message['headers'])
+
+    def test_encode_headers__filter_headers(self):
+        self.message['headers'] = {'kind': 'a', 'size': 3, 'none': None,
+                                   'content-type': 'clash',
+                                   'priority': 9}
+        headers = stomp.encode_headers(
+            self.message,
+            ['kind', 'size', 'none', 'missing', 'content-type', 'priority'],
+        )
+
+        self.assertEqual(headers['kind'], 'a')
+        self.assertEqual(headers['size'], 3)
+        self.assertEqual(headers['content-type'], 'application/json')
+        self.assertEqual(headers['priority'], 0)
+        self.assertEqual(headers[stomp.FILTER_HEADER], 'kind,size')
+
+    def test_encode_headers__not_json_serializable_keeps_delivery(self):
+        self.message['headers'] = {'eta': object()}
+        self.message['properties']['expiration'] = '1500'
+        self.message['properties']['delivery_info']['priority'] = 3
+        with mock.patch('time.time', return_value=1000.0):
+            headers = stomp.encode_headers(self.message)
+
+        self.assertEqual(headers['expires'], 1001500)
+        self.assertEqual(headers['priority'], 3)
+        self.assertEqual(headers['headers'], self.message['headers'])
+
+    def test_encode_headers__filter_headers_not_json_serializable(self):
+        self.message['headers'] = {'kind': 'a', 'eta': object()}
+        headers = stomp.encode_headers(self.message, ['kind'])
+
+        self.assertEqual(headers['kind'], 'a')
+        self.assertEqual(headers['headers'], self.message['headers'])
+
+    def test_encode_headers__expiration(self):
+        self.message['properties']['expiration'] = '1500'
+        with mock.patch('time.time', return_value=1000.0):
+            headers = stomp.encode_headers(self.message)
+
+        self.assertEqual(headers['expires'], 1001500)
+
+    def test_encode_headers__priority(self):
+        self.message['properties']['delivery_info']['priority'] = 3
+        self.assertEqual(stomp.encode_headers(self.message)['priority'], 3)
+
+    def test_encode_headers__priority_capped(self):
+        self.message['properties']['delivery_info']['priority'] = 255
+        self.assertEqual(stomp.encode_headers(self.message)['priority'],
+                         stomp.MAX_PRIORITY)
+
+    def test_encode_headers__no_priority(self):
+        del self.message['properties']['delivery_info']['priority']
+        self.assertNotIn('priority', stomp.encode_headers(self.message))
+
+    def test_restore_delivery_properties(self):
+        properties = {'delivery_info': {}}
+        with mock.patch('time.time', return_value=1000.0):
+            stomp.restore_delivery_properties(
+                properties, {'expires': '1001500', 'priority': '7'})
+
+        self.assertEqual(properties, {'expiration': '1500',
+                                      'delivery_info': {'priority': 7}})
+
+    def test_restore_delivery_properties__expired(self):
+        properties = {}
+        with mock.patch('time.time', return_value=1000.0):
+            stomp.restore_delivery_properties(properties,
+                                              {'expires': '999000'})
+
+        self.assertEqual(properties, {'expiration': '0'})
+
+    def test_restore_delivery_properties__keeps_priority(self):
+        properties = {'delivery_info': {'priority': 2}}
+        stomp.restore_delivery_properties(properties,
+                                          {'expires': '0', 'priority': '4'})
+
+        self.assertEqual(properties, {'delivery_info': {'priority': 2}})
+
+    def test_decode_header__json(self):
+        headers = stomp.encode_headers(self.message)
+        self.assertEqual(
+            stomp.decode_header(headers['properties'], stomp.JSON_FORMAT),
+            self.message['properties'],
+        )
+
+    def test_decode_header__legacy(self):
+        self.assertEqual(
+            stomp.decode_header(str(self.message['properties'])),
+            self.message['properties'],
+        )
+
+
+class ReceiveBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.buffer = stomp.ReceiveBuffer(maxsize=2, maxbytes=10)
+
+    def put_in_thread(self, item, size=0):
+        thread = threading.Thread(target=self.buffer.put, args=(item, size))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_fifo(self):
+        self.buffer.put(1)
+        self.buffer.put(2)
+        self.assertEqual(self.buffer.get_nowait(), 1)
+        self.assertEqual(self.buffer.get_nowait(), 2)
+
+    def test_get_nowait__empty(self):
+        self.assertRaises(queue.Empty, self.buffer.get_nowait)
+
+    def test_get__timeout(self):
+        self.assertRaises(queue.Empty, self.buffer.get, timeout=0.01)
+
+    def test_get__waits_for_put(self):
+        self.put_in_thread(1)
+        self.assertEqual(self.buffer.get(timeout=5), 1)
+
+    def test_bytes(self):
+        self.buffer.put(1, 3)
+        self.buffer.put(2, 4)
+        self.assertEqual(self.buffer.bytes, 7)
+
+        self.buffer.get()
+        self.assertEqual(self.buffer.bytes, 4)
+
+    def test_put__blocks_when_full(self):
+        self.buffer.put(1)
+        self.buffer.put(2)
+        thread = self.put_in_thread(3)
+
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(self.buffer.qsize(), 2)
+
+        self.buffer.get()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.buffer.qsize(), 2)
+
+    def test_put__no_block(self):
+        self.buffer.put(1)
+        self.buffer.put(2)
+
+        self.buffer.put(3, block=False)
+
+        self.assertEqual(self.buffer.qsize(), 3)
+
+    def test_put__keepalive_when_full(self):
+        self.buffer.put(1)
+        self.buffer.put(2)
+        keepalive = mock.Mock()
+        thread = threading.Thread(target=self.buffer.put,
+                                  args=(3,),
+                                  kwargs={'keepalive': keepalive,
+                                          'interval': 0.01})
+        thread.daemon = True
+        thread.start()
+
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertGreater(keepalive.call_count, 2)
+
+        self.buffer.get()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_discard(self):
+        buffer = stomp.ReceiveBuffer()
+        for item in ('a1', 'b1', 'a2', 'c1'):
+            buffer.put(item, 1, key=item[0])
+
+        buffer.discard('a')
+        buffer.discard('d')
+
+        self.assertEqual(buffer.qsize(), 2)
+        self.assertEqual(buffer.bytes, 2)
+        self.assertEqual([buffer.get_nowait() for _ in range(2)],
+                         ['b1', 'c1'])
+
+    def test_discard__waiting_for_room(self):
+        self.buffer.put(1, key='a')
+        self.buffer.put(2, key='b')
+        thread = threading.Thread(target=self.buffer.put, args=(3, 0, 'a'))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.05)
+
+        self.buffer.discard('a')
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.buffer.qsize(), 1)
+        self.assertEqual(self.buffer.get_nowait(), 2)
+
+    def test_put__blocks_when_full_of_bytes(self):
+        self.buffer.put(1, 10)
+        self.assertTrue(self.buffer.full())
+
+    def test_round_robin(self):
+        buffer = stomp.ReceiveBuffer()
+        for item in ('a1', 'a2', 'a3', 'b1', 'c1', 'c2'):
+            buffer.put(item, key=item[0])
+
+        self.assertEqual([buffer.get_nowait() for _ in range(6)],
+                         ['a1', 'b1', 'c1', 'a2', 'c2', 'a3'])
+
+    def test_weights(self):
+        buffer = stomp.ReceiveBuffer(weights={'a': 2})
+        for item in ('a1', 'a2', 'a3', 'b1', 'b2'):
+            buffer.put(item, key=item[0])
+
+        self.assertEqual([buffer.get_nowait() for _ in range(5)],
+                         ['a1', 'a2', 'b1', 'a3', 'b2'])
+
+    def test_get__keys(self):
+        buffer = stomp.ReceiveBuffer()
+        for item in ('a1', 'b1', 'c1'):
+            buffer.put(item, key=item[0])
+
+        self.assertEqual(buffer.get_nowait(keys=['c']), 'c1')
+        self.assertRaises(queue.Empty, buffer.get_nowait, keys=['c'])
+        self.assertEqual(buffer.qsize(), 2)
+        self.assertEqual(buffer.qsize(['a', 'c']), 1)
+
+    def test_get__keys_not_ready(self):
+        buffer = stomp.ReceiveBuffer()
+        for item in ('a1', 'b1', 'c1'):
+            buffer.put(item, key=item[0])
+
+        self.assertRaises(queue.Empty, buffer.get_nowait, keys=['d', 'e'])
+        self.assertEqual(buffer.get_nowait(), 'a1')
+        self.assertEqual(buffer.get_nowait(keys={'c'}), 'c1')
+        self.assertEqual(buffer.get_nowait(keys=('a', 'b')), 'b1')
+        self.assertRaises(queue.Empty, buffer.get_nowait, keys=['b'])
+
+    def test_get__waits_for_requested_key(self):
+        buffer = stomp.ReceiveBuffer()
+        buffer.put('a1', key='a')
+        threading.Timer(0.01, buffer.put, ('b1', 0, 'b')).start()
+
+        self.assertEqual(buffer.get(timeout=5, keys=['b']), 'b1')
+
+    def test_close__releases_put(self):
+        self.buffer.put(1)
+        self.buffer.put(2)
+        thread = self.put_in_thread(3)
+
+        self.buffer.close()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.buffer.qsize(), 0)
+        self.assertEqual(self.buffer.bytes, 0)
+
+
+class DecodePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.delivered = queue.Queue()
+        self.pool = stomp.DecodePool(self.delivered.put, 4)
+        self.addCleanup(self.pool.close)
+
+    def test_submit__keeps_order_by_key(self):
+        def decode(value):
+            if value == 'a1':
+                # the rest of the messages get decoded meanwhile
+                time.sleep(0.05)
+            return value
+
+        for value in ('a1', 'b1', 'a2', 'a3', 'b2'):
+            self.pool.submit(value[0], decode, value)
+        delivered = [self.delivered.get(timeout=5) for _ in range(5)]
+
+        self.assertEqual([v for v in delivered if v[0] == 'a'],
+                         ['a1', 'a2', 'a3'])
+        self.assertEqual([v for v in delivered if v[0] == 'b'], ['b1', 'b2'])
+        # b messages didn't wait for a1
+        self.assertEqual(delivered[-1], 'a3')
+
+    def test_submit__failure(self):
+        def decode(value):
+            if value == 1:
+                raise ValueError(value)
+            return value
+
+        with mock.patch.object(stomp.logger, 'exception') as log:
+            for value in range(3):
+                self.pool.submit('a', decode, value)
+            delivered = [self.delivered.get(timeout=5) for _ in range(2)]
+
+        self.assertEqual(delivered, [0, 2])
+        log.assert_called_once_with('Failed decoding message')
+
+    def test_discard(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def decode(value):
+            release.wait(5)
+            return value
+
+        self.pool.submit('a', decode, 'a1')
+        self.pool.submit('b', decode, 'b1')
+        self.pool.discard('a')
+        self.pool.submit('a', decode, 'a2')
+        release.set()
+        delivered = [self.delivered.get(timeout=5) for _ in range(2)]
+
+        self.assertEqual(sorted(delivered), ['a2', 'b1'])
+
+    def test_submit__keepalive_when_full(self):
+        release = threading.Event()
+        pool = stomp.DecodePool(self.delivered.put, 1, maxsize=1)
+        self.addCleanup(pool.close)
+        self.addCleanup(release.set)
+        pool.keepalive = mock.Mock()
+        pool.keepalive_interval = 0.01
+        # one being decoded, one waiting
+        for _ in range(2):
+            pool.submit('a', release.wait)
+        thread = threading.Thread(target=pool.submit,
+                                  args=('a', release.wait))
+        thread.daemon = True
+        thread.start()
+
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertGreater(pool.keepalive.call_count, 2)
+
+        release.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_close(self):
+        self.pool.close()
+        self.pool.submit('a', lambda: 1)
+
+        for thread in self.pool._threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertTrue(self.delivered.empty())
+
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        self.body = json.dumps([{'id': i, 'name': 'item'} for i in range(50)])
+
+    def test_compress_body__below_threshold(self):
+        headers = {}
+        body = stomp.compress_body(self.body, headers, 'zlib', threshold=1e6)
+
+        self.assertEqual(body, self.body.encode('utf-8'))
+        self.assertEqual(headers, {})
+
+    def test_compress_body(self):
+        for codec in ('zlib', 'gzip'):
+            headers = {}
+            body = stomp.compress_body(self.body, headers, codec)
+
+            self.assertEqual(headers, {stomp.COMPRESSION_HEADER: codec})
+            self.assertLess(len(body), len(self.body))
+            self.assertEqual(stomp.decompress_body(body, headers),
+                             self.body.encode('utf-8'))
+
+    def test_compress_body__unsupported(self):
+        self.assertRaises(ValueError,
+                          stomp.compress_body, self.body, {}, 'nope')
+
+    def test_decompress_body__not_compressed(self):
+        self.assertEqual(stomp.decompress_body(self.body, {}), self.body)
+
+    def test_to_kombu_message(self):
+        headers = {'destination': '/queue/a', 'message-id': 'msg-id'}
+        body = stomp.compress_body(self.body, headers, 'zlib')
+        listener = stomp.MessageListener()
+
+        message = listener.to_kombu_message(headers, body)[0][0]
+
+        self.assertEqual(message, {'body': self.body.encode('utf-8')})
+
+
+class WakerTests(unittest.TestCase):
+    def setUp(self):
+        self.waker = stomp.Waker()
+        self.addCleanup(self.waker.close)
+
+    def readable(self):
+        return bool(select.select([self.waker.fileno()], [], [], 0)[0])
+
+    def test_not_readable_on_init(self):
+        self.assertFalse(self.readable())
+
+    def test_wake(self):
+        self.waker.wake()
+        self.assertTrue(self.readable())
+
+    def test_wake__writes_once(self):
+        with mock.patch('os.write') as write:
+            self.waker.wake()
+            self.waker.wake()
+        self.assertEqual(write.call_count, 1)
+
+    def test_drain(self):
+        self.waker.wake()
+        self.waker.drain()
+        self.assertFalse(self.readable())
+
+    def test_drain__rearms_wake(self):
+        self.waker.wake()
+        self.waker.drain()
+        self.waker.wake()
+        self.assertTrue(self.readable())
+
+
+    def test_close(self):
+        self.waker.close()
+        with mock.patch('os.write') as write:
+            self.waker.wake()
+        self.assertFalse(write.called)
+        # draining and closing again are no-ops too
+        self.waker.drain()
+        self.waker.close()
+
+    def test_close__concurrent_wake(self):
+        stop = threading.Event()
+
+        def wake():
+            while not stop.is_set():
+                self.waker.drain()
+                self.waker.wake()
+
+        thread = threading.Thread(target=wake)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+        time.sleep(0.01)
+        self.waker.close()
+        time.sleep(0.01)
+
+        self.assertTrue(thread.is_alive())
+
 class ConnectionTests(unittest.TestCase):
 
     @mock.patch('kombu_stomp.stomp.MessageListener')
@@ -119,4 +919,195 @@ class ConnectionTests(unittest.TestCase):
             self.conn.get_listener('message_listener'),
             Listener.return_value,
         )
-        Listener.assert_called_once_with(prefix='')
+        Listener.assert_called_once_with(prefix='',
+                                         q=mock.ANY,
+                                         waker=None,
+                                         version='1.0',
+                                         metrics=mock.ANY,
+                                         decode_workers=0)
+
+    def test_receive_buffer_limits(self):
+        conn = stomp.Connection(buffer_size=10, buffer_bytes=100)
+        self.assertEqual(conn.message_listener.q.maxsize, 10)
+        self.assertEqual(conn.message_listener.q.maxbytes, 100)
+
+    def test_connection__version(self):
+        self.assertIsInstance(stomp.Connection(version='1.1'),
+                              stomp.Connection11)
+        conn = stomp.Connection(version='1.2', heartbeats=(1000, 2000))
+        self.assertIsInstance(conn, stomp.Connection12)
+        self.assertEqual(conn.heartbeats, (1000, 2000))
+        self.assertEqual(conn.message_listener.version, '1.2')
+
+    def test_connection__1_0_ignores_heartbeats(self):
+        conn = stomp.Connection(version='1.0', heartbeats=(1000, 2000))
+        self.assertIsInstance(conn, stomp.Connection10)
+        self.assertIsNone(conn.message_listener.keepalive)
+
+    def test_connection__heartbeats_keepalive(self):
+        conn = stomp.Connection(version='1.2', heartbeats=(0, 2000))
+
+        self.assertEqual(conn.message_listener.keepalive, conn.on_heartbeat)
+        self.assertEqual(conn.message_listener.keepalive_interval, 1.0)
+
+    def test_connect_frame__offers_older_versions(self):
+        conn = stomp.Connection(version='1.1')
+        conn.transport = mock.Mock()
+
+        conn.send_frame('STOMP', {})
+
+        frame = conn.transport.transmit.call_args[0][0]
+        self.assertEqual(frame.cmd, 'CONNECT')
+        self.assertEqual(frame.headers['accept-version'], '1.0,1.1')
+
+    def test_connect__version_mismatch(self):
+        conn = stomp.Connection(version='1.2')
+        conn.transport = mock.Mock(connection_error=False,
+                                   current_host_and_port=('host', 61613))
+        conn.message_listener.version = '1.1'
+
+        with self.assertRaises(stomp.VersionMismatch) as cm:
+            conn.connect(wait=True)
+
+        self.assertEqual(cm.exception.version, '1.1')
+        self.assertEqual(conn.transport.transmit.call_args[0][0].cmd,
+                         'DISCONNECT')
+
+    def test_ack__1_1(self):
+        conn = stomp.Connection(version='1.1')
+        conn.transport = mock.Mock()
+
+        conn.ack(('msg-id', 'sub-id'))
+
+        frame = conn.transport.transmit.call_args[0][0]
+        self.assertEqual(frame.headers, {'message-id': 'msg-id',
+                                         'subscription': 'sub-id'})
+
+    def test_subscribe__ack_mode(self):
+        conn = stomp.Connection(version='1.1')
+        conn.transport = mock.Mock()
+
+        conn.subscribe('/queue/a', id='/queue/a', ack='client-individual')
+
+        self.assertEqual(conn.message_listener.conn, conn)
+        self.assertEqual(conn.message_listener.ack_modes,
+                         {'/queue/a': 'client-individual'})
+
+
+class ConnectionBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = stomp.Connection()
+        self.conn.transport = mock.Mock()
+        self.send = self.conn.transport.send
+
+    def written(self):
+        return b''.join(c[0][0] for c in self.send.call_args_list)
+
+    def test_not_batching(self):
+        self.assertFalse(self.conn.batching)
+        self.conn.send('/queue/a', 'body')
+        self.conn.transport.transmit.assert_called_once_with(mock.ANY)
+
+    def test_begin_batch__buffers_send_frames(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body')
+
+        self.assertTrue(self.conn.batching)
+        self.assertFalse(self.send.called)
+        self.assertFalse(self.conn.transport.transmit.called)
+
+    def test_flush__single_write(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body1')
+        self.conn.send('/queue/a', 'body2')
+
+        self.conn.flush()
+
+        self.assertEqual(self.send.call_count, 1)
+        self.assertEqual(self.written().count(b'SEND\n'), 2)
+        self.assertIn(b'body1\x00', self.written())
+
+    def test_flush__nothing_buffered(self):
+        self.conn.begin_batch()
+        self.conn.flush()
+        self.assertFalse(self.send.called)
+
+    def test_max_frames(self):
+        self.conn.begin_batch(max_frames=2)
+        self.conn.send('/queue/a', 'body')
+        self.assertFalse(self.send.called)
+
+        self.conn.send('/queue/a', 'body')
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_max_bytes(self):
+        self.conn.begin_batch(max_bytes=100)
+        self.conn.send('/queue/a', 'x' * 100)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_interval(self):
+        self.conn.begin_batch(interval=0.01)
+        self.conn.send('/queue/a', 'body')
+        self.conn._batch_timer.join(5)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_flush__failed(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body')
+        self.send.side_effect = [OSError('broken pipe'), None]
+
+        self.assertRaises(OSError, self.conn.flush)
+        self.conn.flush()
+
+        self.assertEqual(self.send.call_count, 2)
+        self.assertEqual(self.send.call_args_list[0],
+                         self.send.call_args_list[1])
+
+    def test_interval__failed(self):
+        self.conn.begin_batch(interval=0.01)
+        self.send.side_effect = [OSError('broken pipe'), None]
+        self.conn.send('/queue/a', 'body1')
+        self.conn._batch_timer.join(5)
+
+        self.assertRaises(OSError, self.conn.send, '/queue/a', 'body2')
+        self.conn.end_batch()
+
+        self.assertEqual(self.send.call_count, 2)
+        self.assertIn(b'body1\x00', self.send.call_args[0][0])
+
+    def test_end_batch__failed(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body')
+        self.send.side_effect = OSError('broken pipe')
+
+        self.assertRaises(OSError, self.conn.end_batch)
+        self.assertFalse(self.conn.batching)
+
+    def test_other_frames_flush_first(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body')
+
+        self.conn.ack('msg-id')
+
+        self.assertEqual(self.send.call_count, 1)
+        frame = self.conn.transport.transmit.call_args[0][0]
+        self.assertEqual(frame.cmd, 'ACK')
+
+    def test_end_batch(self):
+        self.conn.begin_batch()
+        self.conn.send('/queue/a', 'body')
+
+        self.conn.end_batch()
+
+        self.assertFalse(self.conn.batching)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_escape_headers(self):
+        conn = stomp.Connection(version='1.2')
+        conn.transport = mock.Mock()
+        conn.begin_batch()
+
+        conn.send('/queue/a', 'body', headers={'key': 'a:b'})
+        conn.flush()
+
+        self.assertIn(b'key:a\\cb\n', conn.transport.send.call_args[0][0])
@@ -0,0 +1,1021 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import kombu
+import stomp as stomppy
+from stomp import listener
+
+import kombu_stomp
+from kombu_stomp import metrics
+from kombu_stomp import stomp
+from kombu_stomp import testing
+from kombu_stomp import transport
+from kombu_stomp.utils import mock
+from kombu_stomp.utils import unittest
+
+
+class EscapeTests(unittest.TestCase):
+    def test_escape__1_0(self):
+        self.assertEqual(testing.escape('a:b\nc', '1.0'), 'a:b\nc')
+
+    def test_escape__1_1(self):
+        self.assertEqual(testing.escape('a:b\\c\n\r', '1.1'),
+                         'a\\cb\\\\c\\n\r')
+
+    def test_escape__1_2(self):
+        self.assertEqual(testing.escape('a\r', '1.2'), 'a\\r')
+
+    def test_unescape(self):
+        value = 'a:b\\c\n\r'
+        self.assertEqual(
+            testing.unescape(testing.escape(value, '1.2'), '1.2'),
+            value,
+        )
+
+
+class FrameParserTests(unittest.TestCase):
+    def setUp(self):
+        self.parser = testing.FrameParser()
+
+    def test_feed(self):
+        frames = self.parser.feed(b'SEND\ndestination:/queue/a\n\nbody\x00')
+
+        self.assertEqual(frames, [
+            ('SEND', {'destination': '/queue/a'}, b'body', 32),
+        ])
+
+    def test_feed__partial(self):
+        self.assertEqual(self.parser.feed(b'SEND\ndestination:/qu'), [])
+        self.assertEqual(self.parser.feed(b'eue/a\n\nbo'), [])
+        frames = self.parser.feed(b'dy\x00')
+        self.assertEqual(frames[0].body, b'body')
+
+    def test_feed__content_length(self):
+        frames = self.parser.feed(b'SEND\ncontent-length:3\n\na\x00b\x00')
+        self.assertEqual(frames[0].body, b'a\x00b')
+
+    def test_feed__heartbeats_and_crlf(self):
+        frames = self.parser.feed(b'\n\r\nACK\r\nid:1\r\n\r\n\x00\n')
+        self.assertEqual(frames, [('ACK', {'id': '1'}, b'', 14)])
+
+    def test_feed__many_frames(self):
+        frames = self.parser.feed(b'ACK\nid:1\n\n\x00ACK\nid:2\n\n\x00')
+        self.assertEqual([f.headers['id'] for f in frames], ['1', '2'])
+
+    def test_feed__unescape(self):
+        self.parser.version = '1.1'
+        frames = self.parser.feed(b'SEND\nkey:a\\cb\n\n\x00')
+        self.assertEqual(frames[0].headers['key'], 'a:b')
+
+    def test_encode_frame(self):
+        self.parser.version = '1.1'
+        data = testing.encode_frame('MESSAGE', {'key': 'a:b'}, 'body', '1.1')
+        self.assertEqual(self.parser.feed(data), [
+            ('MESSAGE', {'key': 'a:b', 'content-length': '4'}, b'body',
+             len(data)),
+        ])
+
+
+class SelectorTests(unittest.TestCase):
+    def assertSelects(self, selector, headers):
+        self.assertTrue(testing.Selector(selector)(headers))
+
+    def assertNotSelects(self, selector, headers):
+        self.assertFalse(testing.Selector(selector)(headers))
+
+    def test_comparisons(self):
+        self.assertSelects("kind = 'a'", {'kind': 'a'})
+        self.assertNotSelects("kind = 'a'", {'kind': 'b'})
+        self.assertSelects("kind <> 'a'", {'kind': 'b'})
+        self.assertSelects("name = 'it''s'", {'name': "it's"})
+        self.assertSelects('size >= 10', {'size': '10'})
+        self.assertNotSelects('size < 2.5', {'size': '3'})
+        self.assertNotSelects('size > 1', {'size': 'big'})
+
+    def test_missing_header(self):
+        self.assertNotSelects("kind = 'a'", {})
+        self.assertSelects('kind IS NULL', {})
+        self.assertSelects('kind is not null', {'kind': 'a'})
+
+    def test_in(self):
+        self.assertSelects("kind IN ('a', 'b')", {'kind': 'b'})
+        self.assertSelects("kind NOT IN ('a', 'b')", {'kind': 'c'})
+
+    def test_logic(self):
+        selector = "kind = 'a' AND (size > 1 OR urgent = 'true')"
+        self.assertSelects(selector, {'kind': 'a', 'urgent': 'true'})
+        self.assertNotSelects(selector, {'kind': 'b', 'size': '2'})
+        self.assertSelects("NOT kind = 'a'", {'kind': 'b'})
+
+    def test_invalid(self):
+        for selector in ("kind = ", "kind 'a'", "(kind = 'a'", "kind = 'a' x"):
+            self.assertRaises(ValueError, testing.Selector, selector)
+
+
+class TopicMatchesTests(unittest.TestCase):
+    def test_topic_matches(self):
+        self.assertTrue(testing.topic_matches('a.b', 'a.b'))
+        self.assertFalse(testing.topic_matches('a.b', 'a.c'))
+        self.assertTrue(testing.topic_matches('a.*', 'a.b'))
+        self.assertFalse(testing.topic_matches('a.*', 'a.b.c'))
+        self.assertTrue(testing.topic_matches('a.>', 'a.b.c'))
+        self.assertTrue(testing.topic_matches('a.>', 'a'))
+        self.assertFalse(testing.topic_matches('a.b.c', 'a.b'))
+
+
+class Listener(listener.ConnectionListener):
+    def __init__(self):
+        self.messages = []
+        self.received = threading.Event()
+
+    def on_message(self, headers, body):
+        self.messages.append((headers, body))
+        self.received.set()
+
+    def wait(self, count):
+        while len(self.messages) < count:
+            self.received.wait(5)
+            self.received.clear()
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class BrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.broker = testing.Broker().start()
+        self.addCleanup(self.broker.stop)
+        self.listener = Listener()
+
+    def connect(self, cls=stomppy.Connection10, **kwargs):
+        conn = cls([self.broker.host_and_port], **kwargs)
+        conn.set_listener('test', self.listener)
+        conn.start()
+        conn.connect(wait=True)
+        self.addCleanup(self.disconnect, conn)
+        return conn
+
+    def disconnect(self, conn):
+        if conn.is_connected():
+            conn.disconnect()
+
+    def test_send_and_receive(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='auto')
+        conn.send('/queue/a', 'hello', custom='header')
+
+        self.listener.wait(1)
+        headers, body = self.listener.messages[0]
+        self.assertEqual(body, 'hello')
+        self.assertEqual(headers['custom'], 'header')
+        self.assertEqual(headers['destination'], '/queue/a')
+        self.assertIn('message-id', headers)
+
+    def test_queued_until_subscribed(self):
+        conn = self.connect()
+        conn.send('/queue/a', 'hello')
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/a') == 1))
+
+        conn.subscribe('/queue/a', ack='auto')
+
+        self.listener.wait(1)
+        self.assertEqual(self.broker.qsize('/queue/a'), 0)
+
+    def test_version_negotiation(self):
+        conn = self.connect(stomppy.Connection12)
+        conn.subscribe('/queue/a', id='sub-1', ack='client-individual')
+        conn.send('/queue/a', 'hello')
+
+        self.listener.wait(1)
+        headers, _ = self.listener.messages[0]
+        self.assertEqual(headers['subscription'], 'sub-1')
+        self.assertEqual(headers['ack'], headers['message-id'])
+
+    def test_unacked_are_redelivered(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='client-individual')
+        conn.send('/queue/a', 'hello')
+        self.listener.wait(1)
+
+        conn.disconnect()
+        self.listener = Listener()
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='client-individual')
+
+        self.listener.wait(1)
+        headers, _ = self.listener.messages[0]
+        self.assertEqual(headers['redelivered'], 'true')
+
+    def test_cumulative_ack(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='client')
+        for body in ('1', '2', '3'):
+            conn.send('/queue/a', body)
+        self.listener.wait(3)
+
+        conn.ack(self.listener.messages[1][0]['message-id'])
+
+        sub = list(self.broker.subscriptions['/queue/a'])[0]
+        self.assertTrue(wait_for(lambda: len(sub.unacked) == 1))
+        self.assertEqual(list(sub.unacked),
+                         [self.listener.messages[2][0]['message-id']])
+
+    def test_transaction__commit(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='auto')
+        transaction = conn.begin()
+        conn.send('/queue/a', 'hello', transaction=transaction)
+        conn.send('/queue/b', 'hello', receipt='sent')
+
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/b') == 1))
+        self.assertEqual(self.listener.messages, [])
+
+        conn.commit(transaction)
+        self.listener.wait(1)
+        headers, _ = self.listener.messages[0]
+        self.assertNotIn('transaction', headers)
+
+    def test_transaction__abort(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='client-individual')
+        conn.send('/queue/a', 'hello')
+        self.listener.wait(1)
+        msg_id = self.listener.messages[0][0]['message-id']
+
+        transaction = conn.begin()
+        conn.send('/queue/a', 'discarded', transaction=transaction)
+        conn.ack(msg_id, transaction=transaction)
+        conn.abort(transaction)
+        conn.send('/queue/b', 'hello')
+
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/b') == 1))
+        sub = list(self.broker.subscriptions['/queue/a'])[0]
+        self.assertEqual(list(sub.unacked), [msg_id])
+        self.assertEqual(self.broker.qsize('/queue/a'), 0)
+
+    def test_prefetch(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='client-individual',
+                       headers={'activemq.prefetchSize': 1})
+        for body in ('1', '2'):
+            conn.send('/queue/a', body)
+
+        self.listener.wait(1)
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/a') == 1))
+        self.assertEqual(len(self.listener.messages), 1)
+
+        conn.ack(self.listener.messages[0][0]['message-id'])
+        self.listener.wait(2)
+
+    def test_selector(self):
+        conn = self.connect()
+        conn.subscribe('/queue/a', ack='auto',
+                       headers={'selector': "kind = 'b'"})
+        conn.send('/queue/a', '1', headers={'kind': 'a'})
+        conn.send('/queue/a', '2', headers={'kind': 'b'})
+
+        self.listener.wait(1)
+        self.assertEqual(self.listener.messages[0][1], '2')
+        # kept for other consumers
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/a') == 1))
+
+    def test_priority(self):
+        conn = self.connect()
+        conn.send('/queue/a', '1')
+        conn.send('/queue/a', '2', headers={'priority': 9})
+        conn.send('/queue/a', '3', headers={'priority': 9})
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/a') == 3))
+
+        conn.subscribe('/queue/a', ack='auto')
+
+        self.listener.wait(3)
+        self.assertEqual([body for _, body in self.listener.messages],
+                         ['2', '3', '1'])
+
+    def test_expired(self):
+        conn = self.connect()
+        conn.send('/queue/a', '1', headers={'expires': 1})
+        conn.send('/queue/a', '2')
+        self.assertTrue(wait_for(lambda: self.broker.qsize('/queue/a') == 2))
+
+        conn.subscribe('/queue/a', ack='auto')
+
+        self.listener.wait(1)
+        self.assertEqual(self.listener.messages[0][1], '2')
+        self.assertEqual(self.broker.stats['expired'], 1)
+
+    def test_topic(self):
+        conn = self.connect()
+        conn.subscribe('/topic/a.b', ack='auto')
+        conn.subscribe('/topic/a.*', ack='client-individual')
+        conn.send('/topic/a.b', 'hello')
+
+        self.listener.wait(2)
+        self.assertEqual(
+            sorted(headers['subscription']
+                   for headers, _ in self.listener.messages),
+            ['/topic/a.*', '/topic/a.b'],
+        )
+        # not kept for later subscribers
+        self.assertEqual(self.broker.qsize('/topic/a.b'), 0)
+
+    def test_virtual_topic(self):
+        conn = self.connect()
+        conn.subscribe('/queue/Consumer.a.VirtualTopic.t', ack='auto')
+        conn.send('/topic/VirtualTopic.t', 'hello')
+        self.listener.wait(1)
+
+        conn.unsubscribe('/queue/Consumer.a.VirtualTopic.t')
+        conn.send('/topic/VirtualTopic.t', 'kept', receipt='sent')
+
+        # queued while nobody consumes
+        self.assertTrue(wait_for(
+            lambda: self.broker.qsize('/queue/Consumer.a.VirtualTopic.t') == 1
+        ))
+
+    def test_heartbeat_timeout(self):
+        self.broker.heartbeats = (100, 0)
+        conn = self.connect(stomppy.Connection12, heartbeats=(0, 100))
+
+        self.assertTrue(wait_for(lambda: not conn.is_connected()))
+
+    def test_stats(self):
+        conn = self.connect()
+        conn.send('/queue/a', 'hello')
+
+        self.assertTrue(wait_for(lambda: self.broker.stats['SEND'] == 1))
+        self.assertGreater(self.broker.stats['SEND_bytes'], len('hello'))
+
+
+class TransportTests(unittest.TestCase):
+    """End to end tests, going through Kombu and the STOMP transport."""
+    def setUp(self):
+        kombu_stomp.register_transport()
+        self.broker = testing.Broker().start()
+        self.addCleanup(self.broker.stop)
+        self.conn = kombu.Connection(
+            'stomp://{0}:{1}'.format(*self.broker.host_and_port),
+        )
+        self.addCleanup(self.conn.release)
+        self.queue = kombu.Queue('queue', routing_key='queue')
+
+    def test_publish_and_consume(self):
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.headers))
+            message.ack()
+
+        producer = self.conn.Producer(serializer='json')
+        producer.publish({'hello': 'world'},
+                         routing_key='queue',
+                         headers={'task': 'add'})
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [({'hello': 'world'}, {'task': 'add'})])
+
+    def test_idle_consumer(self):
+        """Waiting without deliverable messages takes little CPU."""
+        self.conn.transport_options['consume_timeout'] = 0.1
+        messages = []
+        consumer = self.conn.Consumer(
+            [self.queue],
+            callbacks=[lambda body, message: messages.append(message)],
+        )
+        consumer.qos(prefetch_count=1)
+        for body in ('a', 'b'):
+            self.conn.Producer().publish(body, routing_key='queue')
+
+        with consumer:
+            self.conn.drain_events(timeout=5)
+            # the prefetch limit is reached, then nothing is consumed
+            for consuming in (True, False):
+                if not consuming:
+                    consumer.cancel()
+                start, times = time.time(), os.times()
+                with self.assertRaises(socket.timeout):
+                    self.conn.drain_events(timeout=1)
+                wall = time.time() - start
+                cpu = sum(os.times()[:2]) - sum(times[:2])
+                self.assertLess(cpu, wall / 4)
+        self.assertEqual(len(messages), 1)
+
+    def test_idle_channel(self):
+        """An idle channel doesn't hold back the others."""
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        idle = kombu.Queue('idle', routing_key='idle')
+        for queue in (idle, self.queue):
+            kombu.Consumer(self.conn.channel(), [queue],
+                           callbacks=[callback]).consume()
+        producer = self.conn.Producer(serializer='json')
+
+        start = time.time()
+        for i in range(5):
+            producer.publish(i, routing_key='queue')
+            self.conn.drain_events(timeout=5)
+
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(received, list(range(5)))
+
+    def test_drain_events__timeout(self):
+        queues = [kombu.Queue(name, routing_key=name)
+                  for name in ('a', 'b', 'c')]
+        for queue in queues:
+            kombu.Consumer(self.conn.channel(), [queue]).consume()
+        start = time.time()
+
+        with self.assertRaises(socket.timeout):
+            self.conn.drain_events(timeout=0.3)
+
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_reject__frees_prefetch_slot(self):
+        producer = self.conn.Producer(serializer='json')
+        for i in range(4):
+            producer.publish(i, routing_key='queue')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.reject()
+
+        consumer = self.conn.Consumer([self.queue], callbacks=[callback])
+        consumer.qos(prefetch_count=2)
+        with consumer:
+            for _ in range(4):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [0, 1, 2, 3])
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 4))
+        self.assertEqual(self.broker.stats['NACK'], 0)
+        self.assertEqual(self.broker.qsize('/queue/queue'), 0)
+
+    def test_undecodable_message(self):
+        self.broker.publish({'destination': '/queue/queue',
+                             'properties': '{'}, b'')
+        self.conn.Producer(serializer='json').publish('hello',
+                                                      routing_key='queue')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        consumer = self.conn.Consumer([self.queue], callbacks=[callback])
+        consumer.qos(prefetch_count=1)
+        with mock.patch.object(stomp.logger, 'exception') as log:
+            with consumer:
+                # the first one doesn't keep the only prefetch slot
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, ['hello'])
+        log.assert_called_once_with('Failed decoding message')
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 2))
+        self.assertEqual(self.broker.qsize('/queue/queue'), 0)
+
+    def test_prefetch_count__after_consuming(self):
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        producer = self.conn.Producer()
+        for i in range(20):
+            producer.publish(i, routing_key='queue')
+        consumer = self.conn.Consumer([self.queue], callbacks=[callback])
+        with consumer:
+            # like Celery does
+            consumer.qos(prefetch_count=2)
+            self.conn.drain_events(timeout=5)
+            channel = self.conn.default_channel
+            time.sleep(0.1)
+            self.assertLessEqual(channel.buffer_stats()['messages'], 2)
+            while len(received) < 20:
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(sorted(received), list(range(20)))
+        self.assertEqual(self.broker.stats['UNSUBSCRIBE'], 1)
+
+    def test_heartbeats__full_buffer(self):
+        """A slow consumer doesn't make the connection time out."""
+        self.broker.heartbeats = (100, 0)
+        self.broker.send_heartbeats = True
+        self.conn.transport_options.update(stomp_version='1.2',
+                                           heartbeats=(0, 100),
+                                           receive_buffer_size=2)
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        producer = self.conn.Producer()
+        for i in range(6):
+            producer.publish(i, routing_key='queue')
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+            stomp_conn = self.conn.default_channel.stomp_conn
+            # the receiver thread waits for room meanwhile
+            time.sleep(0.5)
+            self.assertTrue(stomp_conn.is_connected())
+            for _ in range(5):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, list(range(6)))
+        self.assertIs(self.conn.default_channel.stomp_conn, stomp_conn)
+        self.assertEqual(self.broker.stats['CONNECT'] +
+                         self.broker.stats['STOMP'], 1)
+
+    def consume_one(self, conn):
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        conn.Producer(serializer='json').publish('hello',
+                                                 routing_key='queue')
+        with conn.Consumer([self.queue], callbacks=[callback]):
+            conn.drain_events(timeout=5)
+        return received
+
+    def test_stomp_1_1(self):
+        self.conn.transport_options['stomp_version'] = '1.1'
+
+        self.assertEqual(self.consume_one(self.conn), ['hello'])
+        stomp_conn = self.conn.default_channel.stomp_conn
+        self.assertEqual(stomp_conn.version, '1.1')
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 1))
+
+    def test_older_broker(self):
+        self.broker.versions = ('1.0',)
+
+        self.assertEqual(self.consume_one(self.conn), ['hello'])
+        self.assertEqual(self.conn.default_channel.stomp_version, '1.0')
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 1))
+
+    def test_prefetch_count(self):
+        producer = self.conn.Producer(serializer='json')
+        for i in range(3):
+            producer.publish(i, routing_key='queue')
+        messages = []
+        consumer = self.conn.Consumer(
+            [self.queue],
+            callbacks=[lambda body, message: messages.append(message)],
+        )
+        consumer.qos(prefetch_count=2)
+        channel = self.conn.default_channel
+
+        with consumer:
+            self.conn.drain_events(timeout=5)
+            # the second message is buffered, the third one kept in the broker
+            self.assertTrue(
+                wait_for(lambda: channel.buffer_stats()['messages'] == 1))
+            self.assertGreater(channel.buffer_stats()['bytes'], 0)
+            self.assertEqual(self.broker.qsize('/queue/queue'), 1)
+
+            messages[0].ack()
+            self.assertTrue(
+                wait_for(lambda: self.broker.qsize('/queue/queue') == 0))
+            self.conn.drain_events(timeout=5)
+            for message in messages[1:]:
+                message.ack()
+
+    def test_queues_take_turns(self):
+        queues = [self.queue, kombu.Queue('other', routing_key='other')]
+        producer = self.conn.Producer(serializer='json')
+        for i in range(10):
+            producer.publish('busy', routing_key='queue')
+        producer.publish('other', routing_key='other')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        channel = self.conn.default_channel
+        with self.conn.Consumer(queues, callbacks=[callback]):
+            # wait until everything was received, so the busy queue had a
+            # head start
+            self.assertTrue(
+                wait_for(lambda: channel.buffer_stats()['messages'] == 11))
+            for _ in range(11):
+                self.conn.drain_events(timeout=5)
+
+        self.assertIn('other', received[:2])
+
+    def test_selector(self):
+        self.conn.transport_options['filter_headers'] = ['kind']
+        producer = self.conn.Producer(serializer='json')
+        for kind in ('a', 'b', 'a'):
+            producer.publish(kind, routing_key='queue', headers={'kind': kind})
+        queue = kombu.Queue('queue', routing_key='queue',
+                            queue_arguments={'selector': "kind = 'a'"})
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.headers))
+            message.ack()
+
+        with self.conn.Consumer([queue], callbacks=[callback]):
+            for _ in range(2):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [('a', {'kind': 'a'})] * 2)
+        # never left the broker
+        self.assertEqual(self.broker.qsize('/queue/queue'), 1)
+
+    def test_priority_and_expiration(self):
+        producer = self.conn.Producer(serializer='json')
+        producer.publish('expired', routing_key='queue', expiration=0.001)
+        producer.publish('low', routing_key='queue')
+        producer.publish('high', routing_key='queue', priority=5)
+        producer.publish('expiring', routing_key='queue', expiration=60)
+        self.assertTrue(
+            wait_for(lambda: self.broker.qsize('/queue/queue') == 4))
+        time.sleep(0.01)
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.properties.get('expiration')))
+            message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            for _ in range(3):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual([body for body, _ in received],
+                         ['high', 'low', 'expiring'])
+        self.assertIsNone(received[0][1])
+        self.assertLessEqual(int(received[2][1]), 60000)
+        self.assertEqual(self.broker.stats['expired'], 1)
+
+    def test_default_priority(self):
+        producer = self.conn.Producer(serializer='json')
+        producer.publish('lowest', routing_key='queue', priority=1)
+        producer.publish('default', routing_key='queue')
+        self.assertTrue(
+            wait_for(lambda: self.broker.qsize('/queue/queue') == 2))
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.delivery_info['priority']))
+            message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            for _ in range(2):
+                self.conn.drain_events(timeout=5)
+
+        # not sent as Kombu's 0, so the broker's default applies
+        self.assertEqual(received, [('default', 4), ('lowest', 1)])
+
+    def test_requeue(self):
+        self.conn.Producer(serializer='json').publish('hello',
+                                                      routing_key='queue')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            if len(received) == 1:
+                message.requeue()
+            else:
+                message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            for _ in range(2):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, ['hello', 'hello'])
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 1))
+        # redelivered by the broker, not published again
+        self.assertEqual(self.broker.stats['NACK'], 1)
+        self.assertEqual(self.broker.stats['SEND'], 1)
+
+    def test_restore_unacked(self):
+        self.conn.Producer(serializer='json').publish('hello',
+                                                      routing_key='queue')
+        with self.conn.Consumer([self.queue],
+                                callbacks=[lambda body, message: None]):
+            self.conn.drain_events(timeout=5)
+        self.conn.release()
+
+        self.assertTrue(
+            wait_for(lambda: self.broker.qsize('/queue/queue') == 1))
+        self.assertEqual(self.broker.stats['NACK'], 1)
+        self.assertEqual(self.broker.stats['SEND'], 1)
+
+    def consume_broadcast(self, exchange_type, routing_key=''):
+        # bindings are kept by Kombu for the whole process
+        exchange = kombu.Exchange(exchange_type, exchange_type)
+        queues = [kombu.Queue(exchange_type + name, exchange,
+                              routing_key=routing_key)
+                  for name in ('a', 'b')]
+        received = []
+
+        def callback(body, message):
+            received.append((body, message.delivery_info['routing_key']))
+            message.ack()
+
+        with self.conn.Consumer(queues, callbacks=[callback]):
+            self.conn.Producer(serializer='json').publish(
+                'hello', exchange=exchange, routing_key='event.created')
+            for _ in range(2):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [('hello', 'event.created')] * 2)
+        # the broker made the copies
+        self.assertEqual(self.broker.stats['SEND'], 1)
+
+    def test_fanout(self):
+        self.consume_broadcast('fanout')
+
+    def test_fanout__virtual_topics(self):
+        self.conn.transport_options['virtual_topics'] = True
+        self.consume_broadcast('fanout')
+
+    def test_topic_exchanges(self):
+        self.conn.transport_options['topic_exchanges'] = True
+        self.consume_broadcast('topic', routing_key='event.#')
+
+    def test_decode_workers(self):
+        self.conn.transport_options['decode_workers'] = 4
+        producer = self.conn.Producer(serializer='json')
+        for i in range(20):
+            producer.publish(i, routing_key='queue')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            for _ in range(20):
+                self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, list(range(20)))
+
+    def test_compression(self):
+        self.conn.transport_options.update(compression='zlib',
+                                           compression_threshold=100)
+        payload = [{'id': i, 'name': 'item'} for i in range(100)]
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        self.conn.Producer(serializer='json').publish(payload,
+                                                      routing_key='queue')
+        self.assertTrue(wait_for(lambda: self.broker.stats['SEND'] == 1))
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [payload])
+        self.assertLess(self.broker.stats['SEND_bytes'],
+                        len(json.dumps(payload)))
+
+    def test_raw_body(self):
+        self.conn.transport_options['body_encoding'] = None
+        body = b'\x00\xff' * 5000
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        self.conn.Producer().publish(body,
+                                     routing_key='queue',
+                                     content_type='application/data',
+                                     content_encoding='binary')
+        self.assertTrue(wait_for(lambda: self.broker.stats['SEND'] == 1))
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, [body])
+        # base64 would take 4/3 of it
+        self.assertLess(self.broker.stats['SEND_bytes'], len(body) * 4 / 3)
+
+    def test_metrics(self):
+        m = metrics.InMemoryMetrics()
+        self.conn.transport_options['metrics'] = m
+
+        self.assertEqual(self.consume_one(self.conn), ['hello'])
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 1))
+
+        channel = self.conn.default_channel.channel_id
+        self.assertEqual(m.get('kombu_stomp_frames_sent_total',
+                               channel=channel,
+                               command='SEND'), 1)
+        self.assertEqual(m.get('kombu_stomp_frames_sent_total',
+                               channel=channel,
+                               command='ACK'), 1)
+        self.assertEqual(m.get('kombu_stomp_frames_received_total',
+                               channel=channel,
+                               command='MESSAGE'), 1)
+        self.assertEqual(m.get('kombu_stomp_unacked_messages',
+                               channel=channel), 0)
+        self.assertIn('# TYPE kombu_stomp_ack_latency_seconds histogram',
+                      m.render())
+
+    def test_trace(self):
+        messages = []
+        self.conn.transport_options['trace_callback'] = messages.append
+
+        self.assertEqual(self.consume_one(self.conn), ['hello'])
+
+        message, = messages
+        self.assertEqual(message.queue, 'queue')
+        self.assertEqual(message.broker, self.broker.host_and_port)
+        # the broker timestamp has millisecond precision
+        self.assertGreater(message.queue_wait, -0.001)
+        self.assertGreaterEqual(message.buffer_wait, 0)
+        self.assertLess(message.latency, 5)
+        self.assertLessEqual(message.published_at, message.delivered_at)
+
+    def test_failover(self):
+        standby = testing.Broker().start()
+        self.addCleanup(standby.stop)
+        self.conn.transport_options['failover'] = [
+            '{0}:{1}'.format(*standby.host_and_port),
+        ]
+        channel = self.conn.default_channel
+        producer = self.conn.Producer(serializer='json')
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            producer.publish('first', routing_key='queue')
+            self.conn.drain_events(timeout=5)
+            self.broker.stop()
+            self.assertTrue(
+                wait_for(lambda: not channel.stomp_conn.is_connected()))
+
+            # resubscribed to the standby broker
+            producer.publish('second', routing_key='queue')
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, ['first', 'second'])
+        self.assertEqual(channel.stomp_conn.transport.current_host_and_port,
+                         standby.host_and_port)
+        self.assertEqual(
+            self.conn.transport.broker_latency[self.broker.host_and_port],
+            transport.FAILED,
+        )
+        self.assertLess(channel.failover_time, 5)
+
+    def test_failover__unacked(self):
+        standby = testing.Broker().start()
+        self.addCleanup(standby.stop)
+        reconnected = []
+        self.conn.transport_options.update(
+            failover=[standby.host_and_port],
+            reconnect_callback=reconnected.append,
+        )
+        channel = self.conn.default_channel
+        producer = self.conn.Producer(serializer='json')
+        messages = []
+        consumer = self.conn.Consumer(
+            [self.queue],
+            callbacks=[lambda body, message: messages.append(message)],
+        )
+        consumer.qos(prefetch_count=1)
+
+        with consumer:
+            producer.publish('first', routing_key='queue')
+            self.conn.drain_events(timeout=5)
+            self.broker.stop()
+            self.assertTrue(
+                wait_for(lambda: not channel.stomp_conn.is_connected()))
+
+            # the unacked message delivered before doesn't hold the prefetch
+            # slot, since the lost broker redelivers it
+            producer.publish('second', routing_key='queue')
+            self.conn.drain_events(timeout=5)
+            for message in messages:
+                message.ack()
+
+        self.assertEqual([m.payload for m in messages], ['first', 'second'])
+        self.assertEqual(reconnected, [channel])
+        self.assertTrue(wait_for(lambda: standby.stats['ACK'] == 1))
+
+    def consume_shared(self, names):
+        """Consume a message from every queue in ``names``, through a channel
+        each, and return the channels.
+        """
+        self.conn.transport_options['shared_connection'] = True
+        channels = [self.conn.channel() for _ in names]
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        for channel, name in zip(channels, names):
+            kombu.Consumer(channel,
+                           [kombu.Queue(name, routing_key=name)],
+                           callbacks=[callback]).consume()
+        producer = kombu.Producer(channels[0], serializer='json')
+        for name in names:
+            producer.publish(name, routing_key=name)
+        # draining waits on every channel, so they must have their message
+        for channel in channels:
+            self.assertTrue(
+                wait_for(lambda: channel.buffer_stats()['messages'] == 1))
+        for _ in names:
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(sorted(received), sorted(names))
+        return channels
+
+    def test_shared_connection(self):
+        channels = self.consume_shared(['a', 'b'])
+
+        self.assertEqual(len(self.broker.sessions), 1)
+        self.assertTrue(wait_for(lambda: self.broker.stats['ACK'] == 2))
+
+        # closing a channel only unsubscribes it
+        channels[0].close()
+        self.assertTrue(channels[1].stomp_conn.is_connected())
+        self.assertTrue(
+            wait_for(lambda: not self.broker.subscriptions['/queue/a']))
+        self.assertEqual(len(self.broker.subscriptions['/queue/b']), 1)
+
+    def test_shared_connection__full_buffer(self):
+        self.conn.transport_options['shared_connection'] = True
+        self.conn.transport_options['receive_buffer_size'] = 1
+        channels = [self.conn.channel() for _ in 'ab']
+        producer = kombu.Producer(channels[0], serializer='json')
+        for _ in range(3):
+            producer.publish('a', routing_key='a')
+        producer.publish('b', routing_key='b')
+
+        for channel, name in zip(channels, 'ab'):
+            kombu.Consumer(channel,
+                           [kombu.Queue(name, routing_key=name)],
+                           callbacks=[lambda body, message: None]).consume()
+
+        # the broker only pushes what fits in the buffer of the first one,
+        # so the second one gets its message
+        self.assertTrue(
+            wait_for(lambda: channels[1].buffer_stats()['messages'] == 1))
+        self.assertEqual(channels[0].buffer_stats()['messages'], 1)
+        self.assertEqual(self.broker.qsize('/queue/a'), 2)
+
+    def test_shared_connection__failover(self):
+        standby = testing.Broker().start()
+        self.addCleanup(standby.stop)
+        self.conn.transport_options['failover'] = [standby.host_and_port]
+        channels = self.consume_shared(['a', 'b'])
+        self.broker.stop()
+        self.assertTrue(
+            wait_for(lambda: not channels[0].stomp_conn.is_connected()))
+
+        for channel in channels:
+            with channel.conn_or_acquire():
+                pass
+
+        # both resubscribed through a single connection to the standby
+        self.assertTrue(wait_for(
+            lambda: all(standby.subscriptions['/queue/' + name]
+                        for name in 'ab')))
+        self.assertEqual(len(standby.sessions), 1)
+
+    def test_transaction(self):
+        channel = self.conn.default_channel
+        producer = self.conn.Producer(channel, serializer='json')
+
+        with self.assertRaises(RuntimeError):
+            with channel.transaction():
+                producer.publish('aborted', routing_key='queue')
+                raise RuntimeError()
+        with channel.transaction():
+            producer.publish('committed', routing_key='queue')
+
+        received = []
+
+        def callback(body, message):
+            received.append(body)
+            message.ack()
+
+        with self.conn.Consumer([self.queue], callbacks=[callback]):
+            self.conn.drain_events(timeout=5)
+
+        self.assertEqual(received, ['committed'])
+        self.assertEqual(self.broker.qsize('/queue/queue'), 0)
@@ -1,5 +1,19 @@
+import socket
+import threading
+import time
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from kombu.transport import virtual
+from six.moves import queue as _queue
 from stomp import exception as exc
 
+from kombu_stomp import metrics
+from kombu_stomp import stomp
 from kombu_stomp import transport
 from kombu_stomp.utils import mock
 from kombu_stomp.utils import unittest
@@ -33,6 +47,15 @@ class MessageTests(unittest.TestCase):
         self.assertEqual(self.raw_message['body'].encode(), message.body)
         self.assertIsNone(message.msg_id)
 
+    def test_init__kombu_4_arguments(self):
+        message = transport.Message(
+            (self.raw_message, self.msg_id),
+            channel=self.channel,
+        )
+        self.assertEqual(self.raw_message['body'].encode(), message.body)
+        self.assertEqual(message.msg_id, self.msg_id)
+        self.assertIs(message.channel, self.channel)
+
     def test_init__raw_message_and_id(self):
         message = transport.Message(
             self.channel,
@@ -41,16 +64,179 @@ class MessageTests(unittest.TestCase):
         # The encode is required in Python 3, since kombu is doing it
         self.assertEqual(self.raw_message['body'].encode(), message.body)
         self.assertEqual(message.msg_id, self.msg_id)
+        self.assertIsNone(message.queue)
+
+    def test_init__raw_message_id_and_queue(self):
+        message = transport.Message(
+            self.channel,
+            (self.raw_message, self.msg_id, 'queue'),
+        )
+        self.assertEqual(message.msg_id, self.msg_id)
+        self.assertEqual(message.queue, 'queue')
+
+    def test_init__trace(self):
+        trace = {
+            'published_at': 100.0,
+            'broker_timestamp': 101.0,
+            'received_at': 103.0,
+            'broker': ('broker', 61613),
+        }
+        with mock.patch('time.time', return_value=106.0):
+            message = transport.Message(
+                self.channel,
+                (self.raw_message, self.msg_id, 'queue', trace),
+            )
+
+        self.assertEqual(message.broker, ('broker', 61613))
+        self.assertEqual(message.queue_wait, 2.0)
+        self.assertEqual(message.buffer_wait, 3.0)
+        self.assertEqual(message.latency, 6.0)
+        self.channel.trace.assert_called_once_with(message)
+
+    def test_init__no_trace(self):
+        message = transport.Message(self.channel, self.raw_message)
+
+        self.assertIsNone(message.queue_wait)
+        self.assertIsNone(message.buffer_wait)
+        self.assertIsNone(message.latency)
+        self.assertFalse(self.channel.trace.called)
+
+
+class UnackedTests(unittest.TestCase):
+    def setUp(self):
+        self.unacked = transport.Unacked()
+
+    def test_mapping(self):
+        self.unacked['tag-1'] = 'msg-1'
+        self.unacked.add('tag-2', 'msg-2', 1.0)
+
+        self.assertEqual(dict(self.unacked), {'tag-1': 'msg-1',
+                                              'tag-2': 'msg-2'})
+        del self.unacked['tag-1']
+        self.assertEqual(self.unacked.pop('tag-2'), 'msg-2')
+        self.assertEqual(len(self.unacked), 0)
+        with self.assertRaises(KeyError):
+            del self.unacked['tag-1']
+
+    def test_settle(self):
+        self.unacked.add('tag-1', 'msg-1', 1.0)
+        self.unacked.add('tag-2', 'msg-2')
+
+        self.assertEqual(self.unacked.settle('tag-1'), ('msg-1', 1.0))
+        self.assertEqual(self.unacked.settle('tag-2'), ('msg-2', None))
+        self.assertEqual(self.unacked.settle('tag-2'), (None, None))
+
+    def test_add__reuses_slots(self):
+        self.unacked.add('tag-1', 'msg-1')
+        self.unacked.add('tag-2', 'msg-2')
+        self.unacked.settle('tag-1')
+
+        self.unacked.add('tag-3', 'msg-3')
+        self.unacked.add('tag-3', 'msg-4')
+
+        self.assertEqual(self.unacked.stats()['slots'], 2)
+        self.assertEqual(self.unacked['tag-3'], 'msg-4')
+
+    def test_settle__releases_slots_when_empty(self):
+        self.unacked.add('tag-1', 'msg-1')
+        empty = transport.Unacked().stats()
+
+        self.unacked.settle('tag-1')
+
+        self.assertEqual(self.unacked.stats(), empty)
+
+    def test_settle__compacts(self):
+        for i in range(100):
+            self.unacked.add(i, 'msg-{0}'.format(i), float(i))
+
+        for i in range(90):
+            self.unacked.settle(i)
+
+        self.assertLess(self.unacked.stats()['slots'], 100)
+        self.assertEqual(dict(self.unacked),
+                         dict((i, 'msg-{0}'.format(i))
+                              for i in range(90, 100)))
+        self.assertEqual(self.unacked.settle(95), ('msg-95', 95.0))
+
+    def test_clear(self):
+        self.unacked.add('tag-1', 'msg-1')
+
+        self.unacked.clear()
+
+        self.assertEqual(self.unacked.stats(), transport.Unacked().stats())
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc not available')
+    def test_soak(self):
+        """Memory stays flat while messages keep being delivered and
+        settled, out of order.
+        """
+        tags = [str(i) for i in range(1000)]
+
+        def cycle():
+            for tag in tags:
+                self.unacked.add(tag, tag, 1.0)
+                # a few messages left unacked for longer
+                if int(tag) % 10:
+                    self.unacked.settle(tag)
+            for tag in tags[::10]:
+                self.unacked.settle(tag)
+
+        cycle()
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(50):
+            cycle()
+        after = tracemalloc.get_traced_memory()[0]
+
+        self.assertLess(after - before, 1024)
+        self.assertEqual(self.unacked.stats()['messages'], 0)
 
 
 class QoSTests(unittest.TestCase):
     def setUp(self):
-        self.channel = mock.MagicMock()
+        self.channel = mock.MagicMock(
+            ack_mode='client-individual',
+            ack_batch_size=1,
+            ack_flush_interval=1.0,
+        )
         self.qos = transport.QoS(self.channel)
         self.msg_id = 'msg-id'
-        self.msg = mock.Mock(msg_id=self.msg_id)
+        self.msg = mock.Mock(msg_id=self.msg_id, queue='queue')
         self.delivery_tag = '423e3830-e67a-458d-9aa0-f58df4d01639'
 
+    @property
+    def conn(self):
+        return self.channel.conn_or_acquire.return_value.__enter__.return_value
+
+    def deliver(self, *msg_ids, **kwargs):
+        for msg_id in msg_ids:
+            message = mock.Mock(msg_id=msg_id,
+                                queue=kwargs.get('queue', 'queue'))
+            self.qos.append(message, 'tag-' + msg_id)
+        self.addCleanup(self.qos._delivered.clear)
+
+    def test_metrics(self):
+        self.channel.metrics = metrics.InMemoryMetrics()
+        self.deliver('a', 'b')
+
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_unacked_messages'), 2)
+
+        self.qos.ack('tag-a')
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_unacked_messages'), 1)
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_ack_latency_seconds')[0], 1)
+
+        self.assertGreater(
+            self.channel.metrics.get('kombu_stomp_unacked_bytes'), 0)
+
+        self.qos.reject('tag-b')
+        self.assertEqual(self.qos.ids.stats()['messages'], 0)
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_unacked_messages'), 0)
+
     @mock.patch('kombu.transport.virtual.QoS.append')
     def test_append__calls_super(self, append):
         self.qos.append(self.msg, self.delivery_tag)
@@ -58,7 +244,7 @@ class QoSTests(unittest.TestCase):
 
     def test_append__saves_message_id_reference(self):
         self.qos.append(self.msg, self.delivery_tag)
-        self.assertDictEqual(self.qos.ids, {self.delivery_tag: self.msg_id})
+        self.assertEqual(dict(self.qos.ids), {self.delivery_tag: self.msg_id})
 
     @mock.patch('kombu.transport.virtual.QoS.ack')
     def test_ack__calls_super(self, ack):
@@ -82,6 +268,416 @@ class QoSTests(unittest.TestCase):
         self.qos._stomp_ack(self.delivery_tag)
         self.assertFalse(self.channel.conn_or_acquire.called)
 
+    def test_stomp_ack__batch(self):
+        self.channel.ack_batch_size = 2
+        self.deliver('1', '2', '3')
+
+        self.qos.ack('tag-1')
+        self.assertFalse(self.conn.ack.called)
+
+        self.qos.ack('tag-2')
+        self.assertEqual(self.conn.ack.call_args_list,
+                         [mock.call('1'), mock.call('2')])
+
+    def test_stomp_ack__batch_order(self):
+        self.channel.ack_batch_size = 10
+        msg_ids = [str(i) for i in range(9, -1, -1)]
+        self.deliver(*msg_ids)
+
+        for msg_id in msg_ids:
+            self.qos.ack('tag-' + msg_id)
+
+        self.assertEqual(self.conn.ack.call_args_list,
+                         [mock.call(msg_id) for msg_id in msg_ids])
+
+    def test_stomp_ack__flush_interval(self):
+        self.channel.ack_batch_size = 10
+        self.channel.ack_flush_interval = 0
+        self.deliver('1')
+
+        self.qos.ack('tag-1')
+
+        self.conn.ack.assert_called_once_with('1')
+
+    def test_flush_acks__nothing_pending(self):
+        self.qos.flush_acks()
+        self.assertFalse(self.channel.conn_or_acquire.called)
+
+    def test_flush_acks__cumulative(self):
+        self.channel.ack_mode = 'client'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2', '3')
+
+        self.qos.ack('tag-1')
+        self.qos.ack('tag-2')
+        self.qos.flush_acks()
+
+        self.conn.ack.assert_called_once_with('2')
+
+    def test_flush_acks__cumulative_waits_for_earlier_messages(self):
+        self.channel.ack_mode = 'client'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2', '3')
+
+        self.qos.ack('tag-2')
+        self.qos.ack('tag-3')
+        self.qos.flush_acks()
+        self.assertFalse(self.conn.ack.called)
+
+        self.qos.ack('tag-1')
+        self.qos.flush_acks()
+        self.conn.ack.assert_called_once_with('3')
+
+    def test_flush_acks__cumulative_per_queue(self):
+        self.channel.ack_mode = 'client'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2', queue='a')
+        self.deliver('3', queue='b')
+
+        for msg_id in '123':
+            self.qos.ack('tag-' + msg_id)
+        self.qos.flush_acks()
+
+        self.assertEqual(sorted(c[0][0] for c in self.conn.ack.call_args_list),
+                         ['2', '3'])
+
+    def test_reject__cumulative_acks_message(self):
+        self.channel.ack_mode = 'client'
+        self.deliver('1')
+
+        self.qos.reject('tag-1')
+
+        self.conn.ack.assert_called_once_with('1')
+
+    def test_reject__individual_acks(self):
+        self.deliver('1')
+
+        self.qos.reject('tag-1')
+
+        self.conn.ack.assert_called_once_with('1')
+        self.assertFalse(self.conn.nack.called)
+        self.assertEqual(self.qos.ids, {})
+
+    def test_discard_stale(self):
+        self.channel.ack_mode = 'client'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2')
+        self.qos.ack('tag-1')
+
+        self.qos.discard_stale()
+        self.qos.flush_acks()
+
+        self.assertEqual(self.qos.ids, {})
+        self.assertFalse(self.conn.ack.called)
+
+    def test_discard_stale__releases_prefetch(self):
+        self.qos.prefetch_count = 1
+        self.deliver('1')
+        self.assertFalse(self.qos.can_consume())
+
+        self.qos.discard_stale()
+
+        self.assertTrue(self.qos.can_consume())
+        # nothing to restore when closing
+        self.assertEqual(self.qos.restore_unacked(), [])
+
+    def test_reject__stale_requeue(self):
+        self.deliver('1')
+        self.qos.discard_stale()
+
+        self.qos.reject('tag-1', requeue=True)
+
+        self.assertFalse(self.channel._restore_at_beginning.called)
+
+    def test_reject__requeue_nacks(self):
+        self.deliver('1')
+
+        self.qos.reject('tag-1', requeue=True)
+
+        self.conn.nack.assert_called_once_with('1')
+        self.assertFalse(self.conn.ack.called)
+        self.assertFalse(self.channel._restore_at_beginning.called)
+        self.assertEqual(self.qos.ids, {})
+
+    def test_reject__requeue_nacks_within_transaction(self):
+        self.deliver('1')
+        self.qos.begin_transaction('tx')
+
+        self.qos.reject('tag-1', requeue=True)
+
+        self.conn.nack.assert_called_once_with('1', transaction='tx')
+
+    def test_reject__requeue_stomp_1_0(self):
+        self.channel.stomp_version = '1.0'
+        self.deliver('1')
+
+        self.qos.reject('tag-1', requeue=True)
+
+        # not redelivered on top of the restored message
+        self.conn.ack.assert_called_once_with('1')
+        self.assertFalse(self.conn.nack.called)
+        self.assertTrue(self.channel._restore_at_beginning.called)
+
+    def test_reject__requeue_cumulative_acks(self):
+        self.channel.ack_mode = 'client'
+        self.deliver('1')
+
+        self.qos.reject('tag-1', requeue=True)
+
+        self.conn.ack.assert_called_once_with('1')
+        self.assertFalse(self.conn.nack.called)
+
+    def test_restore_unacked__nacks(self):
+        self.deliver('1', '2')
+        self.qos.ack('tag-1')
+
+        self.assertEqual(self.qos.restore_unacked(), [])
+
+        self.channel.stomp_conn.nack.assert_called_once_with('2')
+        self.assertFalse(self.channel._restore.called)
+        self.assertFalse(self.qos._delivered)
+
+    def test_restore_unacked__disconnected(self):
+        self.channel.stomp_conn.is_connected.return_value = False
+        self.deliver('1')
+
+        self.assertEqual(self.qos.restore_unacked(), [])
+
+        # redelivered by the broker
+        self.assertFalse(self.channel.stomp_conn.nack.called)
+        self.assertFalse(self.channel._restore.called)
+        self.assertFalse(self.qos._delivered)
+        self.assertEqual(self.qos.ids, {})
+
+    def test_restore_unacked__stomp_1_0(self):
+        self.channel.stomp_version = '1.0'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2')
+
+        self.assertEqual(self.qos.restore_unacked(), [])
+
+        self.assertEqual(sorted(c[0][0] for c in self.conn.ack.call_args_list),
+                         ['1', '2'])
+        self.assertEqual(self.channel._restore.call_count, 2)
+
+    def test_stats(self):
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2')
+        self.qos.ack('tag-1')
+
+        stats = self.qos.stats()
+
+        self.assertEqual(stats['unacked'], 1)
+        self.assertEqual(stats['slots'], 2)
+        self.assertEqual(stats['delivered'], 1)
+        self.assertEqual(stats['pending_acks'], 1)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_soak(self):
+        """Every way of settling a message frees its tracking."""
+        self.channel.metrics = metrics.Metrics()
+        self.channel.ack_batch_size = 10
+        empty = self.qos.stats()
+
+        def ack(tags):
+            for tag in tags:
+                self.qos.ack(tag)
+            self.qos.flush_acks()
+
+        def reject(tags):
+            for i, tag in enumerate(tags):
+                self.qos.reject(tag, requeue=bool(i % 2))
+
+        def restore(tags):
+            self.qos.restore_unacked()
+
+        def reconnect(tags):
+            self.qos.discard_stale()
+
+        for _ in range(50):
+            for settle in (ack, reject, restore, reconnect):
+                tags = ['tag-{0}'.format(i) for i in range(100)]
+                for tag in tags:
+                    self.qos.append(mock.Mock(msg_id=tag, queue='queue'), tag)
+                self.assertEqual(self.qos.stats()['unacked'], 100)
+
+                settle(tags)
+
+                self.assertEqual(self.qos.stats(), empty)
+            # the mocks remember all calls
+            self.conn.reset_mock()
+            self.channel.stomp_conn.reset_mock()
+
+    def test_begin_transaction__flushes_previous_acks(self):
+        self.channel.ack_batch_size = 10
+        self.deliver('1')
+        self.qos.ack('tag-1')
+
+        self.qos.begin_transaction('tx-1')
+
+        self.conn.ack.assert_called_once_with('1')
+        self.assertEqual(self.qos.transaction, 'tx-1')
+
+    def test_ack__within_transaction(self):
+        self.deliver('1')
+        self.qos.begin_transaction('tx-1')
+
+        self.qos.ack('tag-1')
+
+        self.conn.ack.assert_called_once_with('1', transaction='tx-1')
+
+    def test_end_transaction__commit_flushes_acks(self):
+        self.channel.ack_batch_size = 10
+        self.deliver('1')
+        self.qos.begin_transaction('tx-1')
+        self.qos.ack('tag-1')
+
+        self.qos.end_transaction()
+
+        self.conn.ack.assert_called_once_with('1', transaction='tx-1')
+        self.assertIsNone(self.qos.transaction)
+
+    def test_end_transaction__abort_forgets_acks(self):
+        self.channel.ack_mode = 'client'
+        self.channel.ack_batch_size = 10
+        self.deliver('1', '2')
+        self.qos.ack('tag-1')
+        self.qos.begin_transaction('tx-1')
+        self.qos.ack('tag-2')
+
+        self.qos.end_transaction(commit=False)
+        self.qos.flush_acks()
+
+        self.conn.ack.assert_called_once_with('1')
+        self.assertEqual(dict(self.qos._delivery_order), {'queue': {}})
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = transport.ConnectionPool(2)
+        self.create = mock.Mock(side_effect=lambda: mock.Mock())
+
+    def test_acquire__creates_connection(self):
+        with self.pool.acquire(self.create) as conn:
+            self.create.assert_called_once_with()
+            self.assertIsNotNone(conn)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_acquire__reuses_free_connection(self):
+        with self.pool.acquire(self.create) as conn1:
+            pass
+        with self.pool.acquire(self.create) as conn2:
+            pass
+
+        self.assertIs(conn1, conn2)
+        self.assertEqual(self.create.call_count, 1)
+
+    def test_acquire__one_connection_per_user(self):
+        with self.pool.acquire(self.create) as conn1:
+            with self.pool.acquire(self.create) as conn2:
+                self.assertIsNot(conn1, conn2)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_acquire__waits_when_full(self):
+        self.pool.limit = 1
+        acquired = []
+
+        def acquire():
+            with self.pool.acquire(self.create) as conn:
+                acquired.append(conn)
+
+        with self.pool.acquire(self.create) as conn:
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join(0.05)
+            self.assertEqual(acquired, [])
+        thread.join(5)
+
+        self.assertEqual(acquired, [conn])
+
+    def test_acquire__replaces_broken_connection(self):
+        with self.pool.acquire(self.create) as conn1:
+            conn1.is_connected.return_value = False
+        with self.pool.acquire(self.create) as conn2:
+            pass
+
+        self.assertIsNot(conn1, conn2)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_acquire__create_fails(self):
+        self.create.side_effect = exc.ConnectFailedException
+        with self.assertRaises(exc.ConnectFailedException):
+            with self.pool.acquire(self.create):
+                pass
+        self.assertEqual(len(self.pool), 0)
+
+    def test_close(self):
+        with self.pool.acquire(self.create) as conn:
+            pass
+
+        self.pool.close()
+
+        conn.disconnect.assert_called_once_with()
+        self.assertEqual(len(self.pool), 0)
+
+
+class SharedConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.listener = stomp.MessageListener()
+        self.shared = mock.Mock()
+        self.shared.message_listener = stomp.MessageListener()
+        self.conn = transport.SharedConnection(self.listener)
+        self.conn.conn = self.shared
+
+    def test_not_attached(self):
+        conn = transport.SharedConnection(self.listener)
+
+        self.assertFalse(conn.is_connected())
+        with self.assertRaises(exc.NotConnectedException):
+            conn.send('/queue/a', 'body')
+
+    def test_attach(self):
+        channel = mock.Mock()
+        conn = transport.SharedConnection(self.listener)
+
+        conn.attach(channel.connection, channel)
+
+        channel.connection.shared_conn.assert_called_once_with(channel)
+        self.assertIs(conn.conn, channel.connection.shared_conn.return_value)
+
+    def test_delegates(self):
+        self.conn.send('/queue/a', 'body')
+        self.shared.send.assert_called_once_with('/queue/a', 'body')
+
+    def test_subscribe__routes(self):
+        self.conn.subscribe('/queue/a', id='1:/queue/a', ack='auto')
+
+        self.shared.subscribe.assert_called_once_with('/queue/a',
+                                                      id='1:/queue/a',
+                                                      ack='auto')
+        self.assertIs(self.shared.message_listener.routes['1:/queue/a'],
+                      self.listener)
+
+    def test_unsubscribe(self):
+        self.conn.subscribe('/queue/a', id='1:/queue/a')
+        self.conn.unsubscribe('1:/queue/a')
+
+        self.shared.unsubscribe.assert_called_once_with(id='1:/queue/a')
+        self.assertEqual(self.shared.message_listener.routes, {})
+
+    def test_disconnect__only_unsubscribes(self):
+        self.conn.subscribe('/queue/a', id='1:/queue/a')
+        self.conn.disconnect()
+
+        self.shared.unsubscribe.assert_called_once_with(id='1:/queue/a')
+        self.assertFalse(self.shared.disconnect.called)
+
+    def test_disconnect__not_connected(self):
+        self.shared.is_connected.return_value = False
+
+        with self.assertRaises(exc.NotConnectedException):
+            self.conn.disconnect()
+
 
 class ChannelConnectionTests(unittest.TestCase):
     def setUp(self):
@@ -91,6 +687,12 @@ class ChannelConnectionTests(unittest.TestCase):
             'client.transport_options': {},
             'client.userid': self.userid,
             'client.password': self.passcode,
+            'client.hostname': 'localhost',
+            'client.port': 61613,
+            'client.alt': [],
+            'publisher_pool': None,
+            'broker_latency': {},
+            'state': virtual.BrokerState(),
         })
         self.channel = transport.Channel(connection=self.connection)
         self.queue = 'queue'
@@ -123,6 +725,16 @@ class ChannelConnectionTests(unittest.TestCase):
             wait=True,
         )
 
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__discard_stale_on_connect(self, Connection):
+        Connection.return_value.is_connected.return_value = False
+        self.channel.qos.ids['tag'] = 'msg-id'
+
+        with self.channel.conn_or_acquire():
+            pass
+
+        self.assertEqual(self.channel.qos.ids, {})
+
     @mock.patch('kombu_stomp.stomp.Connection')
     def test_conn_or_acquire__do_not_disconnect(self, Connection):
         Connection.return_value.is_connected.return_value = False
@@ -158,106 +770,1001 @@ class ChannelConnectionTests(unittest.TestCase):
         iterator.return_value = iter([1])
 
         self.assertEqual(self.channel._get_many([self.queue]), 1)
-        iterator.assert_called_once_with()
+        iterator.assert_called_once_with(1.0, [self.queue])
 
+    @mock.patch('kombu_stomp.transport.QoS.flush_acks')
     @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
                 new_callable=mock.MagicMock)  # for the context manager
-    def test_put(self, conn_or_acquire):
-        message = {'body': 'body'}
+    def test_get_many__flush_acks_when_idle(self, conn_or_acquire, flush):
         stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.message_listener.qsize.return_value = 0
+        stomp_conn.message_listener.iterator.return_value = iter([1])
 
-        self.channel._put(self.queue, message)
+        self.channel._get_many([self.queue])
 
-        stomp_conn.send.assert_called_once_with(
-            '/queue/{0}'.format(self.queue),
-            'body'
-        )
+        flush.assert_called_once_with()
 
-    @mock.patch('kombu.transport.virtual.Channel.basic_consume')
+    @mock.patch('kombu_stomp.transport.QoS.flush_acks')
     @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
                 new_callable=mock.MagicMock)  # for the context manager
-    def test_basic_consume__subscribe(self, conn_or_acquire, basic_consume):
+    def test_get_many__no_flush_acks_when_busy(self, conn_or_acquire, flush):
         stomp_conn = conn_or_acquire.return_value.__enter__.return_value
-        self.channel.basic_consume(self.queue)
+        stomp_conn.message_listener.qsize.return_value = 1
+        stomp_conn.message_listener.iterator.return_value = iter([1])
 
-        stomp_conn.subscribe.assert_called_once_with(
-            '/queue/{0}'.format(self.queue),
-            ack='client-individual',
-        )
+        self.channel._get_many([self.queue])
+
+        self.assertFalse(flush.called)
 
-    @mock.patch('kombu.transport.virtual.Channel.basic_consume')
     @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
                 new_callable=mock.MagicMock)  # for the context manager
-    def test_basic_consume__super(self, conn_or_acquire, basic_consume):
-        self.channel.basic_consume(self.queue)
+    def test_get_many__timeout(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        iterator = stomp_conn.message_listener.iterator
+        iterator.return_value = iter([1])
 
-        basic_consume.assert_called_once_with(self.queue)
+        self.channel._get_many([self.queue], timeout=5)
 
-    def test_subscribe__already_subscribed(self):
-        self.channel.subscribe(self.connection, self.queue)
+        iterator.assert_called_once_with(5, [self.queue])
 
-        self.assertIsNone(self.channel.subscribe(self.connection, self.queue))
-        self.assertEqual(self.connection.subscribe.call_count, 1)
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_get_many__consume_timeout(self, conn_or_acquire):
+        self.connection.client.transport_options = {'consume_timeout': 0.1}
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        iterator = stomp_conn.message_listener.iterator
+        iterator.return_value = iter([1])
 
-    def test_subscribe__super(self):
-        self.channel.subscribe(self.connection, self.queue)
+        self.channel._get_many([self.queue])
 
-        self.connection.subscribe.assert_called_once_with(
-            '/queue/{0}'.format(self.queue),
-            ack='client-individual',
-        )
+        iterator.assert_called_once_with(0.1, [self.queue])
 
-    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
-    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
-                new_callable=mock.MagicMock)  # for the context manager
-    def test_queue_unbind__calls_super(self, conn_or_acquire, queue_unbind):
-        self.channel.queue_unbind(self.queue)
+    @mock.patch('kombu_stomp.transport.Channel._get_many')
+    def test_drain_events__no_consumers(self, get_many):
+        with self.assertRaises(_queue.Empty):
+            self.channel.drain_events(timeout=5)
 
-        queue_unbind.assert_called_once_with(self.queue, None, '', None)
+        self.assertFalse(get_many.called)
 
-    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
-    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
-                new_callable=mock.MagicMock)  # for the context manager
-    def test_queue_unbind__unsubscribe(self, conn_or_acquire, queue_unbind):
-        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
-        self.channel.queue_unbind(self.queue)
+    @mock.patch('kombu_stomp.transport.Channel._get_many')
+    def test_drain_events__prefetch_limit(self, get_many):
+        self.channel._consumers.add('tag')
+        self.channel.qos.can_consume = mock.Mock(return_value=False)
 
-        stomp_conn.unsubscribe.assert_called_once_with(
-            '/queue/{0}'.format(self.queue)
-        )
+        with self.assertRaises(_queue.Empty):
+            self.channel.drain_events(timeout=5)
 
-    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
-    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
-                new_callable=mock.MagicMock)  # for the context manager
-    def test_queue_unbind__subscriptions_discard(self,
-                                                 conn_or_acquire,
-                                                 queue_unbind):
-        self.channel.subscribe(mock.MagicMock(), self.queue)
-        self.assertSetEqual(self.channel._subscriptions, set([self.queue]))
+        self.assertFalse(get_many.called)
 
-        self.channel.queue_unbind(self.queue)
+    @mock.patch('kombu_stomp.transport.Channel._get_many')
+    def test_drain_events__gets(self, get_many):
+        self.channel._consumers.add('tag')
 
-        self.assertSetEqual(self.channel._subscriptions, set())
+        self.assertEqual(self.channel.drain_events(timeout=5),
+                         get_many.return_value)
+        get_many.assert_called_once_with(self.channel._active_queues,
+                                         timeout=5)
 
-    @mock.patch('kombu.transport.virtual.Channel.close')
-    @mock.patch('kombu_stomp.stomp.Connection')
-    def test_close__call_super(self, Connection, close):
-        self.channel.close()
+    @mock.patch('kombu_stomp.transport.Channel._get_many')
+    def test_drain_events__callback(self, get_many):
+        self.channel._consumers.add('tag')
+        get_many.return_value = ('message', 'queue')
+        callback = mock.Mock()
 
-        close.assert_called_once_with()
+        self.assertIsNone(self.channel.drain_events(timeout=0,
+                                                    callback=callback))
 
-    @mock.patch('kombu.transport.virtual.Channel.close')
-    @mock.patch('kombu_stomp.stomp.Connection')
-    def test_close__disconnect(self, Connection, close):
-        self.channel.close()
+        callback.assert_called_once_with('message', 'queue')
 
-        Connection.return_value.disconnect.assert_called_once_with()
+    def test_prepare_message__no_priority(self):
+        for priority in (None, 0):
+            message = self.channel.prepare_message('body', priority)
 
-    @mock.patch('kombu.transport.virtual.Channel.close')
-    @mock.patch('kombu_stomp.stomp.Connection')
-    def test_close__close_closed_connection(self, Connection, close):
-        Connection.close.side_effect = exc.NotConnectedException
-        self.channel.close()  # just check this doesn't trigger exceptions
+            self.assertNotIn('priority', message['properties'])
+            self.assertNotIn('priority',
+                             message['properties']['delivery_info'])
+            self.assertNotIn('priority', stomp.encode_headers(message))
+
+    def test_prepare_message__priority(self):
+        message = self.channel.prepare_message('body', 7)
+        self.assertEqual(stomp.encode_headers(message)['priority'], 7)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put(self, conn_or_acquire):
+        message = {'body': 'body'}
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, message)
+
+        stomp_conn.send.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            'body',
+            headers={stomp.PUBLISHED_HEADER: mock.ANY},
+        )
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__encode_headers(self, conn_or_acquire):
+        message = {
+            'body': 'body',
+            'headers': {'task': 'add'},
+            'properties': {'delivery_tag': 'tag'},
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, message)
+
+        stomp_conn.send.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            'body',
+            headers={
+                'headers': '{"task":"add"}',
+                'properties': '{"delivery_tag":"tag"}',
+                'kombu-format': '1',
+                stomp.PUBLISHED_HEADER: mock.ANY,
+            },
+        )
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__filter_headers(self, conn_or_acquire):
+        self.connection.client.transport_options = {
+            'filter_headers': ['kind'],
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, {'body': 'body',
+                                       'headers': {'kind': 'a'}})
+
+        args, kwargs = stomp_conn.send.call_args
+        self.assertEqual(kwargs['headers']['kind'], 'a')
+        self.assertEqual(kwargs['headers'][stomp.FILTER_HEADER], 'kind')
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__legacy_headers(self, conn_or_acquire):
+        self.connection.client.transport_options = {
+            'json_headers': False,
+            'publish_timestamps': False,
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, {'body': 'body',
+                                       'headers': {'task': 'add'}})
+
+        args, kwargs = stomp_conn.send.call_args
+        self.assertEqual(kwargs['headers'], {'headers': {'task': 'add'}})
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__no_publish_timestamps(self, conn_or_acquire):
+        self.connection.client.transport_options = {
+            'publish_timestamps': False,
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, {'body': 'body'})
+
+        args, kwargs = stomp_conn.send.call_args
+        self.assertEqual(kwargs['headers'], {})
+
+    def test_trace(self):
+        callback = mock.Mock()
+        self.connection.client.transport_options = {
+            'trace_callback': callback,
+        }
+        self.channel.metrics = metrics.InMemoryMetrics()
+        message = mock.Mock(queue='queue',
+                            broker=('broker', 61613),
+                            queue_wait=1.0,
+                            buffer_wait=None,
+                            latency=2.0)
+
+        self.channel.trace(message)
+
+        callback.assert_called_once_with(message)
+        labels = {'queue': 'queue', 'broker': 'broker:61613'}
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_queue_wait_seconds',
+                                     **labels),
+            (1, 1.0),
+        )
+        self.assertIsNone(
+            self.channel.metrics.get('kombu_stomp_buffer_wait_seconds',
+                                     **labels),
+        )
+        self.assertEqual(
+            self.channel.metrics.get('kombu_stomp_latency_seconds',
+                                     **labels),
+            (1, 2.0),
+        )
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__compression(self, conn_or_acquire):
+        self.connection.client.transport_options = {
+            'compression': 'zlib',
+            'compression_threshold': 10,
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, {'body': 'body' * 10})
+
+        args, kwargs = stomp_conn.send.call_args
+        self.assertEqual(kwargs['headers'], {
+            'kombu-compression': 'zlib',
+            stomp.PUBLISHED_HEADER: mock.ANY,
+        })
+        self.assertEqual(zlib.decompress(args[1]), b'body' * 10)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__compression_threshold(self, conn_or_acquire):
+        self.connection.client.transport_options = {'compression': 'zlib'}
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+
+        self.channel._put(self.queue, {'body': 'body'})
+
+        stomp_conn.send.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            b'body',
+            headers={stomp.PUBLISHED_HEADER: mock.ANY},
+        )
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__publisher_pool(self, conn_or_acquire):
+        self.connection.publisher_pool = mock.MagicMock()
+        pool_conn = (self.connection.publisher_pool.acquire.return_value
+                     .__enter__.return_value)
+
+        self.channel._put(self.queue, {'body': 'body'})
+
+        self.connection.publisher_pool.acquire.assert_called_once_with(
+            self.channel._new_publisher_conn,
+        )
+        pool_conn.send.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            'body',
+            headers={stomp.PUBLISHED_HEADER: mock.ANY},
+        )
+        self.assertFalse(conn_or_acquire.called)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_publish_batch(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.batching = False
+
+        with self.channel.publish_batch():
+            self.channel._put(self.queue, {'body': 'body'})
+            self.channel._put(self.queue, {'body': 'body'})
+            stomp_conn.begin_batch.assert_called_once_with(None, 1 << 16)
+
+        self.assertEqual(stomp_conn.send.call_count, 2)
+        stomp_conn.end_batch.assert_called_once_with()
+        self.assertIsNone(self.channel._local.batch_conn)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_publish_batch__holds_one_connection(self, conn_or_acquire):
+        self.connection.publisher_pool = mock.MagicMock()
+        acquire = self.connection.publisher_pool.acquire
+
+        with self.channel.publish_batch():
+            self.channel._put(self.queue, {'body': 'body'})
+            self.channel._put(self.queue, {'body': 'body'})
+
+        self.assertEqual(acquire.call_count, 1)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_publish_batch__nested(self, conn_or_acquire):
+        self.connection.publisher_pool = mock.MagicMock()
+        acquire = self.connection.publisher_pool.acquire
+        stomp_conn = acquire.return_value.__enter__.return_value
+        stomp_conn.batching = False
+
+        with self.channel.publish_batch():
+            stomp_conn.batching = True
+            with self.channel.publish_batch():
+                self.channel._put(self.queue, {'body': 'body'})
+            self.assertIs(self.channel._local.batch_conn, stomp_conn)
+            self.channel._put(self.queue, {'body': 'body'})
+            self.assertFalse(stomp_conn.flush.called)
+            self.assertFalse(stomp_conn.end_batch.called)
+
+        self.assertEqual(acquire.call_count, 1)
+        self.assertEqual(stomp_conn.send.call_count, 2)
+        stomp_conn.end_batch.assert_called_once_with()
+        self.assertIsNone(self.channel._local.batch_conn)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_publish_batch__already_batching(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.batching = True
+
+        with self.channel.publish_batch():
+            pass
+
+        self.assertFalse(stomp_conn.begin_batch.called)
+        self.assertFalse(stomp_conn.end_batch.called)
+        stomp_conn.flush.assert_called_once_with()
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_transaction__commit(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.begin.return_value = 'tx-1'
+
+        with self.channel.transaction() as transaction:
+            self.assertEqual(transaction, 'tx-1')
+            self.assertEqual(self.channel.qos.transaction, 'tx-1')
+
+        stomp_conn.commit.assert_called_once_with('tx-1')
+        self.assertFalse(stomp_conn.abort.called)
+        self.assertIsNone(self.channel.qos.transaction)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_transaction__abort_on_error(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.begin.return_value = 'tx-1'
+
+        with self.assertRaises(ValueError):
+            with self.channel.transaction():
+                raise ValueError()
+
+        stomp_conn.abort.assert_called_once_with('tx-1')
+        self.assertFalse(stomp_conn.commit.called)
+        self.assertIsNone(self.channel.qos.transaction)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_transaction__abort_on_interrupt(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.begin.return_value = 'tx-1'
+
+        with self.assertRaises(KeyboardInterrupt):
+            with self.channel.transaction():
+                raise KeyboardInterrupt()
+
+        stomp_conn.abort.assert_called_once_with('tx-1')
+        self.assertFalse(stomp_conn.commit.called)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_put__within_transaction(self, conn_or_acquire):
+        self.connection.publisher_pool = mock.MagicMock()
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        stomp_conn.begin.return_value = 'tx-1'
+
+        with self.channel.transaction():
+            self.channel._put(self.queue, {'body': 'body'})
+
+        stomp_conn.send.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            'body',
+            headers={'transaction': 'tx-1',
+                     stomp.PUBLISHED_HEADER: mock.ANY},
+        )
+        self.assertFalse(self.connection.publisher_pool.acquire.called)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__publish_batch_size(self, Connection):
+        self.connection.client.transport_options = {
+            'publish_batch_size': 100,
+        }
+        self.channel.stomp_conn
+
+        Connection.return_value.begin_batch.assert_called_once_with(
+            100, 1 << 16, 0.01,
+        )
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__no_batching_by_default(self, Connection):
+        self.channel.stomp_conn
+        self.assertFalse(Connection.return_value.begin_batch.called)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_new_publisher_conn(self, Connection):
+        conn = self.channel._new_publisher_conn()
+
+        self.assertEqual(conn, Connection.return_value)
+        self.assertNotIn('waker', Connection.call_args[1])
+        conn.start.assert_called_once_with()
+        conn.connect.assert_called_once_with(
+            username=self.userid,
+            passcode=self.passcode,
+            wait=True,
+        )
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__version_and_heartbeats(self, Connection):
+        self.connection.client.transport_options = {
+            'stomp_version': '1.1',
+            'heartbeats': [1000, 1000],
+        }
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['version'], '1.1')
+        self.assertEqual(Connection.call_args[1]['heartbeats'], (1000, 1000))
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__defaults_to_1_2(self, Connection):
+        self.channel.stomp_conn
+        self.assertEqual(Connection.call_args[1]['version'], '1.2')
+
+    def test_brokers(self):
+        self.connection.client.alt = ['stomp://localhost:61613',
+                                      'stomp://b:61614']
+        self.connection.client.transport_options = {
+            'failover': ['c:61615', 'd', ('e', 61616), 'b:61614'],
+        }
+
+        self.assertEqual(self.channel.brokers, [
+            ('localhost', 61613),
+            ('b', 61614),
+            ('c', 61615),
+            ('d', 61613),
+            ('e', 61616),
+        ])
+
+    def test_sort_brokers(self):
+        self.connection.broker_latency = {
+            ('a', 1): transport.FAILED,
+            ('b', 1): 0.2,
+            ('d', 1): 0.1,
+        }
+
+        self.assertEqual(
+            self.channel.sort_brokers([('a', 1), ('b', 1), ('c', 1),
+                                       ('d', 1), ('e', 1)]),
+            [('d', 1), ('b', 1), ('c', 1), ('e', 1), ('a', 1)],
+        )
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__reconnect_params(self, Connection):
+        self.connection.client.transport_options = {
+            'failover': ['b:61613'],
+            'reconnect_attempts': 3,
+            'reconnect_delay': 1.0,
+            'reconnect_delay_max': 10.0,
+            'reconnect_backoff': 1.0,
+            'reconnect_jitter': 0.5,
+        }
+        self.connection.broker_latency[('b', 61613)] = 0.1
+
+        self.channel.stomp_conn
+
+        params = Connection.call_args[1]
+        self.assertEqual(params['host_and_ports'],
+                         [('b', 61613), ('localhost', 61613)])
+        self.assertEqual(params['reconnect_attempts_max'], 6)
+        self.assertEqual(params['reconnect_sleep_initial'], 1.0)
+        self.assertEqual(params['reconnect_sleep_max'], 10.0)
+        self.assertEqual(params['reconnect_sleep_increase'], 1.0)
+        self.assertEqual(params['reconnect_sleep_jitter'], 0.5)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__reconnect_forever(self, Connection):
+        self.connection.client.transport_options = {'reconnect_attempts': -1}
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['reconnect_attempts_max'],
+                         -1)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__record_latency(self, Connection):
+        self.connection.client.transport_options = {'failover': ['b:61613']}
+        conn = Connection.return_value
+        conn.is_connected.return_value = False
+        conn.transport.current_host_and_port = ('b', 61613)
+
+        with self.channel.conn_or_acquire():
+            pass
+
+        latency = self.connection.broker_latency
+        self.assertEqual(latency[('localhost', 61613)], transport.FAILED)
+        self.assertLess(latency[('b', 61613)], 1)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__record_failure(self, Connection):
+        Connection.return_value.is_connected.return_value = False
+        Connection.return_value.start.side_effect = exc.ConnectFailedException
+
+        with self.assertRaises(exc.ConnectFailedException):
+            with self.channel.conn_or_acquire():
+                pass
+
+        self.assertEqual(self.connection.broker_latency,
+                         {('localhost', 61613): transport.FAILED})
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__failover(self, Connection):
+        lost, new = mock.Mock(), mock.Mock()
+        lost.is_connected.return_value = False
+        Connection.side_effect = [lost, new]
+        with self.channel.conn_or_acquire() as conn:
+            self.channel.subscribe(conn, self.queue)
+        # still not connected, so it was lost
+        self.channel.qos.ids['tag'] = 'msg-id'
+
+        with self.channel.conn_or_acquire() as conn:
+            self.assertEqual(conn, new)
+
+        lost.transport.disconnect_socket.assert_called_once_with()
+        lost.message_listener.close.assert_called_once_with()
+        new.start.assert_called_once_with()
+        new.subscribe.assert_called_once_with('/queue/queue',
+                                              id='/queue/queue',
+                                              ack='client-individual')
+        self.assertEqual(self.channel.qos.ids, {})
+        self.assertIsNotNone(self.channel.failover_time)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__failover_resubscribes_with_prefetch(
+            self, Connection):
+        callback = mock.Mock()
+        self.connection.client.transport_options = {
+            'reconnect_callback': callback,
+        }
+        lost, new = mock.Mock(), mock.Mock()
+        lost.is_connected.return_value = False
+        Connection.side_effect = [lost, new]
+        with self.channel.conn_or_acquire() as conn:
+            self.channel.subscribe(conn, self.queue)
+        self.channel.qos.prefetch_count = 10
+
+        with self.channel.conn_or_acquire():
+            pass
+
+        new.subscribe.assert_called_once_with('/queue/queue',
+                                              id='/queue/queue',
+                                              ack='client-individual',
+                                              **{'activemq.prefetchSize': 10})
+        callback.assert_called_once_with(self.channel)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__older_version(self, Connection):
+        old_conn, new_conn = mock.Mock(), mock.Mock()
+        old_conn.is_connected.return_value = False
+        old_conn.connect.side_effect = stomp.VersionMismatch('1.1')
+        Connection.side_effect = [old_conn, new_conn]
+
+        with self.channel.conn_or_acquire() as conn:
+            self.assertEqual(conn, new_conn)
+
+        self.assertEqual(self.channel.stomp_version, '1.1')
+        self.assertEqual(Connection.call_args[1]['version'], '1.1')
+        new_conn.connect.assert_called_once_with(
+            username=self.userid,
+            passcode=self.passcode,
+            wait=True,
+        )
+
+    @mock.patch('kombu.transport.virtual.Channel.basic_consume')
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_basic_consume__subscribe(self, conn_or_acquire, basic_consume):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        self.channel.basic_consume(self.queue)
+
+        stomp_conn.subscribe.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            id='/queue/{0}'.format(self.queue),
+            ack='client-individual',
+        )
+
+    @mock.patch('kombu.transport.virtual.Channel.basic_consume')
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_basic_consume__super(self, conn_or_acquire, basic_consume):
+        self.channel.basic_consume(self.queue)
+
+        basic_consume.assert_called_once_with(self.queue)
+
+    def test_subscribe__already_subscribed(self):
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertIsNone(self.channel.subscribe(self.connection, self.queue))
+        self.assertEqual(self.connection.subscribe.call_count, 1)
+
+    def test_subscribe__super(self):
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.connection.subscribe.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            id='/queue/{0}'.format(self.queue),
+            ack='client-individual',
+        )
+
+    def test_subscribe__ack_mode(self):
+        self.connection.client.transport_options = {'ack_mode': 'client'}
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.connection.subscribe.assert_called_once_with(
+            '/queue/{0}'.format(self.queue),
+            id='/queue/{0}'.format(self.queue),
+            ack='client',
+        )
+
+    def test_subscribe__prefetch(self):
+        self.channel.qos.prefetch_count = 10
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(
+            self.connection.subscribe.call_args[1]['activemq.prefetchSize'],
+            10,
+        )
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_basic_qos__resubscribes(self, Connection):
+        stomp_conn = Connection.return_value
+        with self.channel.conn_or_acquire() as conn:
+            self.channel.subscribe(conn, self.queue)
+        stomp_conn.reset_mock()
+
+        self.channel.basic_qos(prefetch_count=10)
+
+        subscription = '/queue/{0}'.format(self.queue)
+        receipt = stomp_conn.unsubscribe.call_args[1]['receipt']
+        stomp_conn.message_listener.discard.assert_called_once_with(
+            subscription, self.queue, receipt)
+        stomp_conn.unsubscribe.assert_called_once_with(id=subscription,
+                                                       receipt=receipt)
+        stomp_conn.subscribe.assert_called_once_with(
+            subscription,
+            id=subscription,
+            ack='client-individual',
+            **{'activemq.prefetchSize': 10})
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_basic_qos__unchanged(self, Connection):
+        stomp_conn = Connection.return_value
+        self.channel.basic_qos(prefetch_count=10)
+        with self.channel.conn_or_acquire() as conn:
+            self.channel.subscribe(conn, self.queue)
+
+        self.channel.basic_qos(prefetch_count=10)
+
+        self.assertFalse(stomp_conn.unsubscribe.called)
+        self.assertEqual(stomp_conn.subscribe.call_count, 1)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_basic_qos__waits_for_unacked(self, Connection):
+        stomp_conn = Connection.return_value
+        stomp_conn.message_listener.iterator.return_value = iter([1])
+        with self.channel.conn_or_acquire() as conn:
+            self.channel.subscribe(conn, self.queue)
+        message = mock.Mock(msg_id='1', queue=self.queue)
+        self.channel.qos.append(message, 'tag-1')
+
+        self.channel.basic_qos(prefetch_count=10)
+        self.assertFalse(stomp_conn.unsubscribe.called)
+
+        self.channel.basic_ack('tag-1')
+        self.channel._get_many([self.queue])
+        self.assertEqual(stomp_conn.unsubscribe.call_count, 1)
+        self.assertEqual(
+            stomp_conn.subscribe.call_args[1]['activemq.prefetchSize'], 10)
+
+    def test_subscribe__prefetch_header(self):
+        self.connection.client.transport_options = {
+            'prefetch_header': 'prefetch-count',
+        }
+        self.channel.qos.prefetch_count = 10
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(
+            self.connection.subscribe.call_args[1]['prefetch-count'],
+            10,
+        )
+
+    def test_subscribe__selector(self):
+        self.channel.queue_declare(self.queue,
+                                   arguments={'selector': "kind = 'a'"})
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(self.connection.subscribe.call_args[1]['selector'],
+                         "kind = 'a'")
+
+    def test_subscribe__selectors_option(self):
+        self.connection.client.transport_options = {
+            'selectors': {self.queue: "kind = 'b'"},
+        }
+        self.channel.queue_declare(self.queue)
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(self.connection.subscribe.call_args[1]['selector'],
+                         "kind = 'b'")
+
+    def test_subscribe__shared_connection(self):
+        self.connection.client.transport_options = {'shared_connection': True}
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(
+            self.connection.subscribe.call_args[1]['id'],
+            '{0}:/queue/{1}'.format(self.channel.channel_id, self.queue),
+        )
+
+    def test_subscribe__shared_connection_prefetch(self):
+        self.connection.client.transport_options = {
+            'shared_connection': True,
+            'receive_buffer_size': 100,
+        }
+        for prefetch_count, prefetch in ((0, 100), (10, 10), (200, 100)):
+            self.channel.qos.prefetch_count = prefetch_count
+            self.channel.subscribe(self.connection, prefetch_count)
+
+            self.assertEqual(
+                self.connection.subscribe.call_args[1][
+                    'activemq.prefetchSize'],
+                prefetch,
+            )
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_conn_or_acquire__shared_connection(self, Connection):
+        self.connection.client.transport_options = {'shared_connection': True}
+        shared = self.connection.shared_conn.return_value
+        shared.version = '1.1'
+
+        with self.channel.conn_or_acquire() as conn:
+            pass
+
+        self.assertIsInstance(conn, transport.SharedConnection)
+        self.connection.shared_conn.assert_called_once_with(self.channel)
+        self.assertIs(conn.conn, shared)
+        self.assertEqual(self.channel.stomp_version, '1.1')
+        # no connection of its own
+        self.assertFalse(Connection.called)
+
+    def bind(self, type, routing_key=''):
+        self.channel.exchange_declare('exchange', type)
+        self.channel.queue_declare(self.queue)
+        self.channel.queue_bind(self.queue, 'exchange', routing_key)
+
+    def test_subscribe__fanout(self):
+        self.bind('fanout', routing_key='ignored')
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.connection.subscribe.assert_called_once_with(
+            '/topic/exchange',
+            id='/queue/{0}'.format(self.queue),
+            ack='client-individual',
+        )
+
+    def test_subscribe__topic(self):
+        self.connection.client.transport_options = {'topic_exchanges': True}
+        self.bind('topic', routing_key='a.*.#')
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(self.connection.subscribe.call_args[0][0],
+                         '/topic/exchange.a.*.>')
+
+    def test_topic(self):
+        self.bind('fanout')
+        self.assertEqual(self.channel.topic(self.queue), ('exchange', None))
+        self.assertIsNone(self.channel.topic('unbound'))
+
+    def test_bindings(self):
+        self.bind('topic', routing_key='a.*')
+        self.assertEqual(self.channel.bindings(self.queue),
+                         [('exchange', 'a.*')])
+        self.assertEqual(self.channel.bindings('unbound'), [])
+
+    def test_subscribe__topic_as_queues(self):
+        self.bind('topic', routing_key='a.*')
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(self.connection.subscribe.call_args[0][0],
+                         '/queue/{0}'.format(self.queue))
+
+    def test_subscribe__virtual_topic(self):
+        self.connection.client.transport_options = {
+            'virtual_topics': True,
+            'queue_name_prefix': 'prefix.',
+        }
+        self.queue = 'celery.pidbox'
+        self.bind('fanout')
+        self.channel.subscribe(self.connection, self.queue)
+
+        self.assertEqual(
+            self.connection.subscribe.call_args[0][0],
+            '/queue/Consumer.celery_pidbox.VirtualTopic.prefix.exchange',
+        )
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_basic_publish__fanout(self, conn_or_acquire):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        self.bind('fanout')
+        message = self.channel.prepare_message('body')
+
+        self.channel.basic_publish(message, 'exchange', 'key')
+
+        stomp_conn.send.assert_called_once_with('/topic/exchange',
+                                                mock.ANY,
+                                                headers=mock.ANY)
+
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_basic_publish__topic(self, conn_or_acquire):
+        self.connection.client.transport_options = {
+            'topic_exchanges': True,
+            'virtual_topics': True,
+        }
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        self.bind('topic', routing_key='a.#')
+        message = self.channel.prepare_message('body')
+
+        self.channel.basic_publish(message, 'exchange', 'a.b')
+
+        self.assertEqual(stomp_conn.send.call_args[0][0],
+                         '/topic/VirtualTopic.exchange.a.b')
+
+    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_queue_unbind__calls_super(self, conn_or_acquire, queue_unbind):
+        self.channel.queue_unbind(self.queue)
+
+        queue_unbind.assert_called_once_with(self.queue, None, '', None)
+
+    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_queue_unbind__unsubscribe(self, conn_or_acquire, queue_unbind):
+        stomp_conn = conn_or_acquire.return_value.__enter__.return_value
+        self.channel.queue_unbind(self.queue)
+
+        stomp_conn.unsubscribe.assert_called_once_with(
+            id='/queue/{0}'.format(self.queue)
+        )
+
+    @mock.patch('kombu.transport.virtual.Channel.queue_unbind')
+    @mock.patch('kombu_stomp.transport.Channel.conn_or_acquire',
+                new_callable=mock.MagicMock)  # for the context manager
+    def test_queue_unbind__subscriptions_discard(self,
+                                                 conn_or_acquire,
+                                                 queue_unbind):
+        self.channel.subscribe(mock.MagicMock(), self.queue)
+        self.assertSetEqual(self.channel._subscriptions, set([self.queue]))
+
+        self.channel.queue_unbind(self.queue)
+
+        self.assertSetEqual(self.channel._subscriptions, set())
+
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__call_super(self, Connection, close):
+        self.channel.close()
+
+        close.assert_called_once_with()
+
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__disconnect(self, Connection, close):
+        self.channel.close()
+
+        Connection.return_value.disconnect.assert_called_once_with()
+
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__closes_listener(self, Connection, close):
+        self.channel.close()
+        listener = Connection.return_value.message_listener
+        listener.close.assert_called_once_with()
+
+    @mock.patch('kombu_stomp.transport.QoS.flush_acks')
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__flush_acks(self, Connection, close, flush_acks):
+        self.channel.stomp_conn
+        self.channel.close()
+
+        flush_acks.assert_called_once_with()
+
+    @mock.patch('kombu_stomp.transport.QoS.flush_acks')
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__no_flush_acks_if_not_connected(self,
+                                                   Connection,
+                                                   close,
+                                                   flush_acks):
+        Connection.return_value.is_connected.return_value = False
+        self.channel.stomp_conn
+        self.channel.close()
+
+        self.assertFalse(flush_acks.called)
+
+    @mock.patch('kombu.transport.virtual.Channel.close')
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_close__close_closed_connection(self, Connection, close):
+        Connection.close.side_effect = exc.NotConnectedException
+        self.channel.close()  # just check this doesn't trigger exceptions
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__waker(self, Connection):
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['waker'],
+                         self.connection.waker)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__receive_buffer(self, Connection):
+        self.connection.client.transport_options = {
+            'receive_buffer_size': 10,
+            'receive_buffer_bytes': 100,
+        }
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['buffer_size'], 10)
+        self.assertEqual(Connection.call_args[1]['buffer_bytes'], 100)
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__queue_weights(self, Connection):
+        self.connection.client.transport_options = {
+            'queue_weights': {'queue': 2},
+        }
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['queue_weights'],
+                         {'queue': 2})
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_stomp_conn__decode_workers(self, Connection):
+        self.connection.client.transport_options = {'decode_workers': 2}
+        self.channel.stomp_conn
+
+        self.assertEqual(Connection.call_args[1]['decode_workers'], 2)
+
+    def test_buffer_stats__no_connection(self):
+        self.assertEqual(self.channel.buffer_stats(),
+                         {'messages': 0, 'bytes': 0})
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_buffer_stats(self, Connection):
+        listener = Connection.return_value.message_listener
+        listener.qsize.return_value = 2
+        listener.buffered_bytes.return_value = 100
+        self.channel.stomp_conn
+
+        self.assertEqual(self.channel.buffer_stats(),
+                         {'messages': 2, 'bytes': 100})
+
+    def test_has_pending__no_connection(self):
+        self.assertFalse(self.channel.has_pending())
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_has_pending(self, Connection):
+        listener = Connection.return_value.message_listener
+        listener.qsize.return_value = 1
+        self.channel.stomp_conn
+        self.channel._consumers.add('tag')
+
+        self.assertTrue(self.channel.has_pending())
+
+    @mock.patch('kombu_stomp.stomp.Connection')
+    def test_has_pending__can_not_consume(self, Connection):
+        listener = Connection.return_value.message_listener
+        listener.qsize.return_value = 1
+        self.channel.stomp_conn
+        self.channel._consumers.add('tag')
+        self.channel.qos.prefetch_count = 1
+        self.channel.qos._delivered['tag'] = mock.Mock()
+        self.addCleanup(self.channel.qos._delivered.clear)
+
+        self.assertFalse(self.channel.has_pending())
+
+    def test_body_encoding(self):
+        self.assertEqual(self.channel.body_encoding, 'base64')
+
+    def test_body_encoding__raw(self):
+        self.connection.client.transport_options = {'body_encoding': None}
+        self.assertIsNone(self.channel.body_encoding)
 
     def test_queue_destination__prefix(self):
         self.connection.client.transport_options = {
@@ -268,3 +1775,185 @@ class ChannelConnectionTests(unittest.TestCase):
             self.channel.queue_destination(self.queue),
             '/queue/prefix.queue',
         )
+
+
+class TransportTests(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock(transport_options={})
+        self.transport = transport.Transport(self.client)
+        self.addCleanup(self.transport.close_connection, self.client)
+        self.loop = mock.Mock()
+        self.channel = mock.Mock()
+        self.transport.channels.append(self.channel)
+
+    def test_supports_ev(self):
+        self.assertTrue(self.transport.supports_ev)
+
+    def test_publisher_pool__disabled_by_default(self):
+        self.assertIsNone(self.transport.publisher_pool)
+
+    def test_publisher_pool(self):
+        self.client.transport_options = {'publisher_pool_size': 4}
+        pool = transport.Transport(self.client).publisher_pool
+
+        self.assertEqual(pool.limit, 4)
+
+    def test_close_connection__closes_publisher_pool(self):
+        self.transport.publisher_pool = mock.Mock()
+        self.transport.close_connection(self.client)
+        self.transport.publisher_pool.close.assert_called_once_with()
+
+    def shared_channel(self):
+        channel = mock.Mock()
+        channel._connect.side_effect = lambda conn, create: conn
+        channel._new_stomp_conn.side_effect = lambda **kwargs: mock.Mock()
+        return channel
+
+    def test_shared_conn(self):
+        channel = self.shared_channel()
+
+        conn = self.transport.shared_conn(channel)
+
+        channel._new_stomp_conn.assert_called_once_with(
+            waker=self.transport.waker,
+            metrics=self.transport.metrics,
+        )
+        self.assertEqual(conn.message_listener.routes, {})
+        self.assertIs(self.transport.shared_conn(channel), conn)
+        self.assertEqual(channel._connect.call_count, 1)
+
+    def test_shared_conn__replaces_lost(self):
+        channel = self.shared_channel()
+        lost = self.transport.shared_conn(channel)
+        lost.is_connected.return_value = False
+
+        conn = self.transport.shared_conn(channel)
+
+        self.assertIsNot(conn, lost)
+        lost.transport.disconnect_socket.assert_called_once_with()
+
+    def test_close_connection__disconnects_shared_conn(self):
+        shared = self.transport._shared_conn = mock.Mock()
+        self.transport.close_connection(self.client)
+
+        shared.disconnect.assert_called_once_with()
+        self.assertIsNone(self.transport._shared_conn)
+
+    def test_waker__shared(self):
+        self.assertIs(self.transport.waker, self.transport.waker)
+
+    def test_register_with_event_loop(self):
+        self.transport.register_with_event_loop(self.client, self.loop)
+
+        fd = self.transport.waker.fileno()
+        self.loop.add_reader.assert_called_once_with(
+            fd, self.transport.on_readable, fd,
+        )
+        self.loop.on_tick.add.assert_called_once_with(self.transport.on_tick)
+
+    def test_on_readable__delivers(self):
+        callback = mock.Mock()
+        self.transport._callbacks['queue'] = callback
+        self.channel.drain_events.side_effect = [('msg1', 'queue'),
+                                                 ('msg2', 'queue'),
+                                                 _queue.Empty()]
+
+        self.transport.on_readable(self.transport.waker.fileno())
+
+        self.channel.drain_events.assert_called_with(timeout=0)
+        self.assertEqual(callback.call_args_list,
+                         [mock.call('msg1'), mock.call('msg2')])
+
+    def test_on_readable__drains_waker(self):
+        self.channel.drain_events.side_effect = _queue.Empty()
+        with mock.patch.object(self.transport, '_waker') as waker:
+            self.transport.on_readable(waker.fileno.return_value)
+
+        waker.drain.assert_called_once_with()
+
+    def test_on_readable__no_consumers(self):
+        self.channel.drain_events.return_value = ('msg', 'queue')
+        self.assertRaises(KeyError, self.transport.on_readable, 1)
+
+    def test_drain_events__channels_take_turns(self):
+        callback = mock.Mock()
+        self.transport._callbacks['queue'] = callback
+        idle = mock.Mock()
+        idle.drain_events.side_effect = _queue.Empty()
+        self.transport.channels.insert(0, idle)
+        self.channel.drain_events.side_effect = [('msg1', 'queue'),
+                                                 ('msg2', 'queue')]
+
+        for _ in range(2):
+            self.transport.drain_events(self.client, timeout=5)
+
+        self.assertEqual(callback.call_args_list,
+                         [mock.call('msg1'), mock.call('msg2')])
+        # none of them blocks
+        for channel in self.transport.channels:
+            for call in channel.drain_events.call_args_list:
+                self.assertEqual(call, mock.call(timeout=0))
+
+    def test_drain_events__timeout(self):
+        self.channel.drain_events.side_effect = _queue.Empty()
+        self.transport.channels.extend([self.channel] * 2)
+        start = time.time()
+
+        with self.assertRaises(socket.timeout):
+            self.transport.drain_events(self.client, timeout=0.05)
+
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_drain_events__waits_for_wake_up(self):
+        callback = mock.Mock()
+        self.transport._callbacks['queue'] = callback
+        self.channel.has_pending.return_value = False
+        self.channel.drain_events.side_effect = [_queue.Empty(),
+                                                 ('msg', 'queue')]
+        timer = threading.Timer(0.05, self.transport.waker.wake)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.time()
+
+        self.transport.drain_events(self.client, timeout=5)
+
+        self.assertLess(time.time() - start, 1)
+        callback.assert_called_once_with('msg')
+
+    def test_drain_events__notify(self):
+        callback = mock.Mock()
+        self.transport._callbacks['queue'] = callback
+        self.channel.has_pending.return_value = False
+        self.channel.drain_events.side_effect = [_queue.Empty(),
+                                                 ('msg', 'queue')]
+        timer = threading.Timer(0.05, self.transport.notify)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.time()
+
+        self.transport.drain_events(self.client, timeout=5)
+
+        self.assertLess(time.time() - start, 1)
+
+    def test_notify__not_waiting(self):
+        with mock.patch.object(self.transport, '_waker') as waker:
+            self.transport.notify()
+
+        self.assertFalse(waker.wake.called)
+
+    def test_on_tick__wakes_up_on_pending(self):
+        self.channel.has_pending.return_value = True
+        with mock.patch.object(self.transport, '_waker') as waker:
+            self.transport.on_tick()
+        waker.wake.assert_called_once_with()
+
+    def test_on_tick__no_pending(self):
+        self.channel.has_pending.return_value = False
+        with mock.patch.object(self.transport, '_waker') as waker:
+            self.transport.on_tick()
+        self.assertFalse(waker.wake.called)
+
+    def test_on_tick__flush_acks(self):
+        self.channel.has_pending.return_value = False
+        self.transport.on_tick()
+        self.channel.qos.flush_acks.assert_called_once_with()